@@ -31,5 +31,6 @@ __all__ = ["argparse",
            "mcce"
            "runprm",
            "pdbio",
-           "geom"
+           "geom",
+           "ftpl_cache"
           ]
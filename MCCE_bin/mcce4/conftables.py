@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""
+Module: conftables.py
+
+Columnar loaders for the conformer tables written by mcce: head3.lst and fort.38
+(entropy.out has the layout of fort.38 and loads the same way).
+
+  * `read_head3`: Loads head3.lst into a NumPy structured array with one field per
+    column, named as in the head3.lst header (iConf, CONFORMER, FL, occ, ...), and "m"
+    for the on/mark flag that mcce writes after history ("" when the file has no flag).
+
+  * `read_fort38`: Loads fort.38 into an OccTable: titration type and points, conformer
+    names and the (n_conf, n_points) occupancy array.
+
+  * `head3_df`, `fort38_df`: The same tables as pandas.DataFrames.
+
+The text is parsed in one pass: when all data lines have the same length, as mcce writes
+them, the columns are cut from the file as fixed-width byte columns; otherwise the file is
+split on white space at once, or line by line when lines have different numbers of fields.
+The arrays are saved in a binary sidecar next to the file (e.g. head3.lst.npz), keyed by the
+size and modification time of the text file, so that the next load skips the text parsing.
+
+Usage:
+    head3 = read_head3("head3.lst")
+    charged = head3["CONFORMER"][head3["crg"] != 0]
+
+    fort38 = read_fort38("fort.38")
+    occ_at_ph7 = fort38.occ[:, list(fort38.points).index(7.0)]
+"""
+
+import logging
+import os
+from pathlib import Path
+from typing import List, NamedTuple, Union
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_EXT = ".npz"
+CACHE_VERSION = 2  # bump when the arrays saved in a sidecar change
+SPACE, NEWLINE = ord(" "), ord("\n")
+
+HEAD3_COLUMNS = [
+    ("iConf", np.int64),
+    ("CONFORMER", str),
+    ("FL", str),
+    ("occ", np.float64),
+    ("crg", np.float64),
+    ("Em0", np.float64),
+    ("pKa0", np.float64),
+    ("ne", np.int64),
+    ("nH", np.int64),
+    ("vdw0", np.float64),
+    ("vdw1", np.float64),
+    ("tors", np.float64),
+    ("epol", np.float64),
+    ("dsolv", np.float64),
+    ("extra", np.float64),
+    ("history", str),
+    ("m", str),  # on/mark flag (t, f or d) written after history, absent in older files
+]
+HEAD3_OPTIONAL = 1  # trailing columns of HEAD3_COLUMNS that a file may omit
+
+
+class OccTable(NamedTuple):
+    """A titration table such as fort.38: one row of values per conformer."""
+    titr_type: str        # first word of the header, e.g. "ph" or "eh"
+    labels: np.ndarray    # titration points as written in the header
+    points: np.ndarray
+    confname: np.ndarray
+    occ: np.ndarray       # (n_conf, n_points)
+
+
+def _sidecar(fp: Path) -> Path:
+    return fp.with_name(fp.name + CACHE_EXT)
+
+
+def _cache_key(fp: Path) -> str:
+    stat = fp.stat()
+    return "%d:%d:%d" % (CACHE_VERSION, stat.st_size, stat.st_mtime_ns)
+
+
+def _read_sidecar(fp: Path, key: str) -> Union[dict, None]:
+    """Arrays saved for fp, None if there is no sidecar or it is stale."""
+    sidecar = _sidecar(fp)
+    if not sidecar.is_file():
+        return None
+    try:
+        with np.load(sidecar, allow_pickle=False) as npz:
+            if str(npz["key"]) != key:
+                return None
+            return {name: npz[name] for name in npz.files}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_sidecar(fp: Path, key: str, arrays: dict):
+    """Save arrays next to fp. The sidecar is replaced in one step, and a folder that is not
+    writable only costs the text parsing next time."""
+    sidecar = _sidecar(fp)
+    tmp = sidecar.with_name(sidecar.name + ".%d.tmp" % os.getpid())
+    try:
+        with open(tmp, "wb") as fh:
+            np.savez(fh, key=np.array(key), **arrays)
+        os.replace(tmp, sidecar)
+    except OSError as e:
+        logger.debug("Can not write %s: %s", sidecar, e)
+        if tmp.exists():
+            tmp.unlink()
+
+
+def _fixed_width_columns(body: bytes, n_fields: int, n_optional: int = 0) -> Union[List[np.ndarray], None]:
+    """Byte string columns of body when its lines have the same length and the fields line up,
+    None otherwise. The last n_optional fields may be missing from all lines."""
+    if not body.endswith(b"\n"):
+        body += b"\n"
+    buf = np.frombuffer(body, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == NEWLINE)
+    width = int(newlines[0]) + 1
+    if len(buf) != len(newlines) * width or np.any(buf[width - 1::width] != NEWLINE):
+        return None
+
+    grid = buf.reshape(len(newlines), width)[:, :-1]
+    if grid.shape[1] and np.any(grid[:, -1] == ord("\r")):  # CRLF line ends
+        grid = grid[:, :-1]
+    filled = np.any(grid != SPACE, axis=0)
+    edges = np.flatnonzero(np.diff(np.concatenate([[0], filled.view(np.int8), [0]])))
+    starts, ends = edges[::2], edges[1::2]
+    if not n_fields - n_optional <= len(starts) <= n_fields:
+        return None
+
+    columns = []
+    for start, end in zip(starts, ends):
+        field = np.ascontiguousarray(grid[:, start:end])
+        columns.append(field.view("S%d" % (end - start)).ravel())
+    return columns
+
+
+def _split_columns(body: bytes, n_fields: int, n_optional: int = 0) -> List[np.ndarray]:
+    """Byte string columns of body split on white space. Lines with fewer fields than
+    n_fields - n_optional are skipped, fields past n_fields are ignored."""
+    # fields per line, from the starts of non blank runs
+    buf = np.frombuffer(body, dtype=np.uint8)
+    blank = (buf == SPACE) | (buf == NEWLINE) | (buf == ord("\t")) | (buf == ord("\r"))
+    starts = np.flatnonzero(~blank & np.concatenate([[True], blank[:-1]]))
+    line_of_field = np.searchsorted(np.flatnonzero(buf == NEWLINE), starts)
+    fields_per_line = np.bincount(line_of_field)
+
+    counts = np.unique(fields_per_line[fields_per_line > 0])
+    if len(counts) == 1 and n_fields - n_optional <= counts[0] <= n_fields:
+        width = int(counts[0])
+        rows = np.array(body.split(), dtype=bytes).reshape(-1, width)
+    else:
+        width = n_fields
+        rows = [line.split()[:n_fields] for line in body.splitlines()]
+        rows = [row + [b""] * (n_fields - len(row)) for row in rows if len(row) >= n_fields - n_optional]
+        rows = np.array(rows, dtype=bytes).reshape(-1, n_fields)
+    return [rows[:, i] for i in range(width)]
+
+
+def _parse_columns(body: bytes, n_fields: int, n_optional: int = 0) -> List[np.ndarray]:
+    """Columns of body, the missing optional ones as empty byte strings."""
+    columns = None
+    if body.strip():
+        columns = _fixed_width_columns(body, n_fields, n_optional)
+    if columns is None:
+        columns = _split_columns(body, n_fields, n_optional)
+    n_rows = len(columns[0]) if columns else 0
+    return columns + [np.zeros(n_rows, dtype="S1")] * (n_fields - len(columns))
+
+
+def _to_type(column: np.ndarray, dtype) -> np.ndarray:
+    if dtype is str:
+        return np.char.strip(column).astype(str)
+    return column.astype(dtype)
+
+
+def read_head3(fp: Union[str, Path] = "head3.lst", use_cache: bool = True) -> np.ndarray:
+    """Load head3.lst as a structured array, one record per conformer, with the fields of
+    HEAD3_COLUMNS. Energy terms are as written in the file, not scaled."""
+    fp = Path(fp)
+    key = _cache_key(fp)
+    if use_cache:
+        cached = _read_sidecar(fp, key)
+        if cached is not None and "head3" in cached:
+            return cached["head3"]
+
+    body = fp.read_bytes()
+    body = body[body.find(b"\n") + 1:]  # header line
+    columns = _parse_columns(body, len(HEAD3_COLUMNS), HEAD3_OPTIONAL)
+    values = [_to_type(column, dtype) for column, (_, dtype) in zip(columns, HEAD3_COLUMNS)]
+    head3 = np.empty(len(values[0]), dtype=[(name, x.dtype) for (name, _), x in zip(HEAD3_COLUMNS, values)])
+    for (name, _), x in zip(HEAD3_COLUMNS, values):
+        head3[name] = x
+
+    if use_cache:
+        _write_sidecar(fp, key, {"head3": head3})
+    return head3
+
+
+def read_fort38(fp: Union[str, Path] = "fort.38", use_cache: bool = True) -> OccTable:
+    """Load fort.38, or another titration table with its layout such as entropy.out."""
+    fp = Path(fp)
+    key = _cache_key(fp)
+    if use_cache:
+        cached = _read_sidecar(fp, key)
+        if cached is not None and "occ" in cached:
+            return OccTable(str(cached["titr_type"]), cached["labels"], cached["points"],
+                            cached["confname"], cached["occ"])
+
+    body = fp.read_bytes()
+    header_end = body.find(b"\n") + 1
+    header = body[:header_end].decode().split()
+    labels = np.array(header[1:])
+    columns = _parse_columns(body[header_end:], len(header))
+    confname = _to_type(columns[0], str)
+    if len(header) > 1:
+        occ = np.column_stack([column.astype(np.float64) for column in columns[1:]])
+    else:
+        occ = np.zeros((len(confname), 0))
+    table = OccTable(header[0], labels, labels.astype(np.float64), confname, occ)
+
+    if use_cache:
+        _write_sidecar(fp, key, {"titr_type": np.array(table.titr_type), "labels": table.labels,
+                                 "points": table.points, "confname": table.confname, "occ": table.occ})
+    return table
+
+
+def head3_df(fp: Union[str, Path] = "head3.lst", use_cache: bool = True):
+    """head3.lst as a pandas.DataFrame with the columns of the file header and "m"."""
+    import pandas as pd
+
+    return pd.DataFrame(read_head3(fp, use_cache=use_cache))
+
+
+def fort38_df(fp: Union[str, Path] = "fort.38", use_cache: bool = True):
+    """fort.38 as a pandas.DataFrame: the conformer names, then one column per titration point
+    named as in the file header."""
+    import pandas as pd
+
+    table = read_fort38(fp, use_cache=use_cache)
+    df = pd.DataFrame(table.occ, columns=list(table.labels))
+    df.insert(0, table.titr_type, table.confname.astype(object))
+    return df
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+
+"""
+Module: ftpl_cache.py
+
+Compiled, cached parameter records for the ftpl loaders.
+
+Every MCCE step re-reads the ~80 parameter files of the ftpl folder. This module
+parses the folder once into flat (key1, key2, key3, value) string records and keeps
+them in a single columnar .npz file (no pickle). The loaders then build their own
+parameter objects from these records:
+  * mcce4.pdbio.TPL.read_ftpl_folder
+  * bin/pdbio_gr.py ENV.load_ftpl (step3)
+
+The cache is keyed by a fingerprint of the source files (name, size, mtime) and
+by a hash of their contents; it is rebuilt automatically when any source changes.
+
+Only the shared parameter folder is cached. The per-run parameter files of a working
+directory (user_param/*.ftpl, new.tpl and the EXTRA file of run.prm) are still read
+and parsed from source by the loaders on every run: they are small, and caching them
+would add a cache file per run directory.
+
+Environment variable:
+  MCCE_FTPL_CACHE: Folder holding the cache files (default: ~/.cache/mcce4);
+                   set it to "none" to disable the cache.
+"""
+
+import glob
+import hashlib
+import logging
+import os
+import tempfile
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_VERSION = "1"
+ALWAYS_NEEDED_TPL = "00always_needed.tpl"
+CACHE_ENV = "MCCE_FTPL_CACHE"
+RECORD_COLUMNS = ["key1", "key2", "key3", "value"]
+
+
+def ftpl_records(fname: str) -> List[Tuple[str, str, str, str]]:
+    """Parse a ftpl file into (key1, key2, key3, value) records, in file order."""
+    records = []
+    with open(fname) as fh:
+        for line in fh:
+            end = line.find("#")
+            line = line[:end]
+            fields = line.split(":")
+            if len(fields) != 2:
+                continue
+
+            keys = fields[0].strip().split(",")
+            key1 = keys[0].strip().strip('"')
+            key2 = keys[1].strip().strip('"') if len(keys) > 1 else ""
+            # No add'l strip() after stripping quotes to preserve atom names with spaces
+            key3 = keys[2].strip().strip('"') if len(keys) > 2 else ""
+            records.append((key1, key2, key3, fields[1].strip()))
+
+    return records
+
+
+def tpl_records(fname: str) -> List[Tuple[str, str, str, str]]:
+    """Parse a fixed column (old style) tpl file into (key1, key2, key3, value) records.
+    Only the lines carrying a value field are kept; the value is the text after column 20.
+    """
+    records = []
+    with open(fname) as fh:
+        for line in fh:
+            end = line.find("#")
+            line = line[:end].strip()
+            if len(line) < 20:
+                continue
+            records.append((line[:9].strip(), line[9:15].strip(), line[15:19], line[20:]))
+
+    return records
+
+
+def param_sources(folder: str) -> List[str]:
+    """Source files of a parameter folder: sorted *.ftpl files, then 00always_needed.tpl if present."""
+    files = sorted(glob.glob(os.path.join(folder, "*.ftpl")))
+    always_needed = os.path.join(folder, ALWAYS_NEEDED_TPL)
+    if os.path.isfile(always_needed):
+        files.append(always_needed)
+    return files
+
+
+def _fingerprint(files: List[str]) -> str:
+    """Cheap key of the source files from their names, sizes and modification times."""
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    for fname in files:
+        st = os.stat(fname)
+        h.update(("%s|%d|%d\n" % (os.path.basename(fname), st.st_size, st.st_mtime_ns)).encode())
+    return h.hexdigest()
+
+
+def _digest(files: List[str]) -> str:
+    """Hash of the source file names and contents."""
+    h = hashlib.sha1(CACHE_VERSION.encode())
+    for fname in files:
+        h.update(os.path.basename(fname).encode())
+        with open(fname, "rb") as fh:
+            h.update(fh.read())
+    return h.hexdigest()
+
+
+def _cache_path(folder: str) -> str:
+    """Cache file of a parameter folder, or an empty string if the cache is disabled."""
+    cache_dir = os.environ.get(CACHE_ENV, os.path.join(os.path.expanduser("~"), ".cache", "mcce4"))
+    if not cache_dir or cache_dir.lower() == "none":
+        return ""
+    folder_key = hashlib.sha1(os.path.abspath(folder).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, "ftpl_%s.npz" % folder_key)
+
+
+def _parse_sources(files: List[str]) -> Dict[str, List[Tuple[str, str, str, str]]]:
+    records = {}
+    for fname in files:
+        if fname.endswith(".ftpl"):
+            records[os.path.basename(fname)] = ftpl_records(fname)
+        else:
+            records[os.path.basename(fname)] = tpl_records(fname)
+    return records
+
+
+def _pack_strings(strings: List[str]) -> np.ndarray:
+    """Store a string column as one newline separated utf-8 byte buffer."""
+    return np.frombuffer("\n".join(strings).encode(), dtype=np.uint8)
+
+
+def _unpack_strings(buffer: np.ndarray, n: int) -> List[str]:
+    """Inverse of _pack_strings() for a column of n strings."""
+    if n == 0:
+        return []
+    return buffer.tobytes().decode().split("\n")
+
+
+def _read_cache(cache_file: str):
+    """Return (fingerprint, digest, records) stored in cache_file, or None if unreadable."""
+    try:
+        with np.load(cache_file, allow_pickle=False) as data:
+            if str(data["version"]) != CACHE_VERSION:
+                return None
+            file_index = data["file_index"].tolist()
+            files = _unpack_strings(data["files"], int(data["n_files"]))
+            columns = [_unpack_strings(data[c], len(file_index)) for c in RECORD_COLUMNS]
+            fingerprint = str(data["fingerprint"])
+            digest = str(data["digest"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+    records = {f: [] for f in files}
+    for i_file, record in zip(file_index, zip(*columns)):
+        records[files[i_file]].append(record)
+    return fingerprint, digest, records
+
+
+def _write_cache(cache_file: str, fingerprint: str, digest: str, records) -> None:
+    files = list(records.keys())
+    file_index = []
+    columns = [[] for _ in RECORD_COLUMNS]
+    for i_file, fname in enumerate(files):
+        for record in records[fname]:
+            file_index.append(i_file)
+            for column, field in zip(columns, record):
+                column.append(field)
+
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(suffix=".npz", dir=os.path.dirname(cache_file))
+        with os.fdopen(fd, "wb") as fh:
+            np.savez(fh,
+                     version=np.array(CACHE_VERSION),
+                     fingerprint=np.array(fingerprint),
+                     digest=np.array(digest),
+                     n_files=np.array(len(files)),
+                     files=_pack_strings(files),
+                     file_index=np.array(file_index, dtype=np.int32),
+                     **{c: _pack_strings(v) for c, v in zip(RECORD_COLUMNS, columns)})
+        os.replace(tmp_name, cache_file)   # atomic, concurrent p_batch jobs never see a partial file
+    except OSError as e:
+        logger.debug("Could not write ftpl cache %s: %s" % (cache_file, e))
+
+
+def load_param_records(folder: str) -> Dict[str, List[Tuple[str, str, str, str]]]:
+    """Return the records of all source files of a parameter folder, keyed by file name in load order.
+
+    *.ftpl files are parsed by ftpl_records() and 00always_needed.tpl by tpl_records().
+    The records come from the compiled cache when it matches the sources; otherwise the
+    sources are parsed and the cache is rebuilt. Use it for the shared parameter folder,
+    not for the user_param folder of a run, see the module docstring.
+    """
+    files = param_sources(folder)
+    cache_file = _cache_path(folder)
+    if not cache_file:
+        return _parse_sources(files)
+
+    fingerprint = _fingerprint(files)
+    cached = _read_cache(cache_file) if os.path.isfile(cache_file) else None
+    if cached is not None:
+        cached_fingerprint, cached_digest, records = cached
+        if cached_fingerprint == fingerprint:
+            return records
+        # Touched but possibly unchanged files: compare the contents
+        digest = _digest(files)
+        if cached_digest == digest:
+            _write_cache(cache_file, fingerprint, digest, records)
+            return records
+    else:
+        digest = _digest(files)
+
+    logger.info("Compiling parameter cache for %s" % os.path.abspath(folder))
+    records = _parse_sources(files)
+    _write_cache(cache_file, fingerprint, digest, records)
+    return records
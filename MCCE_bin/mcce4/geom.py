@@ -146,6 +146,47 @@ class OPERATION:
         v3 = v2[:-1]
         return v3.T[0]
 
+    def apply_array(self, xyz):
+        "Apply the operation to a block of points, (N, 3) array in, (N, 3) array out"
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        return np.matmul(xyz, self.operation[:3, :3].T) + self.operation[:3, 3]
+
+
+def rotation_matrices(v, COS, SIN):
+    """Rotation matrices about unit vectors v (n, 3) by the angles of cosines COS and sines SIN, scalars or (n),
+    as in OPERATION.roll(), as an (n, 3, 3) array."""
+    x, y, z = v[:, 0], v[:, 1], v[:, 2]
+    C = 1 - COS
+    return np.stack((np.stack((x*x*C + COS, x*y*C - z*SIN, x*z*C + y*SIN), axis=1),
+                     np.stack((x*y*C + z*SIN, y*y*C + COS, y*z*C - x*SIN), axis=1),
+                     np.stack((x*z*C - y*SIN, y*z*C + x*SIN, z*z*C + COS), axis=1)), axis=1)
+
+
+def roll_operations(phis, axis):
+    """Operations of roll(phi, axis) on a reset OPERATION for every angle in phis, as a (K, 4, 4) array."""
+    phis = np.asarray(phis, dtype=float).reshape(-1)
+    operations = np.tile(np.eye(4), (len(phis), 1, 1))
+
+    # validate the axis
+    v = np.copy(axis.t)
+    if np.linalg.norm(v) > 0.0000001:  # validate direction cosines
+        v = v / np.linalg.norm(v)
+        rotate = rotation_matrices(np.tile(v, (len(phis), 1)), np.cos(phis), np.sin(phis))
+
+        # translate to origin, rotate, and translate back
+        p0 = np.asarray(axis.p0, dtype=float)
+        operations[:, :3, :3] = rotate
+        operations[:, :3, 3] = p0 - np.matmul(rotate, p0)
+
+    return operations
+
+
+def apply_operations(operations, xyz):
+    "Apply K operations (K, 4, 4) to the same block of points (N, 3), return a (K, N, 3) array"
+    operations = np.asarray(operations, dtype=float).reshape(-1, 4, 4)
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    return np.matmul(xyz, operations[:, :3, :3].transpose(0, 2, 1)) + operations[:, np.newaxis, :3, 3]
+
 
 # def geom_apply(operation, v):
 #     v1 = np.append(np.array(v), 1)[np.newaxis].transpose()
@@ -7,6 +7,8 @@ Provides these helper functions:
 
   * `mcfile2df`: Loads mcce output files into pandas.DataFrames.
     Numerical columns are floats or integers;
+    Files head3.lst and fort.38 are loaded by mcce4.conftables, which keeps a
+    binary sidecar of the parsed file (e.g. head3.lst.npz) for the next load;
     File pK.out df gets an extra 'note' column that retains the out-of-bound
     or bad curve info from the original 'pKa/Em' column, which now holds
     float values or null for out-of-bound.
@@ -48,6 +50,8 @@ from typing import Callable, List, Tuple, Union
 import pandas as pd
 from pandas.api.types import is_object_dtype
 
+from mcce4.conftables import fort38_df, head3_df
+
 
 logging.basicConfig(format="[ %(levelname)s ] %(funcName)s:\n  %(message)s")
 logger = logging.getLogger(__name__)
@@ -390,6 +394,14 @@ class ToDf:
             logger.error(mf("File {!r} cannot be loaded into a pandas.DataFrame.", which))
             return None
 
+        if fname == "head3.lst":
+            df = head3_df(fp)
+            df["iConf"] = df["iConf"].map("{:05d}".format)
+            df["m"] = df["m"].replace("", float("nan"))  # files without the mark column
+            return df
+        if which == "fort.38":
+            return fort38_df(fp)
+
         df = pd.read_csv(fp, sep=r"\s+")  # noqa: W605
         if fname not in ToDf.headers_dict:
             if (fname in ["pK.out", "all_pK.out"]) or which == "pK.out":
@@ -26,20 +26,15 @@ def center_protein(self):
     op = OPERATION()
     op.move((-c[0], -c[1], -c[2]))
 
-    # dynamic flag _applied
+    # atom is a reference, as atom may be shared by conformers, so we need to check this
+    applied = set()
+    unique_atoms = []
     for atom in atoms:
-        atom._applied = False
-
-    for atom in atoms:
-        if not atom._applied:  
-            # atom is a reference, as atom may be shared by conformers, so we need to check this
-            atom.xyz = op.apply(atom.xyz)
-            atom._applied = True
-
-    # clean up
-    for atom in atoms:
-        if hasattr(atom, "_applied"):
-            del atom._applied
+        if id(atom) not in applied:
+            unique_atoms.append(atom)
+            applied.add(id(atom))
+    for atom, xyz in zip(unique_atoms, op.apply_array([atom.xyz for atom in unique_atoms])):
+        atom.xyz = xyz
 
 
     return
\ No newline at end of file
@@ -59,6 +59,7 @@ def hbond_h(self):
 
 
     # make 12 connectivity of atoms in conformer
+    bond_templates = {}  # confType: {atom name: set of atom names connected to it in tpl file}
     for res in self.protein.residue:
         for conf in res.conf:
             atoms_inconf = conf.atom
@@ -68,18 +69,20 @@ def hbond_h(self):
                 a.conn12 = []
             conf.parent_res = res
 
-            # decide 12 connectivity
+            # decide 12 connectivity, only atom pairs bonded in tpl file are measured
+            template = bond_templates.setdefault(conf.confType, {})
             for i in range(len(atoms_inconf)-1):
-                for j in range(i+1, len(atoms_inconf)):
-                    atom1 = atoms_inconf[i]
+                atom1 = atoms_inconf[i]
+                if atom1.name not in template:
+                    connect_param = self.tpl.db.get(("CONNECT", atom1.name, conf.confType))
+                    template[atom1.name] = set(connect_param.connected) if connect_param else set()  # no CONNECT record, no bond
+                connected = template[atom1.name]
+                bonded = [j for j in range(i+1, len(atoms_inconf)) if atoms_inconf[j].name in connected]
+                for j in bonded:
                     atom2 = atoms_inconf[j]
                     if dvv(atom1.xyz, atom2.xyz) < 2.0:
-                        # check if these two atoms are connected in tpl file
-                        if atom2.name in self.tpl.db[("CONNECT", atom1.name, conf.confType)].connected:
-                            atom1.conn12.append(atom2)
-                            atom2.conn12.append(atom1)
-
-    
+                        atom1.conn12.append(atom2)
+                        atom2.conn12.append(atom1)
 
     # collect a list of donor/acceptor pairs based on charge and distance. This list is atom based.
     all_conformers = []
@@ -97,11 +100,31 @@ def hbond_h(self):
                 atom.parent_conf = conf
                 all_donors_acceptors.append(atom)
     
+    # Put donors/acceptors in DFAR boxes, so that only atoms within neighboring boxes are paired
+    xyz = np.array([atom.xyz for atom in all_donors_acceptors], dtype=float).reshape(-1, 3)
+    atom_boxes = np.floor(xyz / DFAR).astype(int)
+    boxes = {}
+    for i, ibox in enumerate(map(tuple, atom_boxes)):
+        if ibox in boxes:
+            boxes[ibox].append(i)
+        else:
+            boxes[ibox] = [i]
+
     # Pick two atoms as potential hydrogen bond donors and acceptors
     cos_theta = math.cos(math.radians(bond_angle_sp3))
     sin_theta = math.sin(math.radians(bond_angle_sp3))
-    for donor in all_donors_acceptors:
-        for acceptor in all_donors_acceptors:
+    for i_donor, donor in enumerate(all_donors_acceptors):
+        ix, iy, iz = atom_boxes[i_donor]
+        neighbors = []
+        for ibox in [(x, y, z) for x in (ix-1, ix, ix+1) for y in (iy-1, iy, iy+1) for z in (iz-1, iz, iz+1)]:
+            if ibox in boxes:
+                neighbors += boxes[ibox]
+        neighbors = np.sort(neighbors)
+        # distance screen of all neighbors at once, with a margin so that dvv() below makes the final call
+        d = np.sqrt(((xyz[neighbors] - xyz[i_donor])**2).sum(axis=1))
+        in_range = neighbors[(d > DNEAR - 0.001) & (d < DFAR + 0.001)]
+        for i_acceptor in in_range:
+            acceptor = all_donors_acceptors[i_acceptor]
             if donor.parent_conf.parent_res != acceptor.parent_conf.parent_res:
                 distance = dvv(donor.xyz, acceptor.xyz)  # within 2.0-4.0A h bond distance
                 if DNEAR < distance < DFAR:
@@ -117,9 +140,7 @@ def hbond_h(self):
                             # match atom by name
                             cloned_atom_by_name = {}
                             for a in new_conf.atom:
-                                for b in donor.parent_conf.atom:
-                                    if a.name == b.name:
-                                        cloned_atom_by_name[a.name] = a
+                                cloned_atom_by_name[a.name] = a
 
                             if len(connected_heavy_atoms) == 1:
                                 # sp3_1known
@@ -102,13 +102,14 @@ def place_missing_heavy(self):
                             # print(c_atom_p, m1_atom_p, m2_atom_p)
                             # print(c_atom_t, m1_atom_t, m2_atom_t)
                             op = geom_3v_onto_3v(c_atom_t, m1_atom_t, m2_atom_t, c_atom_p, m1_atom_p, m2_atom_p)  # align template to known atoms
-                            for atom_name in list(missing_heavy):
-                                t_atom_xyz = templates[resName][atom_name]
+                            missing_names = list(missing_heavy)
+                            missing_xyz = op.apply_array([templates[resName][atom_name] for atom_name in missing_names])
+                            for atom_name, new_xyz in zip(missing_names, missing_xyz):
                                 # create a new atom                                
                                 new_atom = Atom()                                
                                 new_atom.inherit(atom)
                                 new_atom.name = atom_name
-                                new_atom.xyz = op.apply(t_atom_xyz)
+                                new_atom.xyz = new_xyz
                                 # decide to add this atom
                                 conf_atom_names = [x.name for x in conf.atom ]
                                 if new_atom.name not in conf_atom_names:
@@ -135,13 +136,14 @@ def place_missing_heavy(self):
                                     m2_atom_p = a.xyz
                                     m2_atom_t = templates[resName][a.name]
                                     op = geom_3v_onto_3v(c_atom_t, m1_atom_t, m2_atom_t, c_atom_p, m1_atom_p, m2_atom_p)  # align template to known atoms
-                                    for atom_name in list(missing_heavy):
-                                        t_atom_xyz = templates[resName][atom_name]
+                                    missing_names = list(missing_heavy)
+                                    missing_xyz = op.apply_array([templates[resName][atom_name] for atom_name in missing_names])
+                                    for atom_name, new_xyz in zip(missing_names, missing_xyz):
                                         # create a new atom                                
                                         new_atom = Atom()                                
                                         new_atom.inherit(atom)
                                         new_atom.name = atom_name
-                                        new_atom.xyz = op.apply(t_atom_xyz)
+                                        new_atom.xyz = new_xyz
                                         # decide to add this atom
                                         conf_atom_names = [x.name for x in conf.atom ]
                                         if new_atom.name not in conf_atom_names:
@@ -1,5 +1,7 @@
 import sys
+import time
 import numpy as np
+from scipy.spatial import cKDTree
 from ..pdbio import *
 from ..geom import *
 from ._vdw import vdw_conf
@@ -16,115 +18,146 @@ class HBOND_ELEMENT:    # one Hbond screen candidate is a pair of atom and the c
         self.conf = conf
         self.res = res
 
-def look_for_hbond(self, c1, c2):
+class SWING_GEOMETRY:
+    """Rotation axes of swing() resolved once for a conformer, so that all swing variants of the
+    conformer and of its swung copies can be computed as arrays, without making conformers.
+    """
+    def __init__(self, mcce, conf):
+        self.conf = conf
+        self.names = [atom.name for atom in conf.atom]
+        index = {name: i for i, name in enumerate(self.names)}
+        self.xyz = np.array([atom.xyz for atom in conf.atom], dtype=float)
+        # each axis: (index of atom1 in conf or -1, xyz of atom1, index of atom2 in conf, indices of the atoms it moves)
+        self.axes = []
+        key = ("ROTATE", conf.resID[0])
+        if key in mcce.tpl.db:
+            for each_axis in mcce.tpl.db[key]:
+                # same atom search as swing()
+                atom2 = None
+                for atom in conf.atom:
+                    if atom.name == each_axis[1]:
+                        atom2 = atom
+                        break
+                if atom2 is None:
+                    print("Atom %s in ROTATE record %s %s was not found in this residue %s" % (each_axis[1], key, each_axis, conf.resID))
+                    sys.exit()
+                atom1 = None
+                for atom in atom2.connect12:
+                    if atom.name == each_axis[0]:
+                        atom1 = atom
+                        break
+                if atom1 is None:
+                    print("Atom %s in ROTATE record %s %s was not found in this residue %s" % (each_axis[0], key, each_axis, conf.resID))
+                    sys.exit()
+
+                affected_atoms = []
+                for atom in atom2.connect12:
+                    if atom != atom1 and not is_H(atom.name):
+                        affected_atoms.append(atom)
+                for a_atom in affected_atoms:
+                    for atom in a_atom.connect12:
+                        if atom != atom1 and \
+                            atom != atom2 and \
+                            not is_H(atom.name) and \
+                            not atom in affected_atoms and \
+                            atom.resID == atom2.resID:
+                            affected_atoms.append(atom)
+
+                i1 = index[atom1.name] if atom1 in conf.atom else -1
+                moved = np.array([index[atom.name] for atom in affected_atoms if atom.name in index], dtype=int)
+                self.axes.append((i1, np.array(atom1.xyz, dtype=float), index[atom2.name], moved))
+
+    def swing(self, xyz, phi):
+        """Atom coordinates of the variants swing() makes from a conformer with coordinates xyz,
+        as an (n_variants, n_atoms, 3) array in the order of the returned conformers.
+        """
+        variants = xyz[np.newaxis]
+        COS = np.cos(phi)
+        SIN = np.sin(phi)
+        for i1, xyz1, i2, moved in self.axes:
+            n = len(variants)
+            p0 = variants[:, i1] if i1 >= 0 else np.broadcast_to(xyz1, (n, 3))
+            v = variants[:, i2] - p0
+            norm = np.linalg.norm(v, axis=1)
+            valid = norm > 0.0000001
+            v[valid] /= norm[valid, np.newaxis]
+            new = np.repeat(variants, 2, axis=0)   # variant k rotated by -phi, then by +phi
+            for sign, offset in ((-1.0, 0), (1.0, 1)):
+                rotation = rotation_matrices(v, COS, sign * SIN)
+                rotation[~valid] = np.eye(3)
+                shift = p0[:, np.newaxis, :]
+                new[offset::2][:, moved] = np.matmul(variants[:, moved] - shift, rotation.transpose(0, 2, 1)) + shift
+            variants = np.concatenate((variants, new))
+        return variants[1:]
+
+    def make_conf(self, xyz):
+        """A swung copy of the conformer with coordinates xyz."""
+        new_conf = self.conf.clone()
+        new_conf.history = self.conf.history[:2] + "R" + self.conf.history[3:]
+        for atom, atom_xyz in zip(new_conf.atom, xyz):
+            atom.xyz = tuple(atom_xyz)
+        return new_conf
+
+
+def look_for_hbond(self, c1, c2, geometry):
     """ Based on candidates c1 and c2, find optimized conformers.
+    geometry maps a conformer to its SWING_GEOMETRY, made here when a conformer is first swung.
     """
     base_pair = (c1, c2)  # optimized pair
     d2 = ddvv(c1.atom.xyz, c2.atom.xyz)
     base_doff = abs(d2 - Hbond_distance_end2)
 
     if c1.conf != c2.conf and d2 < Hbond_distance_ini2: # atoms in the same conf or too far will be ignored
-        #print("optimizing ", c1.conf.confID, c2.conf.confID, end=" ")
-        improved = True
-        phi = 60/180*np.pi
-        while improved:
-            improved = False
-            new1_confs = self.swing(base_pair[0].conf, phi)
-            new2_confs = self.swing(base_pair[1].conf, phi)
-            for conf1 in new1_confs+[base_pair[0].conf]:
-                atom1 = None
-                for atom in conf1.atom:
-                    if c1.atom.name == atom.name:
-                        atom1 = atom
-                        break
-                for conf2 in new2_confs+[base_pair[1].conf]:
-                    atom2 = None
-                    for atom in conf2.atom:
-                        if c2.atom.name == atom.name:
-                            atom2 = atom
-                            break
-                    if atom1 and atom2:
-                        d2 = ddvv(atom1.xyz, atom2.xyz)
-                        if abs(d2 - Hbond_distance_end2) < base_doff:
-                            base_doff = abs(d2 - Hbond_distance_end2)
-                            base_pair = (HBOND_ELEMENT(atom1, conf1, c1.res), HBOND_ELEMENT(atom2, conf2, c2.res))
-                            improved = True
-
-        improved = True
-        phi = 15/180*np.pi
-        while improved:
-            improved = False
-            new1_confs = self.swing(base_pair[0].conf, phi)
-            new2_confs = self.swing(base_pair[1].conf, phi)
-            for conf1 in new1_confs+[base_pair[0].conf]:
-                atom1 = None
-                for atom in conf1.atom:
-                    if c1.atom.name == atom.name:
-                        atom1 = atom
-                        break
-                for conf2 in new2_confs+[base_pair[1].conf]:
-                    atom2 = None
-                    for atom in conf2.atom:
-                        if c2.atom.name == atom.name:
-                            atom2 = atom
-                            break
-                    if atom1 and atom2:
-                        d2 = ddvv(atom1.xyz, atom2.xyz)
-                        if abs(d2 - Hbond_distance_end2) < base_doff:
-                            base_doff = abs(d2 - Hbond_distance_end2)
-                            base_pair = (HBOND_ELEMENT(atom1, conf1, c1.res), HBOND_ELEMENT(atom2, conf2, c2.res))
-                            improved = True
-
-        improved = True
-        phi = 3/180*np.pi
-        while improved:
-            improved = False
-            new1_confs = self.swing(base_pair[0].conf, phi)
-            new2_confs = self.swing(base_pair[1].conf, phi)
-            for conf1 in new1_confs+[base_pair[0].conf]:
-                atom1 = None
-                for atom in conf1.atom:
-                    if c1.atom.name == atom.name:
-                        atom1 = atom
-                        break
-                for conf2 in new2_confs+[base_pair[1].conf]:
-                    atom2 = None
-                    for atom in conf2.atom:
-                        if c2.atom.name == atom.name:
-                            atom2 = atom
-                            break
-                    if atom1 and atom2:
-                        d2 = ddvv(atom1.xyz, atom2.xyz)
-                        if abs(d2 - Hbond_distance_end2) < base_doff:
-                            base_doff = abs(d2 - Hbond_distance_end2)
-                            base_pair = (HBOND_ELEMENT(atom1, conf1, c1.res), HBOND_ELEMENT(atom2, conf2, c2.res))
-                            improved = True
-
-        improved = True
-        phi = 1/180*np.pi
-        while improved:
-            improved = False
-            new1_confs = self.swing(base_pair[0].conf, phi)
-            new2_confs = self.swing(base_pair[1].conf, phi)
-            for conf1 in new1_confs+[base_pair[0].conf]:
-                atom1 = None
-                for atom in conf1.atom:
-                    if c1.atom.name == atom.name:
-                        atom1 = atom
-                        break
-                for conf2 in new2_confs+[base_pair[1].conf]:
-                    atom2 = None
-                    for atom in conf2.atom:
-                        if c2.atom.name == atom.name:
-                            atom2 = atom
-                            break
-                    if atom1 and atom2:
-                        d2 = ddvv(atom1.xyz, atom2.xyz)
-                        if abs(d2 - Hbond_distance_end2) < base_doff:
-                            base_doff = abs(d2 - Hbond_distance_end2)
-                            base_pair = (HBOND_ELEMENT(atom1, conf1, c1.res), HBOND_ELEMENT(atom2, conf2, c2.res))
-                            improved = True
+        for conf in (c1.conf, c2.conf):
+            if conf not in geometry:
+                geometry[conf] = SWING_GEOMETRY(self, conf)
+        geom1 = geometry[c1.conf]
+        geom2 = geometry[c2.conf]
+        k1 = geom1.names.index(c1.atom.name)
+        k2 = geom2.names.index(c2.atom.name)
+        xyz1 = geom1.xyz   # coordinates of the current base conformers
+        xyz2 = geom2.xyz
+        moved1 = moved2 = False
+        for phi in (60/180*np.pi, 15/180*np.pi, 3/180*np.pi, 1/180*np.pi):
+            improved = True
+            while improved:
+                improved = False
+                # swung variants first, then the base conformer, as in the original search order
+                variants1 = np.concatenate((geom1.swing(xyz1, phi), xyz1[np.newaxis]))
+                variants2 = np.concatenate((geom2.swing(xyz2, phi), xyz2[np.newaxis]))
+                d2 = ((variants1[:, k1, np.newaxis, :] - variants2[np.newaxis, :, k2, :])**2).sum(axis=2)
+                doff = np.abs(d2 - Hbond_distance_end2)
+                # Scan rows as the original loops did: the last entry of each row is the best
+                # second conformer found so far in this round, the base conformer at first.
+                n2 = len(variants2) - 1
+                i_best = len(variants1) - 1
+                j_best = n2
+                for i in range(len(variants1)):
+                    row = np.append(doff[i, :n2], doff[i, j_best])
+                    k = np.argmin(row)
+                    if row[k] < base_doff:
+                        base_doff = row[k]
+                        i_best = i
+                        j_best = k if k < n2 else j_best
+                        improved = True
+                if improved:
+                    if i_best < len(variants1) - 1:
+                        xyz1 = variants1[i_best]
+                        moved1 = True
+                    if j_best < n2:
+                        xyz2 = variants2[j_best]
+                        moved2 = True
 
+        if moved1 or moved2:
+            base_pair = (HBOND_ELEMENT(c1.atom, c1.conf, c1.res), HBOND_ELEMENT(c2.atom, c2.conf, c2.res))
+            if moved1:
+                conf = geom1.make_conf(xyz1)
+                base_pair[0].conf = conf
+                base_pair[0].atom = conf.atom[k1]
+            if moved2:
+                conf = geom2.make_conf(xyz2)
+                base_pair[1].conf = conf
+                base_pair[1].atom = conf.atom[k2]
 
     if base_doff > 3.25 or base_pair == (c1, c2):  # do not return anything if the atoms are beyond H bond distance (3.5*3.5 - 3*3)
         return None
@@ -152,20 +185,25 @@ def rot_hdirected(self):
                     Hbond_candidates.append(candidate)
 
     logging.info("   Found %d potential hydrogen bond donors and acceptors" % len(Hbond_candidates))
-    # go over all pairs to optimize each pair
-    for ie1 in range(len(Hbond_candidates)-1):
+    # go over the pairs within the initial distance to optimize each pair
+    start_time = time.time()
+    geometry = {}
+    pairs = []
+    if len(Hbond_candidates) > 1:
+        tree = cKDTree([candidate.atom.xyz for candidate in Hbond_candidates])
+        pairs = sorted(tree.query_pairs(np.sqrt(Hbond_distance_ini2)))
+    for ie1, ie2 in pairs:
         candidate1 = Hbond_candidates[ie1]
-        for ie2 in range(ie1+1, len(Hbond_candidates)):
-            candidate2 = Hbond_candidates[ie2]
-            optimized_confs = look_for_hbond(self, candidate1, candidate2)
-            if optimized_confs:
-                new_candidate1 = optimized_confs[0]
-                if new_candidate1.atom != candidate1.atom:
-                    new_candidate1.conf.history = new_candidate1.conf.history[:2] + "H" + new_candidate1.conf.history[3:]
-                    new_candidate1.res.conf.append(new_candidate1.conf)
-                new_candidate2 = optimized_confs[1]
-                if new_candidate2.atom != candidate2.atom:
-                    new_candidate2.conf.history = new_candidate2.conf.history[:2] + "H" + new_candidate2.conf.history[3:]
-                    new_candidate2.res.conf.append(new_candidate2.conf)
-
-                
+        candidate2 = Hbond_candidates[ie2]
+        optimized_confs = look_for_hbond(self, candidate1, candidate2, geometry)
+        if optimized_confs:
+            new_candidate1 = optimized_confs[0]
+            if new_candidate1.atom != candidate1.atom:
+                new_candidate1.conf.history = new_candidate1.conf.history[:2] + "H" + new_candidate1.conf.history[3:]
+                new_candidate1.res.conf.append(new_candidate1.conf)
+            new_candidate2 = optimized_confs[1]
+            if new_candidate2.atom != candidate2.atom:
+                new_candidate2.conf.history = new_candidate2.conf.history[:2] + "H" + new_candidate2.conf.history[3:]
+                new_candidate2.res.conf.append(new_candidate2.conf)
+
+    logging.info("   Optimized %d candidate pairs in %.2f seconds" % (len(pairs), time.time() - start_time))
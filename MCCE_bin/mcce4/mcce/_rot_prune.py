@@ -45,6 +45,34 @@ def rmsd_conf(conf1, conf2):
     return rmsd
 
 
+def conf_coordinates(confs):
+    """Coordinates of the conformers as an (n_confs, n_atoms, 3) array, atoms in the order of the first conformer.
+    Atoms are matched by name as in rmsd_conf().
+    """
+    names = [atom.name for atom in confs[0].atom]
+    coords = np.zeros((len(confs), len(names), 3))
+    for i, conf in enumerate(confs):
+        if len(conf.atom) != len(names):
+            logging.error("Conformers have different number of atoms. %s vs %s" % (confs[0].confID, conf.confID))
+            sys.exit()
+        xyz = {}
+        for atom in conf.atom:
+            xyz.setdefault(atom.name, atom.xyz)   # the first atom of a name is matched
+        for k, name in enumerate(names):
+            if name not in xyz:
+                logging.error("Not all atoms matched between conformers %s and %s" % (confs[0].confID, conf.confID))
+                sys.exit()
+            coords[i, k] = xyz[name]
+    return coords
+
+
+def rmsd_matrix(confs):
+    """Condensed matrix of the pairwise rmsd_conf() values, as used by scipy linkage."""
+    coords = conf_coordinates(confs)
+    n_atoms = coords.shape[1]
+    return np.sqrt(ssd.pdist(coords.reshape(len(confs), -1), "sqeuclidean") / n_atoms)
+
+
 def prune_conf(self):
     """Prune conformers based on the number of conformers allowed for a residue.
     """
@@ -111,31 +139,21 @@ def prune_conf(self):
             confs = confs_grouped[t]
             logging.debug("%s, %s" % (t, [conf.confID for conf in confs]))
             if len(confs) > 1:
-                # 1. Generate the distance matrix
-                n_confs = len(confs)
-                d = np.zeros((n_confs, n_confs))
-                for i in range(n_confs):
-                    for j in range(i+1, n_confs):
-                        d[i][j] = rmsd_conf(confs[i], confs[j]) 
-                        d[j][i] = d[i][j]
+                # 1. Generate the condensed distance matrix
+                d = rmsd_matrix(confs)
                 
                 # 2. Perform hierarchical clustering
-                linkage_matrix = sch.linkage(ssd.squareform(d), method="average")
+                linkage_matrix = sch.linkage(d, method="average")
                 
                 # 3. Find the representative structure of each cluster
                 clusters = sch.fcluster(linkage_matrix, t=prune_rmsd, criterion="distance")
+                d = ssd.squareform(d)
                 for cluster in set(clusters):
-                    cluster_indices = [i for i, x in enumerate(clusters) if x == cluster]
-                    logging.debug(str(cluster_indices))    # the indices of conformers in the group, not the cluster
-                    # Find the center of the cluster
-                    cluster_confs = [confs[i] for i in cluster_indices]
-                    center_index = cluster_indices[0]
-                    min_rmsd_sum = float('inf')
-                    for i in cluster_indices:
-                        rmsd_sum = sum(rmsd_conf(confs[i], confs[j]) for j in cluster_indices)
-                        if rmsd_sum < min_rmsd_sum:
-                            min_rmsd_sum = rmsd_sum
-                            center_index = i
+                    cluster_indices = np.flatnonzero(clusters == cluster)
+                    logging.debug(str(cluster_indices.tolist()))    # the indices of conformers in the group, not the cluster
+                    # Find the center of the cluster, the conformer with the least rmsd sum to the others
+                    rmsd_sum = d[np.ix_(cluster_indices, cluster_indices)].sum(axis=1)
+                    center_index = cluster_indices[np.argmin(rmsd_sum)]
                     logging.debug("Center of cluster (keep): %s" % confs[center_index].confID)
                     confs_to_keep.append(confs[center_index])
             elif len(confs) == 1:
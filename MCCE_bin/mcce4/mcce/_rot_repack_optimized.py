@@ -3,6 +3,8 @@ from ._vdw import vdw_conf
 import random
 import time
 import logging
+import os
+from multiprocessing import Pool, RawArray
 from scipy.sparse import csr_matrix 
 
 Max_vdw_value = 999.0  # max possible vdw value allowed
@@ -21,19 +23,79 @@ Use_dirty_vdw = False
 # Dirty vdw: 72m31s at 20 cycles
 # Dirty vdw optimized:
 
-def vdw_total(conf, microstate, vdw_lookup_table, mcce):
-    vdw_backbone, vdw_pairwise = vdw_lookup_table
-    # backbone (vdw0+vdw1 included in the lookup table)
-    vdw = vdw_backbone[conf.i]
-    # sidechain of microstate
-    for ires in range(len(microstate)):
-        res = mcce.protein.residue[ires]
-        iconf = microstate[ires]
-        conf2 = res.conf[iconf]
+class VdwTable:
+    """
+    Sparse, symmetric conformer to conformer vdw table.
+    Only conformer pairs whose blobs overlap are stored. Rows can be queried per conformer,
+    or as a slice of rows for all side chain conformers of a residue.
+    """
+    def __init__(self, matrix, res_conf_start):
+        self.matrix = matrix   # csr_matrix with sorted column indices in each row
+        self.res_conf_start = res_conf_start   # side chain conformers of residue r: res_conf_start[r]:res_conf_start[r+1]
+
+    @classmethod
+    def from_pairs(cls, n_conf, rows, cols, values, res_conf_start):
+        """Make the table from the upper triangle entries (rows[k], cols[k]) = values[k]."""
+        rows = np.asarray(rows, dtype=np.int32)
+        cols = np.asarray(cols, dtype=np.int32)
+        values = np.asarray(values, dtype=float)
+        matrix = csr_matrix((np.concatenate((values, values)),
+                             (np.concatenate((rows, cols)), np.concatenate((cols, rows)))),
+                            shape=(n_conf, n_conf))
+        matrix.sum_duplicates()
+        return cls(matrix, res_conf_start)
+
+    def __getitem__(self, key):
+        i, j = key
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+        k = start + np.searchsorted(self.matrix.indices[start:end], j)
+        if k < end and self.matrix.indices[k] == j:
+            return self.matrix.data[k]
+        return 0.0
 
-        if conf.resID != res.resID and iconf != 0:
-            vdw += vdw_pairwise[(conf.i, conf2.i)]
-    return vdw
+    def row(self, i):
+        """Conformer indices and vdw values of the nonzero entries of row i."""
+        start, end = self.matrix.indptr[i], self.matrix.indptr[i + 1]
+        return self.matrix.indices[start:end], self.matrix.data[start:end]
+
+    def residue_rows(self, ires):
+        """Rows of the side chain conformers of residue ires, as a csr_matrix."""
+        return self.matrix[self.res_conf_start[ires]:self.res_conf_start[ires + 1]]
+
+    @property
+    def nbytes(self):
+        return self.matrix.data.nbytes + self.matrix.indices.nbytes + self.matrix.indptr.nbytes
+
+
+class PackedField:
+    """
+    Running vdw of every side chain conformer against the side chains of a packed microstate.
+    RepackProblem.vdw_total(i) = vdw_backbone[i] + field[i]; a residue changing its side chain
+    updates the field with two sparse rows of the pairwise table.
+    """
+    def __init__(self, vdw_pairwise, packed):
+        self.vdw_pairwise = vdw_pairwise
+        occupied = np.zeros(vdw_pairwise.matrix.shape[0])
+        occupied[packed] = 1.0
+        self.field = vdw_pairwise.matrix @ occupied
+
+    def move(self, i_old, i_new):
+        """Replace packed side chain conformer i_old by i_new."""
+        cols, values = self.vdw_pairwise.row(i_old)
+        self.field[cols] -= values
+        cols, values = self.vdw_pairwise.row(i_new)
+        self.field[cols] += values
+
+
+def blob_pairs(centers, radii, start, end):
+    """
+    Conformer pairs (i, j), start <= i < end <= j, whose blobs are within the vdw_conf()
+    screening distance.
+    """
+    d = np.sqrt(((centers[start:end, np.newaxis, :] - centers[np.newaxis, end:, :])**2).sum(axis=2))
+    near = d <= radii[start:end, np.newaxis] + 6 + radii[np.newaxis, end:] + 1.0e-6
+    i, j = np.nonzero(near)
+    return start + i, end + j
 
 
 def precalculate_vdw(self):
@@ -47,14 +109,17 @@ def precalculate_vdw(self):
     self.make_blob()
     # init conf serial number
     counter = 0
+    confs = []
+    res_conf_start = [0]
     for res in self.protein.residue:
         if len(res.conf) > 1:  # exclude backbone to save memory 
             for conf in res.conf[1:]:
                 conf.i = counter
                 counter += 1
+                confs.append(conf)
+        res_conf_start.append(counter)
 
     vdw_backbone = []
-    vdw_pairwise = csr_matrix((counter, counter), dtype=float).toarray()
     # backbone and internal
     backbone_confs = [res.conf[0] for res in self.protein.residue]
     for res in self.protein.residue:
@@ -65,20 +130,22 @@ def precalculate_vdw(self):
                     vdw_bk += vdw_conf(conf, conf2, dirty=Use_dirty_vdw)
                 vdw_backbone.append(vdw_bk)
 
-    # pairwise
-    n_res = len(self.protein.residue)
-    for ir1 in range(n_res - 1):
-        res1 = self.protein.residue[ir1]
-        if len(res1.conf) > 1:
-            for conf1 in res1.conf[1:]:
-                for ir2 in range(ir1+1, n_res):
-                    res2 = self.protein.residue[ir2]
-                    if len(res2.conf) > 1:
-                        for conf2 in res2.conf[1:]:
-                            vdw = vdw_conf(conf1, conf2, dirty=Use_dirty_vdw)
-                            if abs(vdw) > 0.00001:
-                                vdw_pairwise[conf1.i][conf2.i] = vdw
-                                vdw_pairwise[conf2.i][conf1.i] = vdw 
+    # pairwise, only for conformers with overlapping blobs
+    centers = np.array([conf.blob.center for conf in confs], dtype=float).reshape(-1, 3)
+    radii = np.array([conf.blob.radius for conf in confs], dtype=float)
+    rows = []
+    cols = []
+    values = []
+    for ir1 in range(len(self.protein.residue) - 1):
+        for i, j in zip(*blob_pairs(centers, radii, res_conf_start[ir1], res_conf_start[ir1 + 1])):
+            vdw = vdw_conf(confs[i], confs[j], dirty=Use_dirty_vdw)
+            if abs(vdw) > 0.00001:
+                rows.append(i)
+                cols.append(j)
+                values.append(vdw)
+    vdw_pairwise = VdwTable.from_pairs(counter, rows, cols, values, res_conf_start)
+    logging.info("   vdw pairwise table: %d of %d conformer pairs stored, %.1f MB (dense table: %.1f MB)" %
+                 (len(values), counter * (counter - 1) // 2, vdw_pairwise.nbytes / 1.0e6, 8.0e-6 * counter * counter))
 
     # check mutual equality, for debug only
     # print("Checking mutual equality of pairwise interaction")
@@ -99,64 +166,164 @@ def precalculate_vdw(self):
     return (vdw_backbone, vdw_pairwise)
 
 
-def rot_repack(self):
-    """ Repack rotamers to select low enegy rotamers
+class RepackProblem:
     """
-    # connect12 is inherited, clean_hvrot did connect 13 and 14 already, we do this just make sure
-    # current_time = time.time()
-    occ_cutoff = float(self.prm.REPACK_CUTOFF.value)
-    max_repacks = int(self.prm.REPACKS.value)
-
-    logging.info("   Prepare vdw energy lookup table. This may take a while...")
-    vdw_lookup_table = precalculate_vdw(self)
-    logging.info("   Done calculating vdw energy lookup table.")
-    
-    # print(time.time() - current_time)
-    random.seed(time.time())
+    Read-only data of the repack restarts as plain arrays, so that restarts can run in
+    worker processes without the protein:
+      vdw_backbone:           vdw0 + vdw1 of each side chain conformer
+      data, indices, indptr:  the pairwise VdwTable in csr form
+      res_conf_start:         side chain conformers of residue r are res_conf_start[r]:res_conf_start[r+1]
+      n_conf:                 number of conformers of each residue, backbone included
+    """
+    def __init__(self, arrays):
+        self.vdw_backbone = arrays["vdw_backbone"]
+        self.res_conf_start = arrays["res_conf_start"].tolist()
+        self.n_conf = arrays["n_conf"].tolist()
+        n = len(self.vdw_backbone)
+        matrix = csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape=(n, n), copy=False)
+        self.vdw_pairwise = VdwTable(matrix, self.res_conf_start)
 
-    converged_ms = []  # stats of converged microstates
+    def vdw_total(self, i, ires, microstate):
+        """Backbone vdw of side chain conformer i of residue ires plus its vdw with the other side chains of microstate."""
+        vdw = self.vdw_backbone[i]
+        for jres, jconf in enumerate(microstate):
+            if jres != ires and jconf != 0:
+                vdw += self.vdw_pairwise[(i, self.res_conf_start[jres] + jconf - 1)]
+        return vdw
 
-    # loop over a pre-defined number of initial microstates, as in (REPACKS)
-    for ipack in range(max_repacks):
+    def restart(self, seed):
+        """
+        Repack from a random microstate until it converges or Max_repack_steps is reached.
+        The random initial microstate and residue orders come from random.Random(seed).
+        Returns (microstate, exit vdw, steps).
+        """
+        rng = random.Random(seed)
+        n_res = len(self.n_conf)
         # generate a random initial state
         microstate = []
-        for res in self.protein.residue:
-            if len(res.conf) <= 1:
+        for n_conf in self.n_conf:
+            if n_conf <= 1:
                 iconf = 0  # no side chain
             else:
-                iconf = random.choice(list(range(1, len(res.conf))))
+                iconf = rng.choice(list(range(1, n_conf)))
             microstate.append(iconf)
         previous_microstate = microstate.copy()
+        packed = PackedField(self.vdw_pairwise, [self.res_conf_start[ires] + iconf - 1 for ires, iconf in enumerate(microstate) if iconf != 0])
 
         for istep in range(Max_repack_steps):
             # get the order of residues that repack will optimize
-            optimize_res = list(range(len(self.protein.residue)))
-            random.shuffle(optimize_res)
-
+            optimize_res = list(range(n_res))
+            rng.shuffle(optimize_res)
 
             # loop over residues to find the lowest energy conformer
             vdw_sum = 0.0
             for ires in optimize_res:
-                res = self.protein.residue[ires]
-                if len(res.conf) > 2:  # only need to search through reside with more than 1 side chain conformers
-                    vdw_min = vdw_total(res.conf[1], microstate, vdw_lookup_table, self)  # use the first conf as inital vdw_min
-                    iconf_min = 1
-                    for iconf in range(2, len(res.conf)):
-                        vdw = vdw_total(res.conf[iconf], microstate, vdw_lookup_table, self)
-                        if vdw < vdw_min:
-                            vdw_min = vdw
-                            iconf_min = iconf
-                    microstate[ires] = iconf_min
+                if self.n_conf[ires] > 2:  # only need to search through reside with more than 1 side chain conformers
+                    first = self.res_conf_start[ires]
+                    last = self.res_conf_start[ires + 1]
+                    vdw = self.vdw_backbone[first:last] + packed.field[first:last]
+                    # resolve near ties with the exact sum, so that the first lowest conformer wins as before
+                    candidates = np.flatnonzero(vdw <= vdw.min() + 1.0e-6)
+                    iconf_min = candidates[0] + 1
+                    vdw_min = vdw[candidates[0]]
+                    if len(candidates) > 1:
+                        vdw_min = self.vdw_total(first + candidates[0], ires, microstate)
+                        for iconf in candidates[1:] + 1:
+                            vdw = self.vdw_total(first + iconf - 1, ires, microstate)
+                            if vdw < vdw_min:
+                                vdw_min = vdw
+                                iconf_min = iconf
+                    if iconf_min != microstate[ires]:
+                        packed.move(first + microstate[ires] - 1, first + iconf_min - 1)
+                        microstate[ires] = int(iconf_min)
                     vdw_sum += vdw_min
 
             # test if the microstate has converged, quit repacking if converged
-            #print(previous_microstate, "--->", microstate)
             break_step = istep + 1  # record current break step number for log
             if microstate != previous_microstate:
                 previous_microstate = microstate.copy()
             else:
                 break  # converged
-            
+
+        return microstate, vdw_sum, break_step
+
+
+def repack_arrays(self, vdw_lookup_table):
+    """Arrays of the RepackProblem from the protein and the vdw lookup table."""
+    vdw_backbone, vdw_pairwise = vdw_lookup_table
+    return {"vdw_backbone": np.array(vdw_backbone, dtype=float),
+            "data": vdw_pairwise.matrix.data,
+            "indices": vdw_pairwise.matrix.indices,
+            "indptr": vdw_pairwise.matrix.indptr,
+            "res_conf_start": np.array(vdw_pairwise.res_conf_start, dtype=np.int64),
+            "n_conf": np.array([len(res.conf) for res in self.protein.residue], dtype=np.int64)}
+
+
+# RepackProblem of a worker process, made by _init_repack_worker()
+_repack_problem = None
+
+
+def share_arrays(arrays):
+    """Copy arrays to shared memory, to be passed to the worker processes at pool creation."""
+    shared = {}
+    for name, a in arrays.items():
+        raw = RawArray("b", max(a.nbytes, 1))
+        np.frombuffer(raw, dtype=a.dtype, count=a.size)[:] = a
+        shared[name] = (raw, a.dtype.str, a.size)
+    return shared
+
+
+def _init_repack_worker(shared):
+    global _repack_problem
+    arrays = {name: np.frombuffer(raw, dtype=dtype, count=size) for name, (raw, dtype, size) in shared.items()}
+    _repack_problem = RepackProblem(arrays)
+
+
+def _repack_restart(seed):
+    return _repack_problem.restart(seed)
+
+
+def repack_processes(prm, max_repacks):
+    """Number of repack processes from (REPACK_PROCESSES), 1 (serial) when absent, 0 means all CPUs."""
+    processes = 1
+    if hasattr(prm, "REPACK_PROCESSES"):
+        processes = int(prm.REPACK_PROCESSES.value)
+    if processes <= 0:
+        processes = os.cpu_count() or 1
+    return max(1, min(processes, max_repacks))
+
+
+def rot_repack(self):
+    """ Repack rotamers to select low enegy rotamers
+    """
+    # connect12 is inherited, clean_hvrot did connect 13 and 14 already, we do this just make sure
+    # current_time = time.time()
+    occ_cutoff = float(self.prm.REPACK_CUTOFF.value)
+    max_repacks = int(self.prm.REPACKS.value)
+
+    logging.info("   Prepare vdw energy lookup table. This may take a while...")
+    vdw_lookup_table = precalculate_vdw(self)
+    logging.info("   Done calculating vdw energy lookup table.")
+    arrays = repack_arrays(self, vdw_lookup_table)
+    
+    # print(time.time() - current_time)
+    # one seed per restart, so the restarts give the same results in any number of processes
+    random.seed(time.time())
+    base_seed = random.randrange(2**31)
+    seeds = [base_seed + ipack for ipack in range(max_repacks)]
+
+    # loop over a pre-defined number of initial microstates, as in (REPACKS)
+    processes = repack_processes(self.prm, max_repacks)
+    if processes > 1:
+        logging.info("   Running %d repacks in %d processes." % (max_repacks, processes))
+        with Pool(processes, initializer=_init_repack_worker, initargs=(share_arrays(arrays),)) as pool:
+            results = pool.map(_repack_restart, seeds, chunksize=max(1, max_repacks // (4 * processes)))
+    else:
+        problem = RepackProblem(arrays)
+        results = [problem.restart(seed) for seed in seeds]
+
+    converged_ms = []  # stats of converged microstates
+    for ipack, (microstate, vdw_sum, break_step) in enumerate(results):
         converged_ms.append(microstate)
         logging.debug("   Repacking cycle %4d of %4d: exit vdw = %.3f kcal/mol at step %d" % (ipack+1, max_repacks, vdw_sum, break_step))
         
@@ -60,13 +60,12 @@ def rot_rotate(self):
                     # obtain rotate operation
                     axis = LINE()
                     axis.from2p(atom1.xyz, atom2.xyz)
-                    op = OPERATION()
-                    for i in range(1, n_rotation_steps):
-                        op.reset()
-                        op.roll(phi*i, axis)
+                    operations = roll_operations([phi*i for i in range(1, n_rotation_steps)], axis)
+                    moved_xyz = apply_operations(operations, [atom.xyz for atom in affected_atoms])  # all rotation steps in one call
+                    for moved in moved_xyz:
                         new_xyz = {}  # atom name : xyz dictionary for affected atoms
-                        for atom in affected_atoms:
-                            new_xyz[atom.name] = op.apply(atom.xyz)
+                        for atom, xyz in zip(affected_atoms, moved):
+                            new_xyz[atom.name] = xyz
                         new_conf = conf.clone()     # this clone will copy all atoms except their 13 and 14 connectivity
                         new_conf.history = conf.history[:2] + "R" + conf.history[3:]
                         for atom in new_conf.atom:  # Update
@@ -76,13 +76,12 @@ def swing(self, conf, phi):
                 # obtain rotate operation
                 axis = LINE()
                 axis.from2p(atom1.xyz, atom2.xyz)
-                op = OPERATION()
-                for i in [-1, 1]:
-                    op.reset()
-                    op.roll(phi*i, axis)
+                operations = roll_operations([-phi, phi], axis)
+                moved_xyz = apply_operations(operations, [atom.xyz for atom in affected_atoms])  # both swings in one call
+                for moved in moved_xyz:
                     new_xyz = {}  # atom name : xyz dictionary for affected atoms
-                    for atom in affected_atoms:
-                        new_xyz[atom.name] = op.apply(atom.xyz)
+                    for atom, xyz in zip(affected_atoms, moved):
+                        new_xyz[atom.name] = xyz
                     new_conf = each_conf.clone()     # this clone will copy all atoms and connect12
                     new_conf.history = each_conf.history[:2] + "R" + conf.history[3:]
                     for atom in new_conf.atom:  # Update
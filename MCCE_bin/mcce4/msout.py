@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+"""
+Module: msout.py
+
+Streaming access to the microstate files written in ms_out/ by step 4 (MS_OUT on),
+e.g. ms_out/pH7.00eH0.00ms.txt, which can be tens of GB per titration point.
+
+  * `iter_microstates`: Reads an msout text file in fixed-size chunks without loading it;
+    each chunk (MsChunk) holds NumPy arrays of the MC run, the microstates as conformer
+    indices (iConf - 1 in head3.lst) of the free residues, the energy and the count.
+    For an ENUMERATE file, count is the occupancy of the microstate.
+
+  * `convert_msout`: Converts an msout text file to a compressed, chunked binary archive
+    (.msz). The archive is a zip of .npy members that stores what the text file stores,
+    the conformer flips of each microstate, with the energy in exact fixed point; so
+    it loads back to the same values as the text file.
+
+  * `MsoutArchive`: Random access by chunk to an .msz archive; iterating it yields the
+    same chunks as `iter_microstates` on the text file.
+
+  * `benchmark_msout`: Text parse throughput, archive size reduction and archive read speed.
+
+Usage:
+    for chunk in iter_microstates("ms_out/pH7.00eH0.00ms.txt"):
+        E_avg = np.sum(chunk.energy * chunk.count) / np.sum(chunk.count)
+
+    convert_msout("ms_out/pH7.00eH0.00ms.txt")  # writes ms_out/pH7.00eH0.00ms.msz
+    archive = MsoutArchive("ms_out/pH7.00eH0.00ms.msz")
+    chunk = archive.chunk(3)
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import logging
+from pathlib import Path
+import sys
+import time
+from typing import Iterator, List, NamedTuple, Union
+import zipfile
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+CHUNK_SIZE = 100_000
+ARCHIVE_EXT = ".msz"
+ENERGY_SCALE = 1_000_000  # energies are written with 6 decimals ("%lf")
+OCC_SCALE = 1_000         # ENUMERATE occupancies are written with 3 decimals ("%5.3f")
+NEWLINE, COLON, HASH = ord("\n"), ord(":"), ord("#")
+
+
+class MsoutHeader:
+    """Header of an msout file: conditions, sampling method, fixed conformers and the
+    conformers of each free residue."""
+
+    def __init__(self, T: float, pH: float, eH: float, method: str,
+                 fixed_confs: np.ndarray, free_residues: List[np.ndarray]):
+        self.T = T
+        self.pH = pH
+        self.eH = eH
+        self.method = method
+        self.fixed_confs = fixed_confs
+        self.free_residues = free_residues
+        self.n_free = len(free_residues)
+
+        # position in the microstate of the residue of each free conformer
+        n_confs = max([int(x.max(initial=-1)) for x in free_residues], default=-1) + 1
+        self.res_of_conf = np.full(n_confs, -1, dtype=np.int32)
+        for i, confs in enumerate(free_residues):
+            self.res_of_conf[confs] = i
+
+    @property
+    def count_scale(self) -> int:
+        """Fixed point scale of the count column in an archive."""
+        return OCC_SCALE if self.method == "ENUMERATE" else 1
+
+
+class MsChunk(NamedTuple):
+    """Microstates number `start` to `start + len(energy)` of an msout file."""
+    index: int
+    start: int
+    mc: np.ndarray      # MC run of each microstate (0 for ENUMERATE)
+    states: np.ndarray  # (n, n_free) conformer indices
+    energy: np.ndarray
+    count: np.ndarray   # MC counts, or occupancies for ENUMERATE
+
+
+class _Events(NamedTuple):
+    """A chunk as written in the msout file: the state before the chunk, and the
+    conformers that flip in before each microstate."""
+    start_state: np.ndarray
+    mc: np.ndarray
+    energy: np.ndarray
+    count: np.ndarray
+    flip_n: np.ndarray
+    flip_conf: np.ndarray
+
+
+def _int_list(text: str) -> np.ndarray:
+    return np.array(text.split(), dtype=np.int32)
+
+
+def read_msout_header(fh) -> MsoutHeader:
+    """Read the header lines of an msout file opened in binary mode; fh is left at the first
+    line after the header.
+
+    Header example:
+        T:298.15,pH:7.00,eH:0.00
+        METHOD:MONTERUNS
+        #N_FIXED:FIXED_CONF_ID
+        43:3 10 36 ...
+        #N_FREE residues:CONF_IDs for each free residues
+        61:0 1 ;4 6 ;7 8 ;...
+    """
+    conditions = {}
+    for field in fh.readline().decode().strip().split(","):
+        key, value = field.split(":")
+        conditions[key] = float(value)
+    method = fh.readline().decode().strip().split(":")[1]
+
+    fields = []
+    while len(fields) < 2:
+        line = fh.readline()
+        if not line:
+            raise ValueError("Incomplete msout header in %s" % fh.name)
+        line = line.decode().strip()
+        if line and not line.startswith("#"):
+            fields.append(line.split(":", 1)[1])
+
+    fixed_confs = _int_list(fields[0])
+    free_residues = [_int_list(x) for x in fields[1].split(";") if x.strip()]
+
+    return MsoutHeader(conditions["T"], conditions["pH"], conditions["eH"], method,
+                       fixed_confs, free_residues)
+
+
+def _end_state(events: _Events, header: MsoutHeader) -> np.ndarray:
+    """The microstate after the last flip of a chunk."""
+    state = events.start_state.copy()
+    flip_res = header.res_of_conf[events.flip_conf]
+    # the last flip of a residue wins
+    _, last = np.unique(flip_res[::-1], return_index=True)
+    last = len(flip_res) - 1 - last
+    state[flip_res[last]] = events.flip_conf[last]
+    return state
+
+
+def _expand_states(events: _Events, header: MsoutHeader) -> np.ndarray:
+    """Full (n, n_free) microstates of a chunk from its start state and flips."""
+    n = len(events.energy)
+    n_free = header.n_free
+    value = np.empty((n + 1, n_free), dtype=np.int32)
+    value[0] = events.start_state
+    changed = np.zeros((n + 1, n_free), dtype=np.int32)
+
+    rows = np.repeat(np.arange(1, n + 1, dtype=np.int32), events.flip_n)
+    cols = header.res_of_conf[events.flip_conf]
+    value[rows, cols] = events.flip_conf
+    changed[rows, cols] = rows
+
+    # each residue takes its conformer from the last microstate that flipped it
+    np.maximum.accumulate(changed, axis=0, out=changed)
+    return value[changed, np.arange(n_free)][1:]
+
+
+def _parse_microstates(data: bytes, method: str) -> tuple:
+    """Energy, count, number of flips and flipped conformers of a block of microstate lines
+    "ENERGY,COUNT,NEW_CONF", each ending with a newline.
+    All numbers of the block are parsed in one pass; the lines are only used to tell which
+    number is which.
+    """
+    data = data.replace(b",", b" ")
+    values = np.fromstring(data, sep=" ")
+    chars = np.frombuffer(data, dtype=np.uint8)
+    blank = chars <= 32  # space, tab, newline
+    token_start = np.flatnonzero(~blank & np.concatenate(([True], blank[:-1])))
+    if len(token_start) != len(values):
+        raise ValueError("Microstate line is not ENERGY,COUNT,NEW_CONF: %s" % data[token_start[len(values)]:][:80])
+
+    # index of the first number after each line
+    line_end = np.searchsorted(token_start, np.flatnonzero(chars == NEWLINE))
+    line_start = np.concatenate(([0], line_end[:-1]))
+    flip_n = (line_end - line_start - 2).astype(np.int32)
+    if flip_n.min(initial=0) < 0:
+        raise ValueError("Microstate line without energy and count in the msout file")
+
+    energy = values[line_start]
+    count = values[line_start + 1]
+    if method != "ENUMERATE":
+        count = count.astype(np.int64)
+    is_flip = np.ones(len(values), dtype=bool)
+    is_flip[line_start] = False
+    is_flip[line_start + 1] = False
+    flip_conf = values[is_flip].astype(np.int32)
+
+    return energy, count, flip_n, flip_conf
+
+
+def _iter_text_events(fh, header: MsoutHeader, chunk_size: int, block_size: int = 1 << 24) -> Iterator[_Events]:
+    """Read the lines after the header in blocks of about block_size bytes and cut the
+    microstates into chunks of chunk_size. fh is a binary file object.
+    """
+    state = np.full(header.n_free, -1, dtype=np.int32)
+    run = 0
+    pending = None  # a full state line, applied with the next microstate
+    columns = ["mc", "energy", "count", "flip_n", "flip_conf"]
+    buffered = {x: [] for x in columns}
+
+    def add_microstates(data):
+        nonlocal pending
+        energy, count, flip_n, flip_conf = _parse_microstates(data, header.method)
+        if pending is not None:
+            flip_n[0] += len(pending)
+            flip_conf = np.concatenate((pending, flip_conf))
+            pending = None
+        for name, array in zip(columns, (np.full(len(energy), run, dtype=np.int32), energy, count, flip_n, flip_conf)):
+            buffered[name].append(array)
+
+    rest = b""
+    while True:
+        block = fh.read(block_size)
+        data = rest + block
+        if block:
+            cut = data.rfind(b"\n") + 1
+            data, rest = data[:cut], data[cut:]
+        elif data and not data.endswith(b"\n"):
+            data += b"\n"
+
+        # Lines other than microstates are rare: comments, "MC:N" and full states "N_FREE:CONF_IDs".
+        # The microstates between them are parsed as one block.
+        chars = np.frombuffer(data, dtype=np.uint8)
+        line_end = np.flatnonzero(chars == NEWLINE)
+        line_start = np.concatenate(([0], line_end[:-1] + 1))
+        marked = np.flatnonzero((chars == COLON) | (chars == HASH))
+        controls = np.union1d(np.searchsorted(line_end, marked), np.flatnonzero(line_end == line_start))
+        first = 0
+        for i in list(controls) + [len(line_end)]:
+            if i > first:
+                add_microstates(data[line_start[first]:line_start[i] if i < len(line_end) else len(data)])
+            if i < len(line_end):
+                line = data[line_start[i]:line_end[i]].decode()
+                if line.startswith("MC:"):
+                    run = int(line[3:])
+                elif ":" in line and not line.startswith("#"):
+                    pending = _int_list(line.split(":", 1)[1])
+            first = i + 1
+
+        if buffered["energy"]:
+            arrays = {name: np.concatenate(buffered[name]) for name in columns}
+            flip_start = np.concatenate(([0], np.cumsum(arrays["flip_n"])))
+            n = len(arrays["energy"])
+            begin = 0
+            while n - begin >= chunk_size or (not block and n > begin):
+                end = min(begin + chunk_size, n)
+                events = _Events(state, *[arrays[name][begin:end] for name in columns[:4]],
+                                 arrays["flip_conf"][flip_start[begin]:flip_start[end]])
+                state = _end_state(events, header)
+                yield events
+                begin = end
+            buffered = {name: [arrays[name][begin:]] for name in columns[:4]}
+            buffered["flip_conf"] = [arrays["flip_conf"][flip_start[begin]:]]
+            if begin == n:
+                buffered = {x: [] for x in columns}
+
+        if not block:
+            break
+
+
+def _chunks_from_events(events_iter: Iterator[_Events], header: MsoutHeader) -> Iterator[MsChunk]:
+    start = 0
+    for index, events in enumerate(events_iter):
+        yield MsChunk(index, start, events.mc, _expand_states(events, header), events.energy, events.count)
+        start += len(events.energy)
+
+
+def iter_microstates(msout_fp: Union[str, Path], chunk_size: int = CHUNK_SIZE) -> Iterator[MsChunk]:
+    """Yield the microstates of an msout text file in chunks of chunk_size.
+    The header is available as read_msout_header(open(msout_fp, "rb")).
+    """
+    with open(msout_fp, "rb") as fh:
+        header = read_msout_header(fh)
+        yield from _chunks_from_events(_iter_text_events(fh, header, chunk_size), header)
+
+
+def _compact_int(array: np.ndarray) -> np.ndarray:
+    """The array in the smallest integer type that holds its values."""
+    if array.size == 0:
+        return array
+    if array.min() >= 0:
+        return array.astype(np.min_scalar_type(array.max()))
+    return array.astype(np.promote_types(np.min_scalar_type(array.min()), np.min_scalar_type(-array.max() - 1)))
+
+
+def _pack_energy(energy: np.ndarray) -> np.ndarray:
+    """Energies for the archive. mcce writes a single precision energy with 6 decimals, so the
+    float32 value restores the written number exactly; it is stored as its 4 byte planes, which
+    compress far better than the interleaved bytes. A chunk that does not restore exactly
+    (energies not written by mcce) is stored in fixed point as int64 instead.
+    """
+    micro = np.rint(energy * ENERGY_SCALE).astype(np.int64)
+    single = energy.astype(np.float32)
+    if np.array_equal(np.rint(single.astype(np.float64) * ENERGY_SCALE).astype(np.int64), micro):
+        return single.view(np.uint8).reshape(-1, 4).T
+    return micro
+
+
+def _unpack_energy(packed: np.ndarray) -> np.ndarray:
+    if packed.dtype == np.uint8:  # byte planes of float32
+        micro = np.rint(np.ascontiguousarray(packed.T).view(np.float32).ravel().astype(np.float64) * ENERGY_SCALE)
+    else:
+        micro = packed
+    return micro / ENERGY_SCALE
+
+
+def _write_array(zf: zipfile.ZipFile, name: str, array: np.ndarray):
+    with zf.open(name + ".npy", "w", force_zip64=True) as fh:
+        if not array.flags.c_contiguous:
+            array = array.copy(order="C")
+        np.lib.format.write_array(fh, array, allow_pickle=False)
+
+
+def convert_msout(msout_fp: Union[str, Path], archive_fp: Union[str, Path, None] = None,
+                  chunk_size: int = CHUNK_SIZE, compression: int = zipfile.ZIP_DEFLATED) -> Path:
+    """Convert an msout text file to an .msz archive, by default next to the text file.
+    Return the archive path.
+    """
+    msout_fp = Path(msout_fp)
+    if archive_fp is None:
+        archive_fp = msout_fp.with_suffix(ARCHIVE_EXT)
+    archive_fp = Path(archive_fp)
+    tmp_fp = archive_fp.with_name(archive_fp.name + ".tmp")
+
+    n_chunks = 0
+    n_microstates = 0
+    with open(msout_fp, "rb") as fh, zipfile.ZipFile(tmp_fp, "w", compression=compression) as zf:
+        header = read_msout_header(fh)
+        _write_array(zf, "header_conditions", np.array([header.T, header.pH, header.eH]))
+        _write_array(zf, "header_method", np.array(header.method))
+        _write_array(zf, "header_fixed", header.fixed_confs)
+        _write_array(zf, "header_free", np.concatenate(header.free_residues or [np.zeros(0, dtype=np.int32)]))
+        _write_array(zf, "header_free_n", np.array([len(x) for x in header.free_residues], dtype=np.int32))
+
+        for events in _iter_text_events(fh, header, chunk_size):
+            prefix = "chunk%06d_" % n_chunks
+            _write_array(zf, prefix + "start_state", events.start_state)
+            _write_array(zf, prefix + "mc", _compact_int(events.mc))
+            _write_array(zf, prefix + "energy", _pack_energy(events.energy))
+            _write_array(zf, prefix + "count", _compact_int(np.rint(events.count * header.count_scale).astype(np.int64)))
+            _write_array(zf, prefix + "flip_n", _compact_int(events.flip_n))
+            _write_array(zf, prefix + "flip_conf", _compact_int(events.flip_conf))
+            n_chunks += 1
+            n_microstates += len(events.energy)
+
+        # written last: an archive without it is incomplete
+        _write_array(zf, "header_chunks", np.array([chunk_size, n_chunks, n_microstates], dtype=np.int64))
+
+    tmp_fp.replace(archive_fp)
+    return archive_fp
+
+
+class MsoutArchive:
+    """Random access by chunk to an .msz archive written by convert_msout."""
+
+    def __init__(self, archive_fp: Union[str, Path]):
+        self.npz = np.load(archive_fp, allow_pickle=False)
+        if "header_chunks" not in self.npz.files:
+            sys.exit(f"Incomplete msout archive: {archive_fp!s}")
+
+        T, pH, eH = self.npz["header_conditions"]
+        free = self.npz["header_free"]
+        free_n = self.npz["header_free_n"]
+        free_residues = np.split(free, np.cumsum(free_n)[:-1]) if len(free_n) else []
+        self.header = MsoutHeader(float(T), float(pH), float(eH), str(self.npz["header_method"]),
+                                  self.npz["header_fixed"], free_residues)
+        self.chunk_size, self.n_chunks, self.n_microstates = [int(x) for x in self.npz["header_chunks"]]
+
+    def _events(self, index: int) -> _Events:
+        prefix = "chunk%06d_" % index
+        count = self.npz[prefix + "count"].astype(np.int64)
+        if self.header.count_scale != 1:
+            count = count / self.header.count_scale
+        return _Events(self.npz[prefix + "start_state"],
+                       self.npz[prefix + "mc"].astype(np.int32),
+                       _unpack_energy(self.npz[prefix + "energy"]),
+                       count,
+                       self.npz[prefix + "flip_n"].astype(np.int32),
+                       self.npz[prefix + "flip_conf"].astype(np.int32))
+
+    def chunk(self, index: int) -> MsChunk:
+        """Chunk number index, 0 based; every chunk but the last holds chunk_size microstates."""
+        if not 0 <= index < self.n_chunks:
+            raise IndexError(f"Chunk {index} out of range, the archive has {self.n_chunks} chunks")
+        events = self._events(index)
+        return MsChunk(index, index * self.chunk_size, events.mc, _expand_states(events, self.header),
+                       events.energy, events.count)
+
+    def __len__(self) -> int:
+        return self.n_chunks
+
+    def __iter__(self) -> Iterator[MsChunk]:
+        for index in range(self.n_chunks):
+            yield self.chunk(index)
+
+    def close(self):
+        self.npz.close()
+
+
+def benchmark_msout(msout_fp: Union[str, Path], chunk_size: int = CHUNK_SIZE) -> dict:
+    """Time parsing the text file, converting it and reading the archive back; check that
+    the archive holds the same microstates. Return the measurements.
+    """
+    msout_fp = Path(msout_fp)
+    text_bytes = msout_fp.stat().st_size
+    result = {"text_MB": text_bytes / 1e6}
+
+    t0 = time.time()
+    n_microstates = 0
+    for chunk in iter_microstates(msout_fp, chunk_size):
+        n_microstates += len(chunk.energy)
+    seconds = time.time() - t0
+    result["microstates"] = n_microstates
+    result["parse_s"] = seconds
+    result["parse_MB_per_s"] = text_bytes / 1e6 / seconds
+    result["parse_microstates_per_s"] = n_microstates / seconds
+
+    t0 = time.time()
+    archive_fp = convert_msout(msout_fp, msout_fp.with_name(msout_fp.stem + "_bench" + ARCHIVE_EXT), chunk_size)
+    result["convert_s"] = time.time() - t0
+    result["archive_MB"] = archive_fp.stat().st_size / 1e6
+    result["size_reduction"] = text_bytes / archive_fp.stat().st_size
+
+    archive = MsoutArchive(archive_fp)
+    t0 = time.time()
+    for chunk in archive:
+        pass
+    seconds = time.time() - t0
+    result["archive_read_s"] = seconds
+    result["archive_microstates_per_s"] = n_microstates / seconds
+
+    t0 = time.time()
+    archive.chunk(archive.n_chunks // 2)
+    result["random_chunk_s"] = time.time() - t0
+
+    same = all(np.array_equal(a.states, b.states) and np.array_equal(a.energy, b.energy)
+               and np.array_equal(a.count, b.count) and np.array_equal(a.mc, b.mc)
+               for a, b in zip(iter_microstates(msout_fp, chunk_size), archive))
+    result["identical"] = same
+    archive.close()
+    archive_fp.unlink()
+
+    return result
+
+
+def cli_parser():
+    p = ArgumentParser(
+        prog="msout_convert",
+        description="""Convert msout text files in ms_out/ to compressed, chunked binary
+archives (.msz) with random access by chunk, or benchmark the conversion.""",
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    p.add_argument("msout_files", nargs="+", type=Path, help="msout text file(s), e.g. ms_out/pH7.00eH0.00ms.txt")
+    p.add_argument("-chunk", type=int, default=CHUNK_SIZE,
+                   help="Number of microstates per chunk; default: %(default)s.")
+    p.add_argument("--bench", default=False, action="store_true",
+                   help="Report parse throughput and size reduction instead of converting.")
+    return p
+
+
+def msout_convert_cli(argv=None):
+    """Cli function for the `msout_convert` tool."""
+    logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+    args = cli_parser().parse_args(argv)
+
+    for msout_fp in args.msout_files:
+        if not msout_fp.is_file():
+            logger.error(f"Not found: {msout_fp!s}")
+            continue
+        if args.bench:
+            r = benchmark_msout(msout_fp, args.chunk)
+            logger.info(f"{msout_fp!s}: {r['microstates']:,} microstates, {r['text_MB']:,.1f} MB\n"
+                        f"  parse  : {r['parse_s']:,.2f} s, {r['parse_MB_per_s']:,.1f} MB/s, "
+                        f"{r['parse_microstates_per_s']:,.0f} microstates/s\n"
+                        f"  archive: {r['archive_MB']:,.2f} MB ({r['size_reduction']:.1f}x smaller), "
+                        f"converted in {r['convert_s']:,.2f} s\n"
+                        f"  read   : {r['archive_read_s']:,.2f} s, {r['archive_microstates_per_s']:,.0f} microstates/s, "
+                        f"random chunk {r['random_chunk_s']*1000:,.1f} ms\n"
+                        f"  identical to text: {r['identical']}")
+        else:
+            t0 = time.time()
+            archive_fp = convert_msout(msout_fp, chunk_size=args.chunk)
+            logger.info(f"Converted {msout_fp!s} -> {archive_fp!s} in {time.time() - t0:,.2f} s")
+
+    return 0
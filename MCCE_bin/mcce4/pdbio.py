@@ -26,9 +26,10 @@ Classes:
 """
 # ...................................................................................................| 100
 
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, namedtuple
 import glob
 import logging
+from operator import attrgetter
 import os
 from pathlib import Path
 from pprint import pformat
@@ -40,6 +41,7 @@ from typing import Tuple, Union
 import numpy as np
 
 from mcce4.constants import IONIZABLE_RES
+from mcce4.ftpl_cache import ftpl_records, load_param_records
 from .geom import ddvv
 
 
@@ -48,6 +50,21 @@ logging.basicConfig(level=logging.INFO,
 logger = logging.getLogger(__name__)
 
 
+ATOM_META = namedtuple("ATOM_META", ["altLoc", "resName", "chainID", "resSeq", "iCode", "confType", "resID"])
+ATOM_META.__doc__ = """Immutable residue and conformer identity of an atom, shared by an atom and its clones."""
+DEFAULT_ATOM_META = ATOM_META(" ", "UNK", "A", 0, "_", "", "")
+
+
+def _meta_property(field):
+    """Atom attribute stored in the shared ATOM_META record. Assigning a different value
+    replaces the record of this atom only (copy-on-write), the clones keep the old one.
+    """
+    def set_field(self, value):
+        if getattr(self.meta, field) != value:
+            self.meta = self.meta._replace(**{field: value})
+    return property(attrgetter("meta." + field), set_field)
+
+
 class Atom:
     """This class defines atom properties and operations.
 
@@ -81,28 +98,43 @@ class Atom:
         connect13 [list]: connected atoms at distance level 1-3.
         connect14 [list]: connected atoms at distance level 1-4.
         history (str): conformer history string.
+
+    Memory layout:
+        Rotamer generation clones atoms hundreds of thousands of times, so the class uses
+        __slots__ and keeps the residue identity (altLoc, resName, chainID, resSeq, iCode,
+        confType, resID) in one ATOM_META record shared with the clones, see meta. These
+        fields read and assign like plain attributes. name, element, r_vdw and e_vdw stay
+        direct slots as they are read in the pairwise loops.
+        mass, conn12 and parent_conf are scratch slots of place_h and hbond_h, r (SAS radius)
+        of conf_sas and rot_xposed.
     """
+    __slots__ = ("meta", "record", "serial", "name", "xyz", "element", "confNum", "atomID", "confID",
+                 "connectivity_param", "r_bound", "charge", "r_vdw", "e_vdw", "connect12", "connect13",
+                 "connect14", "history", "mass", "conn12", "parent_conf", "r")
+
+    altLoc = _meta_property("altLoc")
+    resName = _meta_property("resName")
+    chainID = _meta_property("chainID")
+    resSeq = _meta_property("resSeq")
+    iCode = _meta_property("iCode")
+    confType = _meta_property("confType")
+    resID = _meta_property("resID")
+
     def __init__(self) -> None:
         """
         Declare variable types and default values
         """
+        self.meta = DEFAULT_ATOM_META  # altLoc, resName, chainID, resSeq, iCode, confType, resID
         self.record = "ATOM"  # _atom_site.group_PDB in cif
         self.serial = 0  # from cif/pdb/pqr
         self.name = "  X "  # from cif/pdb/pqr
-        self.altLoc = " "  # from cif/pdb/pqr
-        self.resName = "UNK"  # from cif/pdb/pqr
-        self.chainID = "A"  # from cif/pdb/pqr
-        self.resSeq = 0  # from cif/pdb/pqr
-        self.iCode = "_"  # from cif/pdb/pqr
         self.xyz = (0.0, 0.0, 0.0)  # from cif/pdb/pqr
         self.element = "  "  # element name converted from atom name
         # mcce internals:
         self.confNum = 0  # conformer number
         self.atomID = ""  # atom ID given residue, sequence, conformer and atom name.
         self.confID = ""  # conformer ID in context of residue, sequence, and conf name.
-        self.confType = ""  # 5-char conftype as in CONFLIST from ftpl file
         # defined in ftpl file:
-        self.resID = ""  # residue ID given residue name, chainId, sequence number and insertion code.
         self.connectivity_param = ""  # connectivity parameter defined in ftpl file
         self.r_bound = 0.0  # radius for dielectric boundary
         self.charge = 0.0  # atom charge
@@ -122,50 +154,38 @@ class Atom:
         self.record = line[:6]
         self.serial = int(line[6:11])
         self.name = line[12:16]
-        self.altLoc = line[16]
-        self.resName = line[17:20]
-        self.chainID = line[21]
-        self.resSeq = int(line[22:26])
-        self.iCode = line[26]
+        resName = line[17:20]
+        chainID = line[21]
+        resSeq = int(line[22:26])
+        iCode = line[26]
+        self.meta = self.meta._replace(altLoc=line[16], resName=resName, chainID=chainID, resSeq=resSeq,
+                                       iCode=iCode, resID=(resName, chainID, resSeq, iCode))
         self.xyz = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
-        self.resID = (self.resName, self.chainID, self.resSeq, self.iCode)
 
     def loadline(self, line, tpl):
         self.record = line[:6]
         self.serial = int(line[6:11])
-        self.name = line[12:16]
-        self.altLoc = line[16]
-        self.resName = line[17:20]
-        self.chainID = line[21]
-        self.resSeq = int(line[22:26])
-        self.iCode = line[26]
+        self.name = name = line[12:16]
+        resName = line[17:20]
+        chainID = line[21]
+        resSeq = int(line[22:26])
+        iCode = line[26]
         self.confNum = int(line[27:30])
         self.xyz = (float(line[30:38]), float(line[38:46]), float(line[46:54]))
         self.r_bound = float(line[54:62])
         self.charge = float(line[62:74])
-        self.confType = "%3s%2s" % (self.resName, line[80:82])
-        self.element = self.name[:2]  # element name defaults to the first two char
-        if len(self.name.strip()) == 4 and self.name[0] == "H": # special case H, 4 char, H is the first char
+        confType = "%3s%2s" % (resName, line[80:82])
+        self.element = name[:2]  # element name defaults to the first two char
+        if len(name.strip()) == 4 and name[0] == "H": # special case H, 4 char, H is the first char
             self.element = " H"
 
         self.history = line[80:].strip()
 
-        self.compose_atomID()
-
-        self.confID = "%5s%c%04d%c%03d" % (
-            self.confType,
-            self.chainID,
-            self.resSeq,
-            self.iCode,
-            self.confNum,
-        )
-        self.resID = (self.resName, self.chainID, self.resSeq, self.iCode)
-
         # extended records
-        connect_key = ("CONNECT", self.name, self.confType)
+        connect_key = ("CONNECT", name, confType)
         self.connectivity_param = tpl.db[connect_key]
 
-        radius_key = ("RADIUS", self.confType, self.name)
+        radius_key = ("RADIUS", confType, name)
         if radius_key in tpl.db:
             radius_values = tpl.db[radius_key]
             self.r_vdw = radius_values.r_vdw
@@ -177,6 +197,17 @@ class Atom:
             )
             self.r_vdw = 1.908
             self.e_vdw = 0.086
+
+        self.meta = ATOM_META(line[16], resName, chainID, resSeq, iCode, confType, (resName, chainID, resSeq, iCode))
+        self.compose_atomID()
+
+        self.confID = "%5s%c%04d%c%03d" % (
+            self.confType,
+            self.chainID,
+            self.resSeq,
+            self.iCode,
+            self.confNum,
+        )
         return
 
     def compose_atomID(self):
@@ -194,28 +225,24 @@ class Atom:
         Args:
             atom (Atom class): template atom 
         """
+        self.meta = atom.meta  # shared until either atom assigns a different value
         self.serial = atom.serial
         self.name = atom.name
-        self.altLoc = atom.altLoc
-        self.resName = atom.resName 
-        self.chainID = atom.chainID
-        self.resSeq = atom.resSeq
-        self.iCode = atom.iCode
         self.confNum = atom.confNum
         self.xyz = atom.xyz
         self.r_bound = atom.r_bound
         self.charge = atom.charge
         self.r_vdw = atom.r_vdw
         self.e_vdw = atom.e_vdw
-        self.confType = atom.confType
         self.element = atom.element
         self.history = atom.history
         self.compose_atomID()
+        if self.atomID == atom.atomID:  # share the string when the template ID is current
+            self.atomID = atom.atomID
         self.confID = atom.confID
-        self.resID = atom.resID
         self.connect12 = []
         self.connect13 = []
-        self.connect13 = []
+        self.connect14 = []
 
     def as_ATOM_line(self) -> str:
         """Use an ATOM instance data to build an undifferentiated pdb ATOM line.
@@ -293,25 +320,21 @@ class Conformer:
         for atom in self.atom:
             new_atom = Atom()
             new_atom.inherit(atom)
-            new_atom.connect12_inherited = atom.connect12
             new_conf.atom.append(new_atom)
 
-        in_conf_atomnames = [a.name for a in self.atom]
-
-        # create name to atom mapping for new_conf
-        name2atom = {}
-        for atom in new_conf.atom:
-            name2atom[atom.name] = atom
+        # map in-conf atoms to their clones
+        clone_of = {}
+        for atom, new_atom in zip(self.atom, new_conf.atom):
+            clone_of[atom.name] = new_atom
 
         # recreate connect12 for in-conf connected atoms
-        for atom in new_conf.atom:  
-            for atom2 in atom.connect12_inherited:
-                if atom2.name in in_conf_atomnames:  # in the same side chain conformer, update with the atom in the new_conf
-                    atom.connect12.append(name2atom[atom2.name])
+        for atom, new_atom in zip(self.atom, new_conf.atom):
+            for atom2 in atom.connect12:
+                if atom2.name in clone_of:  # in the same side chain conformer, update with the atom in the new_conf
+                    new_atom.connect12.append(clone_of[atom2.name])
                 else:
-                    atom.connect12.append(atom2)
-                    atom2.connect12.append(atom)
-            atom.connect12_inherited = []
+                    new_atom.connect12.append(atom2)
+                    atom2.connect12.append(new_atom)
         return new_conf
 
     def init_by_atom(self, atom):
@@ -595,8 +618,10 @@ class TPL:
             logging.error('No ftpl file in folder "%s". Quiting' % updated_tplfolder)
             sys.exit(1)
         else:
-            for fname in files:
-                self.read_ftpl_file(fname)
+            # records come from the compiled parameter cache, rebuilt when any ftpl file changes
+            for fname, records in load_param_records(updated_tplfolder).items():
+                if fname.endswith(".ftpl"):
+                    self.load_ftpl_records(records, os.path.join(updated_tplfolder, fname))
 
     def read_ftpl_file(self, fname):
         """Read ftpl records from a ftpl file and store in the internal dictionary.
@@ -624,28 +649,18 @@ class TPL:
         >>> tpl.read_ftpl_file()
         >>> tpl.printme()
         """
-        lines = open(fname).readlines()
-        for line in lines:
-            end = line.find("#")
-            line = line[:end]
-            fields = line.split(":")
-            if len(fields) != 2:
-                continue
+        self.load_ftpl_records(ftpl_records(fname), fname)
 
-            key_string = fields[0].strip()
-            keys = key_string.split(",")
-            key1 = keys[0].strip().strip('"')
-            if len(keys) > 1:
-                key2 = keys[1].strip().strip('"')
-            else:
-                key2 = ""
-            if len(keys) > 2:
-                # No add'l strip() after stripping quotes to perserve atom names with spaces
-                key3 = keys[2].strip().strip('"')
-            else:
-                key3 = ""
-
-            value_string = fields[1].strip()
+    def load_ftpl_records(self, records, fname=""):
+        """Store parsed ftpl records in the internal dictionary.
+        Parameters
+        ----------
+        records: list
+        (key1, key2, key3, value_string) tuples, as returned by mcce4.ftpl_cache.ftpl_records.
+        fname: str
+        Name of the source file, used in warnings.
+        """
+        for key1, key2, key3, value_string in records:
             warn_msg_overwrite_key = "This key {} was already loaded, now overwriting"
 
             if key1 == "CONFLIST":
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+
+"""
+Module: reweight.py
+
+Occupancies at new pH or Eh points from the microstates sampled by step 4 with MS_OUT on,
+without running Monte Carlo again.
+
+In monte.c the energy of a microstate depends on pH and Eh only through the protons (nH) and
+electrons (ne) of its conformers:
+    E(pH, Eh) = E0 + PH2KCAL * pH * sum(nH) + PH2KCAL / 58 * Eh * sum(ne)
+Microstates with the same sum(nH), sum(ne) and conformer energy shift are reweighted alike, so
+the sampled microstates are reduced, in one pass over each msout file, to a histogram over these
+sums that keeps the MC count and the count of each conformer in each bin. New conditions are then
+evaluated on the histogram in milliseconds.
+
+Msout files sampled at several conditions are combined by the multi-histogram (WHAM) equations,
+solved on the same histogram; with one file this is single histogram reweighting. Entropy
+correction (MONTE_TSX) is not part of the microstate energy and is not reweighted.
+
+Msout files written in ENUMERATE mode hold the Boltzmann occupancy of every microstate rather than
+MC counts. Their histogram is an exact distribution: it is reweighted on its own, from the file of
+the nearest condition, and is not combined with other files by WHAM. ENUMERATE and MC files can not
+be mixed.
+
+  * `Reweighting`: Reads msout files (text or .msz archives) and solves the free energy of
+    each sampled condition. `occupancy(pH, eH)` gives the occupancy of every conformer in
+    head3.lst and the effective sample size (ESS) at a condition; `titration(points)` gives a
+    fort.38 style OccTable for several points, and warns when the ESS of a point is below
+    min_ess, i.e. when the sampled microstates do not overlap it well enough.
+
+  * `write_occ_table`: Writes an OccTable in the format of fort.38.
+
+Usage:
+    rw = Reweighting(sorted(Path("ms_out").glob("pH*eH*ms.txt")), "head3.lst")
+    table, ess = rw.titration([6.5, 7.5])
+    write_occ_table("fort.38.reweighted", table)
+
+    # with the energy of a conformer shifted by 1 kcal/mol
+    rw = Reweighting(["ms_out/pH7.00eH0.00ms.txt"], shifts={"GLU-1A0035_002": 1.0})
+"""
+
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import logging
+from pathlib import Path
+import time
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+
+from mcce4.conftables import OccTable, read_head3
+from mcce4.constants import KCAL2KT, PH2KCAL, ROOMT
+from mcce4.msout import ARCHIVE_EXT, CHUNK_SIZE, MsoutArchive, iter_microstates, read_msout_header
+
+
+logger = logging.getLogger(__name__)
+
+
+EH2KCAL = PH2KCAL / 58.0  # mV to kcal/mol, as in monte.c
+MIN_ESS = 1000            # effective sample size below which a condition is reported as poorly sampled
+WHAM_TOL = 1.0e-10
+WHAM_MAXITER = 100_000
+
+
+def _logsumexp(a: np.ndarray, axis: int) -> np.ndarray:
+    top = np.max(a, axis=axis, keepdims=True)
+    top = np.where(np.isfinite(top), top, 0.0)
+    return np.squeeze(top, axis=axis) + np.log(np.sum(np.exp(a - top), axis=axis))
+
+
+class Reweighting:
+    """Histogram of the microstates in msout_fps over sum(nH), sum(ne) and energy shift, and the
+    free energies of the sampled conditions.
+    shifts: {conformer name: kcal/mol} added to the energy of these conformers at new conditions.
+    """
+
+    def __init__(self, msout_fps: List[Union[str, Path]], head3_fp: Union[str, Path] = "head3.lst",
+                 shifts: Dict[str, float] = None, chunk_size: int = CHUNK_SIZE, min_ess: float = MIN_ESS):
+        head3 = read_head3(head3_fp)
+        self.confname = head3["CONFORMER"]
+        self.nh = head3["nH"]
+        self.ne = head3["ne"]
+        self.shift = np.zeros(len(head3))
+        index = {name: i for i, name in enumerate(self.confname.tolist())}
+        for name, value in (shifts or {}).items():
+            if name not in index:
+                raise ValueError(f"Conformer {name} of the energy shifts is not in {head3_fp!s}")
+            self.shift[index[name]] = value
+        self.min_ess = min_ess
+
+        n_files = len(msout_fps)
+        self.T = None
+        self.conditions = np.zeros((n_files, 2))   # pH, eH of each file
+        self.bins = np.zeros((0, 3))                # sum(nH), sum(ne), shift of each bin
+        self._bin_index = {}
+        self.counts = np.zeros((n_files, 0))        # MC count (occupancy for ENUMERATE) of each file in each bin
+        self.exact = None                           # the files are ENUMERATE, set by the first file
+        self.conf_counts = None                     # count of each conformer in each bin, of each file for ENUMERATE
+        for k, msout_fp in enumerate(msout_fps):
+            self._add_file(k, Path(msout_fp), chunk_size)
+
+        self.f = self._solve_wham()
+
+    @property
+    def beta(self) -> float:
+        """1/kT in (kcal/mol)^-1 at the temperature of the msout files, as in monte.c."""
+        return KCAL2KT * ROOMT / self.T
+
+    def _columns(self, keys: np.ndarray) -> np.ndarray:
+        """Columns of the bins of keys (n, 3), adding the bins not seen before."""
+        new = [tuple(key) for key in keys.tolist() if tuple(key) not in self._bin_index]
+        if new:
+            for key in new:
+                self._bin_index[key] = len(self._bin_index)
+            self.bins = np.vstack([self.bins, np.array(new)])
+            self.counts = np.hstack([self.counts, np.zeros((self.counts.shape[0], len(new)))])
+            self.conf_counts = np.concatenate([self.conf_counts, np.zeros(self.conf_counts.shape[:2] + (len(new),))], axis=2)
+        return np.array([self._bin_index[tuple(key)] for key in keys.tolist()], dtype=np.int64)
+
+    def _add_file(self, k: int, msout_fp: Path, chunk_size: int):
+        if msout_fp.suffix == ARCHIVE_EXT:
+            archive = MsoutArchive(msout_fp)
+            header = archive.header
+            chunks = iter(archive)
+        else:
+            with open(msout_fp, "rb") as fh:
+                header = read_msout_header(fh)
+            chunks = iter_microstates(msout_fp, chunk_size=chunk_size)
+
+        if self.T is None:
+            self.T = header.T
+        elif abs(header.T - self.T) > 0.001:
+            raise ValueError(f"{msout_fp!s} was sampled at {header.T} K, not {self.T} K as the other files")
+        self.conditions[k] = header.pH, header.eH
+
+        # ENUMERATE files keep the conformer counts of each file, MC files add them up
+        n_conf = len(self.confname)
+        exact = header.method == "ENUMERATE"
+        if self.exact is None:
+            self.exact = exact
+            self.conf_counts = np.zeros((len(self.conditions) if exact else 1, n_conf, len(self.bins)))
+        elif exact != self.exact:
+            raise ValueError(f"{msout_fp!s} was sampled by {header.method}: "
+                             "ENUMERATE and Monte Carlo msout files can not be reweighted together")
+        layer = k if exact else 0
+
+        # fixed conformers are in every microstate of the file
+        fixed = header.fixed_confs
+        for chunk in chunks:
+            states = chunk.states
+            keys = np.column_stack([self.nh[states].sum(axis=1) + self.nh[fixed].sum(),
+                                    self.ne[states].sum(axis=1) + self.ne[fixed].sum(),
+                                    self.shift[states].sum(axis=1) + self.shift[fixed].sum()])
+            keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+            inverse = inverse.ravel()
+            n_keys = len(keys)
+            count = chunk.count.astype(np.float64)
+
+            key_counts = np.bincount(inverse, weights=count, minlength=n_keys)
+            flat = states * n_keys + inverse[:, None]
+            conf_counts = np.bincount(flat.ravel(), weights=np.repeat(count, states.shape[1]),
+                                      minlength=n_conf * n_keys).reshape(n_conf, n_keys)
+            conf_counts[fixed] += key_counts
+
+            columns = self._columns(keys)
+            self.counts[k, columns] += key_counts
+            self.conf_counts[layer][:, columns] += conf_counts
+
+        if msout_fp.suffix == ARCHIVE_EXT:
+            archive.close()
+        logger.debug(f"{msout_fp!s}: pH {header.pH:.2f}, eH {header.eH:.0f}, {self.counts[k].sum():,.0f} counts")
+
+    def _bias(self, pH: float, eH: float) -> np.ndarray:
+        """Reduced energy of each bin at a condition, less the part common to all bins."""
+        return self.beta * (PH2KCAL * pH * self.bins[:, 0] + EH2KCAL * eH * self.bins[:, 1])
+
+    def _solve_wham(self) -> np.ndarray:
+        """Free energy of each sampled condition, the first one at 0."""
+        if self.exact:
+            return np.zeros(len(self.conditions))   # not used, ENUMERATE files are reweighted one by one
+
+        n_total = self.counts.sum(axis=1)
+        log_n = np.log(n_total)
+        log_hist = np.log(self.counts.sum(axis=0))
+        bias = np.array([self._bias(pH, eH) for pH, eH in self.conditions])
+
+        f = np.zeros(len(n_total))
+        for _ in range(WHAM_MAXITER):
+            log_denom = _logsumexp(log_n[:, None] + f[:, None] - bias, axis=0)
+            f_new = -_logsumexp(log_hist[None, :] - bias - log_denom[None, :], axis=1)
+            f_new -= f_new[0]
+            if np.max(np.abs(f_new - f)) < WHAM_TOL:
+                return f_new
+            f = f_new
+
+        logger.warning(f"Multi-histogram equations did not converge in {WHAM_MAXITER} iterations")
+        return f
+
+    def _log_weights(self, pH: float, eH: float) -> np.ndarray:
+        """Log weight of one count in each bin at a condition."""
+        bias = np.array([self._bias(x, y) for x, y in self.conditions])
+        log_denom = _logsumexp(np.log(self.counts.sum(axis=1))[:, None] + self.f[:, None] - bias, axis=0)
+        return -self._bias(pH, eH) - self.beta * self.bins[:, 2] - log_denom
+
+    def occupancy(self, pH: float, eH: float) -> Tuple[np.ndarray, float]:
+        """Occupancy of each conformer in head3.lst at pH and eH, and the effective sample size:
+        the number of equally weighted MC counts that the reweighted counts are worth. MC counts are
+        correlated, so compare the ESS with that of the sampled conditions rather than read it as a
+        number of independent samples. The ESS of ENUMERATE files is infinite."""
+        if self.exact:
+            return self._exact_occupancy(pH, eH), np.inf
+
+        log_w = self._log_weights(pH, eH)
+        w = np.exp(log_w - log_w.max())
+        hist = self.counts.sum(axis=0)
+        total = np.sum(hist * w)
+        ess = total ** 2 / np.sum(hist * w ** 2)
+        return self.conf_counts[0] @ w / total, float(ess)
+
+    def _exact_occupancy(self, pH: float, eH: float) -> np.ndarray:
+        """Occupancy of each conformer at pH and eH, reweighted from the ENUMERATE file of the nearest
+        condition (1 pH unit = 58 mV). Microstates with occupancy below the 3 decimals of the file are
+        missing from it, the nearest condition misses the least."""
+        k = int(np.argmin(np.hypot(self.conditions[:, 0] - pH, (self.conditions[:, 1] - eH) / 58.0)))
+        hist = self.counts[k]
+        seen = hist > 0
+        log_w = self._bias(*self.conditions[k]) - self._bias(pH, eH) - self.beta * self.bins[:, 2]
+        w = np.exp(np.where(seen, log_w - log_w[seen].max(), -np.inf))
+        return self.conf_counts[k] @ w / np.sum(hist * w)
+
+    def titration(self, points: List[float], titr_type: str = "ph", other: float = None) -> Tuple[OccTable, np.ndarray]:
+        """Occupancies at pH points (titr_type "ph") or Eh points ("eh"), with the other condition at
+        `other`, by default the one of the first msout file. Return an OccTable and the ESS of each point."""
+        titr_type = titr_type.lower()
+        if other is None:
+            other = self.conditions[0, 1] if titr_type == "ph" else self.conditions[0, 0]
+
+        occ = np.zeros((len(self.confname), len(points)))
+        ess = np.zeros(len(points))
+        for i, point in enumerate(points):
+            pH, eH = (point, other) if titr_type == "ph" else (other, point)
+            occ[:, i], ess[i] = self.occupancy(pH, eH)
+            if ess[i] < self.min_ess:
+                logger.warning(f"{titr_type} {point:g}: effective sample size {ess[i]:,.0f} < {self.min_ess:,.0f}; "
+                               "the sampled microstates do not overlap this condition well, run MC at this point.")
+
+        fmt = "%.2f" if titr_type == "ph" else "%.0f"
+        labels = np.array([fmt % x for x in points])
+        return OccTable(titr_type, labels, np.array(points, dtype=float), self.confname, occ), ess
+
+
+def write_occ_table(fp: Union[str, Path], table: OccTable):
+    """Write an OccTable in the format of fort.38."""
+    lines = [" %-12s %s\n" % (table.titr_type, " ".join("%5s" % x for x in table.labels))]
+    for name, row in zip(table.confname.tolist(), table.occ):
+        lines.append(name + "".join(" %5.3f" % x for x in row) + "\n")
+    Path(fp).write_text("".join(lines))
+
+
+def cli_parser():
+    p = ArgumentParser(
+        prog="ms_reweight",
+        description="""Estimate fort.38 style occupancies at new pH or Eh points by reweighting the
+microstates sampled in ms_out/, without running Monte Carlo again. Files sampled at several
+conditions are combined (multi-histogram reweighting).""",
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+    p.add_argument("msout_files", nargs="+", type=Path,
+                   help="msout text files or .msz archives, e.g. ms_out/pH*eH*ms.txt")
+    p.add_argument("-points", nargs="+", type=float, required=True, help="New titration points.")
+    p.add_argument("-titr", choices=["ph", "eh"], default="ph", help="Titration type of the points; default: %(default)s.")
+    p.add_argument("-other", type=float, default=None,
+                   help="Eh of a pH titration, or pH of an Eh titration; default: that of the first file.")
+    p.add_argument("-shift", nargs="+", default=[], metavar="CONF=KCAL",
+                   help="Energy shift of conformers in kcal/mol at the new points, e.g. GLU-1A0035_002=1.0")
+    p.add_argument("-head3", type=Path, default=Path("head3.lst"), help="Conformer list; default: %(default)s.")
+    p.add_argument("-o", type=Path, default=Path("fort.38.reweighted"), help="Output file; default: %(default)s.")
+    p.add_argument("-min_ess", type=float, default=MIN_ESS,
+                   help="Warn for points with a smaller effective sample size; default: %(default)s.")
+    return p
+
+
+def ms_reweight_cli(argv=None):
+    """Cli function for the `ms_reweight` tool."""
+    logging.basicConfig(format="[ %(levelname)s ] %(message)s", level=logging.INFO)
+    args = cli_parser().parse_args(argv)
+
+    shifts = {}
+    for item in args.shift:
+        name, _, value = item.partition("=")
+        shifts[name] = float(value)
+
+    t0 = time.time()
+    rw = Reweighting(args.msout_files, args.head3, shifts=shifts, min_ess=args.min_ess)
+    t1 = time.time()
+    table, ess = rw.titration(args.points, titr_type=args.titr, other=args.other)
+    write_occ_table(args.o, table)
+    t2 = time.time()
+
+    logger.info(f"Read {len(args.msout_files)} msout file(s) into {len(rw.bins)} histogram bins in {t1 - t0:,.2f} s; "
+                f"reweighted {len(args.points)} point(s) in {t2 - t1:,.3f} s -> {args.o!s}")
+    if rw.exact:
+        logger.info("  ENUMERATE msout file(s): occupancies are exact, no effective sample size")
+    else:
+        for label, x in zip(table.labels, ess):
+            logger.info(f"  {args.titr} {label}: effective sample size {x:,.0f}")
+
+    return 0
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+
+"""
+Module: sas.py
+
+Solvent accessible surface (Shrake-Rupley) with a numpy cell list.
+
+An atom sphere, extended by the probe radius, is sampled by fibonacci sphere points;
+a point is buried when it falls inside the extended sphere of any other atom. This
+module is shared by:
+  * mcce4.mcce._rot_xposed: exposure of a conformer over the fixed protein background
+  * mcce4.mcce._strip_cofactors: layered stripping of surface cofactors
+  * bin/striph2o.py
+
+Usage:
+    grid = SAS_GRID(xyz, rad_ext)        # occluding atoms, e.g. the fixed background
+    sas = atom_sas(xyz, rad_ext, points, background=grid)
+"""
+
+import math
+
+import numpy as np
+
+
+DEFAULT_RAD = 1.8
+probe_rad = 1.4
+area_k = 4.0*math.pi
+
+radius = {" H": 1.2,
+          " C": 1.7,
+          " N": 1.55,
+          " O": 1.52,
+          " F": 1.47,
+          " P": 1.8,
+          " S": 1.8,
+          "CL": 1.75,
+          "CU": 1.4,
+          " B": 1.92,
+          "AL": 1.84,
+          "NA": 2.27,
+          "MG": 1.73,
+          "SI": 2.1,
+          "CA": 2.31,
+          " K": 2.75,
+          "FE": 1.63,
+          "ZN": 1.39,
+          "BR": 1.85
+}
+
+PAIR_CHUNK = 8192   # atom pairs tested against the sphere points at a time
+ALL_PAIRS = 4096    # below this number of query x grid pairs, all pairs are tested without the cell list
+
+
+def fibonacci_sphere(samples):
+
+    points = []
+    phi = math.pi * (3. - math.sqrt(5.))  # golden angle in radians
+
+    for i in range(samples):
+        y = 1 - (i / float(samples - 1)) * 2  # y goes from 1 to -1
+        radius = math.sqrt(1 - y * y)  # radius at y
+
+        theta = phi * i  # golden angle increment
+
+        x = math.cos(theta) * radius
+        z = math.sin(theta) * radius
+
+        points.append((x, y, z))
+
+    return points
+
+
+class SAS_GRID:
+    """Cell list of occluding spheres, given by centers xyz (n, 3) and extended radii rad_ext (n,).
+    """
+    def __init__(self, xyz, rad_ext):
+        self.xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        self.rad_ext = np.asarray(rad_ext, dtype=float).reshape(-1)
+        self.max_rad = self.rad_ext.max() if len(self.rad_ext) else 0.0
+        self.cell = max(2.0 * self.max_rad, 1.0)
+
+        if len(self.xyz):
+            self.origin = self.xyz.min(axis=0)
+            ijk = np.floor((self.xyz - self.origin) / self.cell).astype(int)
+            self.dims = ijk.max(axis=0) + 1
+            cell_id = np.ravel_multi_index(ijk.T, self.dims)
+            self.order = np.argsort(cell_id, kind="stable")     # atoms sorted by cell
+            self.counts = np.bincount(cell_id, minlength=np.prod(self.dims))
+            self.start = np.cumsum(self.counts) - self.counts
+
+    def pairs(self, xyz, rad_ext):
+        """Index pairs (i, j) of query spheres i and grid spheres j that overlap, sorted by i."""
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        rad_ext = np.asarray(rad_ext, dtype=float).reshape(-1)
+        if len(self.xyz) == 0 or len(xyz) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        if len(xyz) * len(self.xyz) <= ALL_PAIRS:
+            i, j = np.divmod(np.arange(len(xyz) * len(self.xyz)), len(self.xyz))
+            d2 = ((xyz[i] - self.xyz[j])**2).sum(axis=1)
+            overlap = d2 < (rad_ext[i] + self.rad_ext[j])**2
+            return i[overlap], j[overlap]
+
+        reach = int(math.ceil((rad_ext.max() + self.max_rad) / self.cell))
+        qijk = np.floor((xyz - self.origin) / self.cell).astype(int)
+        shifts = np.arange(-reach, reach + 1)
+        all_i = []
+        all_j = []
+        for dx in shifts:
+            for dy in shifts:
+                for dz in shifts:
+                    nijk = qijk + (dx, dy, dz)
+                    inside = np.all((nijk >= 0) & (nijk < self.dims), axis=1)
+                    i_query = np.flatnonzero(inside)
+                    cid = np.ravel_multi_index(nijk[inside].T, self.dims)
+                    n = self.counts[cid]
+                    total = n.sum()
+                    if total == 0:
+                        continue
+                    within = np.arange(total) - np.repeat(np.cumsum(n) - n, n)
+                    all_i.append(np.repeat(i_query, n))
+                    all_j.append(self.order[np.repeat(self.start[cid], n) + within])
+        if not all_i:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        i = np.concatenate(all_i)
+        j = np.concatenate(all_j)
+        d2 = ((xyz[i] - self.xyz[j])**2).sum(axis=1)
+        overlap = d2 < (rad_ext[i] + self.rad_ext[j])**2
+        i = i[overlap]
+        j = j[overlap]
+        order = np.argsort(i, kind="stable")
+        return i[order], j[order]
+
+    def buried(self, xyz, rad_ext, points, skip_self=False, ignore=None):
+        """Buried flags (n_atoms, n_points) of the sphere points of atoms xyz, rad_ext.
+        skip_self: the atoms are the grid atoms themselves, an atom does not bury its own points.
+        ignore: boolean mask of grid atoms that do not bury any point.
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        rad_ext = np.asarray(rad_ext, dtype=float).reshape(-1)
+        points = np.asarray(points, dtype=float).reshape(-1, 3)
+        buried = np.zeros((len(xyz), len(points)), dtype=bool)
+
+        i, j = self.pairs(xyz, rad_ext)
+        keep = np.ones(len(i), dtype=bool)
+        if skip_self:
+            keep &= i != j
+        if ignore is not None:
+            keep &= ~np.asarray(ignore, dtype=bool)[j]
+        i = i[keep]
+        j = j[keep]
+
+        for lo in range(0, len(i), PAIR_CHUNK):
+            ic = i[lo:lo+PAIR_CHUNK]
+            jc = j[lo:lo+PAIR_CHUNK]
+            sphere = points[np.newaxis, :, :] * rad_ext[ic, np.newaxis, np.newaxis] + xyz[ic, np.newaxis, :]
+            dd = ((sphere - self.xyz[jc, np.newaxis, :])**2).sum(axis=2)
+            hit = dd < (self.rad_ext[jc]**2)[:, np.newaxis]
+            # pairs are sorted by atom, so reduce each run of the same atom
+            first = np.flatnonzero(np.r_[True, ic[1:] != ic[:-1]])
+            buried[ic[first]] |= np.logical_or.reduceat(hit, first, axis=0)
+
+        return buried
+
+
+def exposed_points(xyz, rad_ext, points, background=None, ignore=None):
+    """Number of exposed sphere points of each atom. The atoms bury each other's points,
+    and the points are also buried by the SAS_GRID background, except by its ignore atoms.
+    """
+    buried = SAS_GRID(xyz, rad_ext).buried(xyz, rad_ext, points, skip_self=True)
+    if background is not None:
+        buried |= background.buried(xyz, rad_ext, points, ignore=ignore)
+    return len(points) - buried.sum(axis=1)
+
+
+def atom_sas(xyz, rad_ext, points, background=None, ignore=None):
+    """Solvent accessible surface of each atom, see exposed_points()."""
+    rad_ext = np.asarray(rad_ext, dtype=float).reshape(-1)
+    counter = exposed_points(xyz, rad_ext, points, background=background, ignore=ignore)
+    return area_k * rad_ext * rad_ext * counter / len(points)
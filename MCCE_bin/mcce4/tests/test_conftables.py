@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import os
+
+import numpy as np
+import pytest
+
+from mcce4.conftables import HEAD3_COLUMNS, HEAD3_OPTIONAL, _fixed_width_columns, read_fort38, read_head3
+
+
+HEAD3_HEADER = ("iConf CONFORMER     FL  occ    crg   Em0  pKa0 ne nH    vdw0    vdw1    tors    epol"
+                "   dsolv   extra    history\n")
+CONFORMERS = ["ASP01A0017_001", "ASP01A0017_002", "ASP-1A0017_003", "HOH01W0201_001", "HIS+1A0015_004"]
+
+
+def head3_line(i, flag=True, wide=False):
+    """A head3.lst line as make_matrices.c writes it; flag=False drops the trailing on/mark flag
+    of older files, wide=True widens vdw0 as a hand edited file may."""
+    rng = np.random.default_rng(i)
+    terms = " ".join("%7.3f" % x for x in rng.normal(0, 3, 6))
+    if wide:
+        terms = "%9.3f" % -1234.5 + terms[7:]
+    line = "%05d %s %c %4.2f %6.3f %5.0f %5.2f %2d %2d %s %10s" % (
+        i + 1, CONFORMERS[i % len(CONFORMERS)], "f", 0.0, rng.choice([-1, 0, 1]), 0, 4.75, 0, -1, terms,
+        "01O%03dM000" % i)
+    if flag:
+        line += " %c" % "tfd"[i % 3]
+    return line + "\n"
+
+
+def reference_head3(lines):
+    """Line by line parse: the fields of each line of 16 or more fields."""
+    rows = []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < len(HEAD3_COLUMNS) - HEAD3_OPTIONAL:
+            continue
+        fields = fields[:len(HEAD3_COLUMNS)] + [""] * (len(HEAD3_COLUMNS) - len(fields))
+        rows.append([dtype(x) if dtype is not np.float64 else float(x) for x, (_, dtype) in zip(fields, HEAD3_COLUMNS)])
+    return rows
+
+
+def check_head3(fp, lines, fixed_width):
+    """read_head3 of fp matches the reference parse, with and without the sidecar cache."""
+    fp.write_text(HEAD3_HEADER + "".join(lines))
+    body = fp.read_bytes()[len(HEAD3_HEADER):]
+    assert (_fixed_width_columns(body, len(HEAD3_COLUMNS), HEAD3_OPTIONAL) is not None) == fixed_width
+
+    reference = reference_head3(lines)
+    for use_cache in (False, True, True):  # parse, parse and write the sidecar, read the sidecar
+        head3 = read_head3(fp, use_cache=use_cache)
+        assert head3.dtype.names == tuple(name for name, _ in HEAD3_COLUMNS)
+        assert [list(row) for row in head3.tolist()] == reference
+    assert fp.with_name(fp.name + ".npz").is_file()
+    return head3
+
+
+class TestReadHead3:
+
+    def test_17_fields(self, tmp_path):
+        head3 = check_head3(tmp_path / "head3.lst", [head3_line(i) for i in range(12)], fixed_width=True)
+        assert head3["m"].tolist() == ["tfd"[i % 3] for i in range(12)]
+
+    def test_16_fields(self, tmp_path):
+        head3 = check_head3(tmp_path / "head3.lst", [head3_line(i, flag=False) for i in range(12)], fixed_width=True)
+        assert head3["m"].tolist() == [""] * 12
+
+    def test_uneven_widths(self, tmp_path):
+        """17 fields on every line, but not lined up: the whole file is split at once."""
+        lines = [head3_line(i, wide=(i == 5)) for i in range(12)]
+        check_head3(tmp_path / "head3.lst", lines, fixed_width=False)
+
+    def test_mixed_16_17_fields(self, tmp_path):
+        """Lines with and without the flag, a blank line and a truncated line, split line by line."""
+        lines = [head3_line(i, flag=(i % 2 == 0)) for i in range(12)]
+        lines.insert(4, "\n")
+        lines.insert(8, "00099 ASP01A0017_009 f 0.00\n")
+        head3 = check_head3(tmp_path / "head3.lst", lines, fixed_width=False)
+        assert len(head3) == 12
+        assert head3["m"].tolist() == ["tfd"[i % 3] if i % 2 == 0 else "" for i in range(12)]
+
+    def test_stale_sidecar(self, tmp_path):
+        fp = tmp_path / "head3.lst"
+        check_head3(fp, [head3_line(i) for i in range(6)], fixed_width=True)
+        fp.write_text(HEAD3_HEADER + "".join(head3_line(i) for i in range(4)))
+        os.utime(fp, ns=(fp.stat().st_atime_ns, fp.stat().st_mtime_ns + 1_000_000_000))
+        assert len(read_head3(fp)) == 4
+
+
+class TestReadFort38:
+
+    @pytest.mark.parametrize("occ_format", [" %5.3f", " %g"])  # lined up as mcce writes it, or not
+    def test_fort38(self, tmp_path, occ_format):
+        points = [0.0, 1.0, 2.0, 3.0]
+        rng = np.random.default_rng(0)
+        occ = rng.random((len(CONFORMERS), len(points))).round(3)
+        fp = tmp_path / "fort.38"
+        fp.write_text("ph   " + "".join("%6.1f" % x for x in points) + "\n"
+                      + "".join("%-14s" % name + "".join(occ_format % x for x in row) + "\n"
+                                for name, row in zip(CONFORMERS, occ)))
+
+        for use_cache in (False, True, True):
+            table = read_fort38(fp, use_cache=use_cache)
+            assert table.titr_type == "ph"
+            assert table.labels.tolist() == ["0.0", "1.0", "2.0", "3.0"]
+            assert table.points.tolist() == points
+            assert table.confname.tolist() == CONFORMERS
+            assert table.occ.tolist() == occ.tolist()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pytest
+
+from mcce4.msout import (MsoutArchive, _chunks_from_events, _iter_text_events, convert_msout,
+                         iter_microstates, read_msout_header)
+
+
+FREE_RESIDUES = [[0, 1], [4, 5, 6], [7, 8], [10, 11, 12, 13]]
+FIXED_CONFS = [2, 3, 9]
+
+
+def write_msout(fp, method, n_runs, n_per_run, seed, big_energy=False):
+    """Synthetic msout file: MC runs that start from a full state line, then microstates
+    that each flip a few conformers."""
+    rng = np.random.default_rng(seed)
+    lines = ["T:298.15,pH:7.00,eH:0.00",
+             "METHOD:%s" % method,
+             "#N_FIXED:FIXED_CONF_ID",
+             "%d:%s" % (len(FIXED_CONFS), " ".join(map(str, FIXED_CONFS))),
+             "#N_FREE residues:CONF_IDs for each free residues",
+             "%d:%s" % (len(FREE_RESIDUES), "".join("%s ;" % " ".join(map(str, x)) for x in FREE_RESIDUES)),
+             ]
+    for run in range(n_runs):
+        if method == "MONTERUNS":
+            lines += ["MC:%d" % run]
+        state = [int(rng.choice(x)) for x in FREE_RESIDUES]
+        lines += ["%d:%s" % (len(state), " ".join(map(str, state)))]
+        for i in range(n_per_run):
+            if i == n_per_run // 2:
+                lines += ["# comment in the body"]
+            flips = [int(rng.choice(FREE_RESIDUES[r])) for r in rng.choice(len(FREE_RESIDUES), rng.integers(0, 3))]
+            energy = np.float32(rng.normal(-20, 10))
+            if big_energy and i % 7 == 3:
+                energy = 123456.123456  # not exact in float32
+            if method == "ENUMERATE":
+                count = "%5.3f" % rng.random()
+            else:
+                count = "%d" % rng.integers(1, 500)
+            lines += [",".join(["%f" % energy, count] + [" ".join(map(str, flips))] * bool(flips))]
+    fp.write_text("\n".join(lines) + "\n")
+    return fp
+
+
+def reference_microstates(fp):
+    """Line by line parse of an msout file: run, state, energy and count of each microstate."""
+    res_of_conf = {conf: i for i, confs in enumerate(FREE_RESIDUES) for conf in confs}
+    run = 0
+    state = [-1] * len(FREE_RESIDUES)
+    rows = []
+    for line in fp.read_text().splitlines()[6:]:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("MC:"):
+            run = int(line[3:])
+        elif ":" in line:
+            for conf in map(int, line.split(":")[1].split()):
+                state[res_of_conf[conf]] = conf
+        else:
+            fields = line.split(",")
+            for conf in map(int, " ".join(fields[2:]).split()):
+                state[res_of_conf[conf]] = conf
+            rows.append((run, list(state), float(fields[0]), float(fields[1])))
+    return rows
+
+
+def assert_matches_reference(chunks, reference, chunk_size):
+    assert [chunk.index for chunk in chunks] == list(range(len(chunks)))
+    assert [chunk.start for chunk in chunks] == list(range(0, len(reference), chunk_size))
+    assert all(len(chunk.energy) == chunk_size for chunk in chunks[:-1])
+    mc = np.concatenate([chunk.mc for chunk in chunks])
+    states = np.concatenate([chunk.states for chunk in chunks])
+    energy = np.concatenate([chunk.energy for chunk in chunks])
+    count = np.concatenate([chunk.count for chunk in chunks])
+    assert mc.tolist() == [row[0] for row in reference]
+    assert states.tolist() == [row[1] for row in reference]
+    assert energy.tolist() == [row[2] for row in reference]  # exact, as written in the file
+    assert count.tolist() == [row[3] for row in reference]
+
+
+@pytest.fixture(params=["MONTERUNS", "ENUMERATE"])
+def msout_file(request, tmp_path):
+    if request.param == "MONTERUNS":
+        return write_msout(tmp_path / "pH7.00eH0.00ms.txt", "MONTERUNS", n_runs=3, n_per_run=40, seed=1)
+    return write_msout(tmp_path / "pH7.00eH0.00ms.txt", "ENUMERATE", n_runs=1, n_per_run=90, seed=2,
+                       big_energy=True)
+
+
+def test_header(msout_file):
+    with open(msout_file, "rb") as fh:
+        header = read_msout_header(fh)
+    assert (header.T, header.pH, header.eH) == (298.15, 7.0, 0.0)
+    assert header.fixed_confs.tolist() == FIXED_CONFS
+    assert [x.tolist() for x in header.free_residues] == FREE_RESIDUES
+    assert header.n_free == len(FREE_RESIDUES)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 50, 1000])
+def test_iter_microstates(msout_file, chunk_size):
+    reference = reference_microstates(msout_file)
+    chunks = list(iter_microstates(msout_file, chunk_size=chunk_size))
+    assert_matches_reference(chunks, reference, chunk_size)
+
+
+@pytest.mark.parametrize("block_size", [1, 13, 64])
+def test_small_blocks(msout_file, block_size):
+    """Blocks that cut lines, and full state lines, anywhere."""
+    reference = reference_microstates(msout_file)
+    with open(msout_file, "rb") as fh:
+        header = read_msout_header(fh)
+        chunks = list(_chunks_from_events(_iter_text_events(fh, header, 5, block_size=block_size), header))
+    assert_matches_reference(chunks, reference, 5)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 16, 1000])
+def test_archive_round_trip(msout_file, chunk_size):
+    archive_fp = convert_msout(msout_file, chunk_size=chunk_size)
+    assert archive_fp == msout_file.with_suffix(".msz")
+    archive = MsoutArchive(archive_fp)
+
+    with open(msout_file, "rb") as fh:
+        header = read_msout_header(fh)
+    assert (archive.header.T, archive.header.pH, archive.header.eH) == (header.T, header.pH, header.eH)
+    assert archive.header.method == header.method
+    assert archive.header.fixed_confs.tolist() == header.fixed_confs.tolist()
+    assert [x.tolist() for x in archive.header.free_residues] == FREE_RESIDUES
+
+    reference = reference_microstates(msout_file)
+    assert archive.chunk_size == chunk_size
+    assert archive.n_microstates == len(reference)
+    assert len(archive) == archive.n_chunks == -(-len(reference) // chunk_size)
+    assert_matches_reference(list(archive), reference, chunk_size)
+
+    # random access, last chunk first
+    text_chunks = list(iter_microstates(msout_file, chunk_size=chunk_size))
+    for index in (archive.n_chunks - 1, 0, archive.n_chunks // 2):
+        chunk = archive.chunk(index)
+        assert chunk.start == text_chunks[index].start
+        assert chunk.states.tolist() == text_chunks[index].states.tolist()
+        assert chunk.energy.tolist() == text_chunks[index].energy.tolist()
+    with pytest.raises(IndexError):
+        archive.chunk(archive.n_chunks)
+    archive.close()
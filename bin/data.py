@@ -2,7 +2,12 @@
 """ PyMCCE data structure """
 import sys
 import os.path
+import hashlib
 import numpy as np
+from scipy.sparse import csr_matrix, coo_matrix
+
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4.conftables import read_head3
 
 ROOMT = 298.15
 PH2KCAL = 1.364
@@ -22,6 +27,7 @@ class Env:
         self.fn_conflist2 = "head2.lst"
         self.fn_conflist3 = "head3.lst"
         self.energy_table = "energies"
+        self.pairwise_cache = "energies.pairwise"  # memory mapped CSR copy of the pairwise table
         # run.prm parameters key:value
         self.tpl = {}
         # tpl parameters (key1, key2, key3):value
@@ -197,38 +203,96 @@ class Conformer:
 
 
 def load_head3lst():
-    conformers = []
-    fname = env.fn_conflist3
-    lines = open(fname).readlines()
-    lines.pop(0)
-    for line in lines:
-        fields = line.split()
-        if len(fields) >= 16:
-            conf = Conformer(fields)
-            conformers.append(conf)
-
-    confnames = [x.confname for x in conformers]
-    for name in confnames:
+    conformers = [Conformer(fields) for fields in read_head3(env.fn_conflist3).tolist()]
+
+    occurrence = {}
+    for conf in conformers:
+        name = conf.confname
         if len(name) != 14:
-            print("%s is not a conformer name.")
+            print("%s is not a conformer name." % name)
             sys.exit()
-        occurrence = confnames.count(name)
-        if occurrence > 1:
-            print("Conformer %s occurred %d times" % occurrence)
+        occurrence[name] = occurrence.get(name, 0) + 1
+    for name, count in occurrence.items():
+        if count > 1:
+            print("Conformer %s occurred %d times" % (name, count))
             sys.exit()
 
     return conformers
 
+def pairwise_cache_key(confnames, scale_ele, scale_vdw):
+    """A digest of everything the pairwise matrix depends on: conformer list, scaling factors and the
+    size and modification time of each .opp file. Any change of an .opp file changes the key.
+    """
+    digest = hashlib.sha1()
+    digest.update(("%r %r\n" % (scale_ele, scale_vdw)).encode())
+    for confname in confnames:
+        oppfile = "%s/%s.opp" % (env.energy_table, confname)
+        try:
+            stat = os.stat(oppfile)
+            digest.update(("%s %d %d\n" % (confname, stat.st_size, stat.st_mtime_ns)).encode())
+        except FileNotFoundError:
+            digest.update(("%s -\n" % confname).encode())
+    return digest.hexdigest()
+
+
+def read_pairwise_cache(key, n_conf):
+    """Memory map the CSR arrays of the cached pairwise matrix, None if the cache is missing or stale."""
+    folder = env.pairwise_cache
+    fname_key = "%s/key" % folder
+    if not os.path.isfile(fname_key) or open(fname_key).read().strip() != key:
+        return None
+    try:
+        data = np.load("%s/data.npy" % folder, mmap_mode="r")
+        indices = np.load("%s/indices.npy" % folder, mmap_mode="r")
+        indptr = np.load("%s/indptr.npy" % folder, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if indptr.shape[0] != n_conf + 1:
+        return None
+    return csr_matrix((data, indices, indptr), shape=(n_conf, n_conf), copy=False)
+
+
+def write_pairwise_cache(key, pw):
+    """Save the CSR arrays of pw as .npy files. The key is written last, so an interrupted write
+    leaves a cache that is ignored.
+    """
+    folder = env.pairwise_cache
+    try:
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fname_key = "%s/key" % folder
+        if os.path.isfile(fname_key):
+            os.remove(fname_key)
+        for name in ["data", "indices", "indptr"]:
+            np.save("%s/%s.npy" % (folder, name), getattr(pw, name))
+        open(fname_key, "w").write(key + "\n")
+    except OSError as e:
+        print("      Warning: can not write pairwise cache %s: %s" % (folder, e))
+
+
 def load_pairwise():
+    """Pairwise interaction between conformers as a symmetric CSR sparse matrix, ele and vdw scaled and
+    the two directions averaged. The matrix is cached in env.pairwise_cache and read back memory mapped
+    as long as no .opp file has changed.
+    """
     folder = env.energy_table
     n_conf = len(head3lst)
     confnames = [x.confname for x in head3lst]
+    conf_index = {name: i for i, name in enumerate(confnames)}
     scale_ele = env.tpl[("SCALING", "ELE")]
     scale_vdw = env.tpl[("SCALING", "VDW")]
-    pw = np.zeros(shape=(n_conf, n_conf))
+
+    key = pairwise_cache_key(confnames, scale_ele, scale_vdw)
+    pw = read_pairwise_cache(key, n_conf)
+    if pw is not None:
+        return pw
+
+    rows = []
+    cols = []
+    ele = []
+    vdw = []
     for ic in range(n_conf):
-        conf = head3lst[ic]
-        oppfile = "%s/%s.opp" % (folder, conf.confname)
+        oppfile = "%s/%s.opp" % (folder, confnames[ic])
         if os.path.isfile(oppfile):
             lines = open(oppfile)
             for line in lines:
@@ -236,22 +300,30 @@ def load_pairwise():
                 if len(fields) < 6:
                     continue
                 confname = fields[1]
-                jc = confnames.index(confname)
-                if jc < 0:
+                jc = conf_index.get(confname)
+                if jc is None:
                     print("      Warning: %s in file %s is not a conformer" % (confname, oppfile))
                     continue
-                ele = float(fields[2])
-                vdw = float(fields[3])
-                pw[ic][jc] = ele * scale_ele + vdw * scale_vdw
-
-    # average the opposite sides
-    for ic in range(n_conf-1):
-        for jc in range(ic+1, n_conf):
-            #if abs(pw[ic][jc] - pw[jc][ic]) > 0.000001:
-            #    print("%s %.3f <-> %s %.3f" % (confnames[ic], pw[ic][jc], confnames[jc], pw[jc][ic]))
-            averaged_pw = (pw[ic][jc] + pw[jc][ic]) * 0.5
-            pw[ic][jc] = pw[jc][ic] = averaged_pw
-
+                rows.append(ic)
+                cols.append(jc)
+                ele.append(fields[2])
+                vdw.append(fields[3])
+
+    rows = np.array(rows, dtype=np.int64)
+    cols = np.array(cols, dtype=np.int64)
+    values = np.array(ele, dtype=float) * scale_ele + np.array(vdw, dtype=float) * scale_vdw
+
+    # a pair listed twice in one file keeps the last entry
+    pair = rows * n_conf + cols
+    _, last = np.unique(pair[::-1], return_index=True)
+    keep = len(pair) - 1 - last
+    one_side = coo_matrix((values[keep], (rows[keep], cols[keep])), shape=(n_conf, n_conf)).tocsr()
+
+    # average the opposite sides, a side not in the .opp files counts as 0
+    pw = ((one_side + one_side.T) * 0.5).tocsr()
+    pw.sort_indices()
+
+    write_pairwise_cache(key, pw)
     return pw
 
 env = Env()
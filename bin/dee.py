@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Module: dee.py
+
+Dead-end elimination (DEE) of conformers before Monte Carlo sampling of step 4.
+
+A free conformer r is eliminated by a competitor t of the same residue when, by the Goldstein
+criterion, swapping r for t lowers the energy of every microstate by more than a margin:
+    E_self(r) - E_self(t) + sum over other residues j of min over conformers s of j (E(r,s) - E(t,s)) > margin
+Then the occupancy of r is at most exp(-margin/kT) times that of t, at any point where the criterion
+holds. Self energies include the pH and Eh effect and the mean field of fixed conformers, as in
+monte.py; the pH and Eh effect is linear, so the criterion holds over a titration range when it
+holds at both ends. The elimination is repeated until no more conformers are eliminated.
+
+Entropy correction (MONTE_TSX) is not part of the criterion.
+
+Input:
+ * run.prm, head3.lst, energies/*.opp and the EXTRA file (read by data.py)
+
+Output:
+ * dee.out, the eliminated conformers, their competitor and energy gap
+ * dee/head3.lst, dee/energies/*.opp and dee/run.prm: the conformer space without the eliminated
+   conformers, renumbered, for step 4
+
+Usage examples:
+
+1. Eliminate conformers over the titration range in run.prm, with the default margin
+    dee.py
+
+2. Eliminate conformers between pH 5 and pH 9 with a margin of 3 kcal/mol, write to folder reduced
+    dee.py -r 5 9 -m 3 -o reduced
+"""
+
+import argparse
+import time
+from data import *
+from monte import group_residues, verify_flags, titration_points, runprm_value
+
+KCAL2KT = 1.688
+DEE_MARGIN = 5.0          # kcal/mol, bounds the occupancy of an eliminated conformer to 2e-4 at room temperature
+DEE_BLOCK = 1 << 24       # pair differences evaluated at a time
+fname_report = "dee.out"
+folder_reduced = "dee"
+
+
+def range_self_energy(fixed, occ, t_range):
+    """Self energy of each conformer at the two ends of the titration range, shape (n_conf, 2),
+    with the pH and Eh effect and the mean field of the fixed conformers.
+    """
+    points = titration_points()
+    titr_type = env.runprm.get("TITR_TYPE", "ph").lower()
+    if t_range is None:
+        ends = [points[0], points[-1]]
+    elif titr_type == "ph":
+        ends = [(x, points[0][1]) for x in t_range]
+    else:
+        ends = [(points[0][0], x) for x in t_range]
+
+    E_self_conf = np.array([conf.vdw0 + conf.vdw1 + conf.epol + conf.tors + conf.dsolv + conf.extra for conf in head3lst])
+    nh = np.array([conf.nh for conf in head3lst])
+    ne = np.array([conf.ne for conf in head3lst])
+    pk0 = np.array([conf.pk0 for conf in head3lst])
+    em0 = np.array([conf.em0 for conf in head3lst])
+    mfe_fixed = pairwise @ np.where(fixed, occ, 0.0)
+
+    E_self = np.zeros((len(head3lst), 2))
+    for i, (ph, eh) in enumerate(ends):
+        E_self[:, i] = E_self_conf + nh * (ph - pk0) * PH2KCAL + ne * (eh - em0) * PH2KCAL / 58.0 + mfe_fixed
+    return E_self, ends
+
+
+def dead_end_elimination(residues, fixed, E_self, margin):
+    """Goldstein elimination of free conformers over the range of E_self (n_conf, 2).
+    Return a dict of eliminated conformer: (competitor, energy gap), and the number of sweeps.
+    """
+    free_res = [res[~fixed[res]] for res in residues if (~fixed[res]).sum() > 1]
+    if not free_res:
+        return {}, 0
+    confs = np.concatenate(free_res)
+    res_of = np.concatenate([np.full(len(x), ir) for ir, x in enumerate(free_res)])
+    first = np.cumsum([len(x) for x in free_res]) - np.array([len(x) for x in free_res])
+    pw = pairwise[confs][:, confs].toarray()
+    for ir, res in enumerate(free_res):  # conformers of the same residue never interact
+        pw[first[ir]:first[ir] + len(res), first[ir]:first[ir] + len(res)] = 0.0
+
+    alive = np.ones(len(confs), dtype=bool)
+    eliminated = {}
+    n_sweep = 0
+    while True:
+        n_sweep += 1
+        cols = np.flatnonzero(alive)
+        starts = np.flatnonzero(np.diff(res_of[cols], prepend=-1))  # alive conformers of each residue
+        newly = []
+        for ir in range(len(free_res)):
+            rows = cols[res_of[cols] == ir]
+            if len(rows) < 2:
+                continue
+            P = pw[rows][:, cols]
+            d_self = E_self[confs[rows]]
+            block = max(1, DEE_BLOCK // (len(rows) * len(cols)))
+            for lo in range(0, len(rows), block):
+                hi = min(lo + block, len(rows))
+                # gap[r, t]: least energy change of swapping r for t over the range and all microstates
+                pair_min = np.minimum.reduceat(P[lo:hi, None, :] - P[None, :, :], starts, axis=2).sum(axis=2)
+                gap = (d_self[lo:hi, None, :] - d_self[None, :, :]).min(axis=2) + pair_min
+                gap[np.arange(hi - lo), np.arange(lo, hi)] = -np.inf
+                best = gap.argmax(axis=1)
+                for k in np.flatnonzero(gap[np.arange(hi - lo), best] > margin):
+                    newly.append(rows[lo + k])
+                    eliminated[confs[rows[lo + k]]] = (confs[rows[best[k]]], gap[k, best[k]])
+        if not newly:
+            break
+        alive[newly] = False
+
+    return eliminated, n_sweep
+
+
+def write_report(fname, eliminated, n_free, margin, T, ends, n_sweep):
+    occ_bound = np.exp(-margin * KCAL2KT * ROOMT / T)
+    lines = ["# Dead-end elimination, Goldstein criterion\n",
+             "# titration range: pH %.2f Eh %.0f to pH %.2f Eh %.0f\n" % (ends[0][0], ends[0][1], ends[1][0], ends[1][1]),
+             "# energy margin: %.2f kcal/mol, occupancy bound of eliminated conformers: %.1e at %.2f K\n"
+             % (margin, occ_bound, T),
+             "# eliminated %d of %d free conformers (%.1f%%) in %d sweeps\n"
+             % (len(eliminated), n_free, 100.0 * len(eliminated) / max(n_free, 1), n_sweep),
+             "# conformer     competitor      gap(kcal)\n"]
+    for ic in sorted(eliminated):
+        jc, gap = eliminated[ic]
+        lines.append("%s %s %9.3f\n" % (head3lst[ic].confname, head3lst[jc].confname, gap))
+    open(fname, "w").writelines(lines)
+
+
+def write_reduced(folder, eliminated):
+    """Write head3.lst and the .opp files without the eliminated conformers, and run.prm, to folder.
+    Conformers are renumbered, and the serial in field 0 of the .opp lines follows, as mcce looks up
+    the interaction partner by this serial. Relative file paths in run.prm are made absolute.
+    """
+    removed = set(head3lst[ic].confname for ic in eliminated)
+    energy_folder = "%s/%s" % (folder, os.path.basename(env.energy_table))
+    if not os.path.isdir(energy_folder):
+        os.makedirs(energy_folder)
+
+    lines = open(env.fn_conflist3).readlines()
+    out = [lines[0]]
+    new_iconf = {}
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) < 2 or fields[1] in removed:
+            continue
+        new_iconf[fields[1]] = len(new_iconf) + 1
+        out.append("%05d%s" % (new_iconf[fields[1]], line[line.find(fields[0]) + len(fields[0]):]))
+    open("%s/%s" % (folder, os.path.basename(env.fn_conflist3)), "w").writelines(out)
+
+    for conf in head3lst:
+        oppfile = "%s/%s.opp" % (env.energy_table, conf.confname)
+        if conf.confname in removed or not os.path.isfile(oppfile):
+            continue
+        kept = []
+        for line in open(oppfile):
+            fields = line.split()
+            if len(fields) < 2 or fields[1] not in new_iconf:
+                if len(fields) < 2 or fields[1] not in removed:
+                    kept.append(line)
+                continue
+            kept.append("%05d%s" % (new_iconf[fields[1]], line[line.find(fields[0]) + len(fields[0]):]))
+        open("%s/%s.opp" % (energy_folder, conf.confname), "w").writelines(kept)
+
+    lines = []
+    written = [os.path.basename(env.fn_conflist3), os.path.basename(env.energy_table)]
+    for line in open(env.fn_runprm):
+        fields = line.split()
+        if fields and line.rfind("(") > 0 and not os.path.isabs(fields[0]) and os.path.exists(fields[0]) \
+                and os.path.basename(os.path.normpath(fields[0])) not in written:
+            start = line.find(fields[0])
+            line = line[:start] + os.path.abspath(fields[0]) + line[start + len(fields[0]):]
+        lines.append(line)
+    open("%s/%s" % (folder, os.path.basename(env.fn_runprm)), "w").writelines(lines)
+
+
+if __name__ == "__main__":
+    helpmsg = "Eliminate conformers that can not be significantly occupied over a titration range (dead-end " \
+              "elimination), and write the reduced conformer space for step 4."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("-r", metavar=("start", "end"), nargs=2, type=float, default=None,
+                        help="titration range, pH or Eh as TITR_TYPE; default: the titration points in run.prm")
+    parser.add_argument("-m", metavar="margin", type=float, default=DEE_MARGIN,
+                        help="energy margin in kcal/mol of the elimination; default: %(default)s")
+    parser.add_argument("-o", metavar="folder", default=folder_reduced,
+                        help="folder of the reduced head3.lst and energies; default: %(default)s")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    residues = group_residues()
+    print("Verifying conformer flags ...")
+    fixed, occ = verify_flags(residues)
+    E_self, ends = range_self_energy(fixed, occ, args.r)
+    eliminated, n_sweep = dead_end_elimination(residues, fixed, E_self, args.m)
+
+    n_free = sum([(~fixed[res]).sum() for res in residues if (~fixed[res]).sum() > 1])
+    T = runprm_value("MONTE_T", ROOMT)
+    write_report(fname_report, eliminated, n_free, args.m, T, ends, n_sweep)
+    write_reduced(args.o, eliminated)
+    print("Eliminated %d of %d free conformers (%.1f%%) with a margin of %.2f kcal/mol in %.1f seconds."
+          % (len(eliminated), n_free, 100.0 * len(eliminated) / max(n_free, 1), args.m, time.time() - t0))
+    print("Eliminated conformers are listed in %s, the reduced head3.lst and energies are in %s/." % (fname_report, args.o))
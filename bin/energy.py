@@ -1,8 +1,86 @@
 #!/usr/bin/env python
 
+import time
+import argparse
 from data import *
 
 PW_PRINT_CUT = 0.001
+STATE_CHUNK_SIZE = 1 << 22  # array elements per chunk of states in state_energies()
+DENSE_PAIRWISE_MAX = 1 << 24  # largest dense pairwise submatrix state_energies() makes, in elements
+
+
+def conformer_self_energy(ph=7.0, eh=0.0, T=ROOMT):
+    """Self energy of every conformer in head3.lst times its occupancy, and the occupancy, as
+    analyze_state_energy() computes them. Occupancy is conf.occ for fixed conformers and 1.0 otherwise.
+    """
+    fields = np.array([(conf.nh, conf.pk0, conf.ne, conf.em0, conf.vdw0, conf.vdw1, conf.epol, conf.tors,
+                        conf.dsolv, conf.extra, conf.entropy) for conf in head3lst], dtype=float).reshape(-1, 11)
+    nh, pk0, ne, em0 = fields[:, 0], fields[:, 1], fields[:, 2], fields[:, 3]
+    E_ph = T / ROOMT * nh * (ph - pk0) * PH2KCAL
+    E_eh = T / ROOMT * ne * (eh - em0) * PH2KCAL / 58.0
+    occ = np.array([conf.occ if conf.flag.upper() == "T" else 1.0 for conf in head3lst])
+
+    return occ * (E_eh + E_ph + fields[:, 4:].sum(axis=1)), occ
+
+
+def sparse_pair_lookup(used, occ):
+    """Function that returns the occupancy weighted pairwise energy of conformer pairs (a, b),
+    given as indices into used, by a binary search of the sorted sparse entries of pairwise.
+    """
+    n_used = len(used)
+    sub = pairwise[used][:, used].tocoo()
+    keys = sub.row.astype(np.int64) * n_used + sub.col
+    order = np.argsort(keys)
+    keys = np.append(keys[order], -1)  # sentinel for keys past the last entry
+    values = np.append((sub.data * occ[used][sub.row] * occ[used][sub.col])[order], 0.0)
+
+    def lookup(a, b):
+        query = a.astype(np.int64) * n_used + b
+        found = np.searchsorted(keys[:-1], query)
+        return np.where(keys[found] == query, values[found], 0.0)
+
+    return lookup
+
+
+def state_energies(states, ph=7.0, eh=0.0, T=ROOMT, chunk_size=STATE_CHUNK_SIZE):
+    """Self and pairwise energy of many microstates at once.
+    states is an (M, n_res) integer array, each row the conformer index (in head3.lst) selected in
+    each residue. Return arrays E_self and E_pw of length M, the totals analyze_state_energy() reports
+    for each state. States are evaluated in chunks of about chunk_size array elements to bound memory.
+    """
+    states = np.asarray(states)
+    if states.ndim != 2:
+        raise ValueError("states must be an (M, n_res) array, got shape %s" % str(states.shape))
+    n_states, n_res = states.shape
+    E_conf, occ = conformer_self_energy(ph, eh, T)
+    E_self = E_conf[states].sum(axis=1)
+
+    used, local = np.unique(states, return_inverse=True)
+    local = local.reshape(states.shape)
+    n_used = len(used)
+    E_pw = np.zeros(n_states)
+    if n_used * n_used <= DENSE_PAIRWISE_MAX:
+        # Row i of selected @ pw is the interaction of every used conformer with state i, the
+        # selected conformers of the state are then gathered from it. Pairs are counted twice.
+        pw = pairwise[used][:, used].toarray() * np.outer(occ[used], occ[used])
+        n_rows = max(1, chunk_size // n_used)
+        for start in range(0, n_states, n_rows):
+            block = local[start:start + n_rows]
+            selected = np.zeros((len(block), n_used))
+            np.put_along_axis(selected, block, 1.0, axis=1)
+            E_pw[start:start + n_rows] = 0.5 * np.take_along_axis(selected @ pw, block, axis=1).sum(axis=1)
+    else:
+        # each pair is counted once, the interaction of a conformer with itself half
+        pair_energy = sparse_pair_lookup(used, occ)
+        ia, ib = np.triu_indices(n_res, 1)
+        n_rows = max(1, chunk_size // (len(ia) + n_res))
+        for start in range(0, n_states, n_rows):
+            block = local[start:start + n_rows]
+            E_pw[start:start + n_rows] = pair_energy(block[:, ia], block[:, ib]).sum(axis=1) + \
+                                         0.5 * pair_energy(block, block).sum(axis=1)
+
+    return E_self, E_pw
+
 
 def analyze_state_energy(state, ph=7.0, eh=0.0, T=ROOMT, cutoff = PW_PRINT_CUT):
     print("Environment: pH = %.2f  eh = %.f  Temperature = %.2f K" % (ph, eh, T))
@@ -45,7 +123,7 @@ def analyze_state_energy(state, ph=7.0, eh=0.0, T=ROOMT, cutoff = PW_PRINT_CUT):
     E_pw = 0.0
     for ic in state:
         for jc in state:
-            E_pw_icjc = pairwise[ic][jc] * moving_occ[ic] * moving_occ[jc]
+            E_pw_icjc = pairwise[ic, jc] * moving_occ[ic] * moving_occ[jc]
             E_pw += E_pw_icjc * 0.5    # This is because the interaction will be counted twice A <- B, B <- A
             if abs(E_pw_icjc) > cutoff:
                 print("%s <- %s: %5.2f" % (head3lst[ic].confname, head3lst[jc].confname, E_pw_icjc))
@@ -56,3 +134,52 @@ def analyze_state_energy(state, ph=7.0, eh=0.0, T=ROOMT, cutoff = PW_PRINT_CUT):
 
     print("\n")
     return
+
+
+def random_states(n_states, seed=None):
+    """n_states random microstates, one conformer selected in each residue of head3.lst."""
+    residues = {}
+    for ic, conf in enumerate(head3lst):
+        residues.setdefault(conf.confname[:3] + conf.confname[5:11], []).append(ic)
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.choice(np.array(res), size=n_states) for res in residues.values()])
+
+
+def loop_state_energy(state, E_conf, occ):
+    """State energy by the loops of analyze_state_energy(), without printing.
+    E_conf and occ are the conformer self energies and occupancies from conformer_self_energy().
+    """
+    E_pw = 0.0
+    for ic in state:
+        for jc in state:
+            E_pw += pairwise[ic, jc] * occ[ic] * occ[jc] * 0.5
+    return E_conf[state].sum() + E_pw
+
+
+if __name__ == "__main__":
+    helpmsg = "Evaluate the energy of random microstates in batch and report the throughput. " \
+              "Run in a folder with head3.lst and energies/."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("-n", metavar="states", default=100000, type=int, help="number of random microstates, default 100000")
+    parser.add_argument("-ph", metavar="pH", default=7.0, type=float, help="pH, default 7.0")
+    parser.add_argument("-eh", metavar="Eh", default=0.0, type=float, help="Eh in mV, default 0.0")
+    parser.add_argument("-c", metavar="states", default=100, type=int, help="states checked against the loop evaluation, default 100")
+    parser.add_argument("-s", metavar="seed", default=None, type=int, help="random seed")
+    args = parser.parse_args()
+
+    states = random_states(args.n, args.s)
+    print("Microstates: %d, residues: %d, conformers: %d" % (states.shape[0], states.shape[1], len(head3lst)))
+
+    t0 = time.time()
+    E_self, E_pw = state_energies(states, ph=args.ph, eh=args.eh)
+    seconds = time.time() - t0
+    print("Batch evaluation: %.3f seconds, %.0f states/second" % (seconds, args.n / seconds))
+
+    n_check = min(args.c, args.n)
+    if n_check > 0:
+        t0 = time.time()
+        E_conf, occ = conformer_self_energy(ph=args.ph, eh=args.eh)
+        E_loop = np.array([loop_state_energy(state, E_conf, occ) for state in states[:n_check]])
+        seconds = time.time() - t0
+        print("Loop evaluation:  %.3f seconds, %.0f states/second" % (seconds, n_check / seconds))
+        print("Largest difference over %d states: %.3g kCal/mol" % (n_check, np.max(np.abs(E_self[:n_check] + E_pw[:n_check] - E_loop))))
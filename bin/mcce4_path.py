@@ -0,0 +1,15 @@
+"""Put MCCE_bin on the python path, so that the scripts in bin/ can import the mcce4 package.
+
+Import this module before importing mcce4:
+    import mcce4_path  # noqa: F401
+    from mcce4.conftables import read_head3
+"""
+
+import importlib.util
+import os
+import sys
+
+MCCE_BIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "MCCE_bin")
+
+if importlib.util.find_spec("mcce4") is None:   # MCCE_bin is not on the python path when called from bin/
+    sys.path.append(MCCE_BIN)
@@ -7,13 +7,13 @@ record_file = "run.prm.record"
 backup_file = "run.prm.backup~"
 
 # write the entries to file run.prm
-def export_runprm(runprm):
+def export_runprm(runprm, fname="run.prm"):
 
     lines = ["# WARRPER GENERATED run.prm at %s\n" % datetime.now().strftime("%Y/%m%d, %H:%M:%S")]
     for key in runprm:
         line = "%-20s    (%s)\n" % (runprm[key], key)
         lines.append(line)
-    open("run.prm", "w").writelines(lines)
+    open(fname, "w").writelines(lines)
     return
 
 # update the step section with new entries to run.prm.recorded
@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+"""
+Module: mfe.py
+
+Mean field energy (mfe) analysis: break down the ionization energy of residues into energy terms
+and the interactions with other residues, at a titration point.
+
+This is tools_c/mfe/mfe.py in Python 3. The old program computed one residue with loops over
+conformers. Here all residues and titration points are computed together with occupancy weighted
+sparse matrix products, and the table of each residue is printed as the old program did.
+
+Input:
+ * run.prm
+ * head3.lst
+ * fort.38
+ * pK.out
+ * energies/
+
+Usage examples:
+
+1. Break down the ionization energy of all residues in pK.out at pH 7
+    mfe.py -p 7
+
+2. Break down GLU-A0035_ and ASP-A0052_ at pH 7.5, print residues with more than 0.1 pH unit
+    mfe.py -p 7.5 -c 0.1 GLU-A0035_ ASP-A0052_
+"""
+
+import os
+import sys
+import argparse
+import numpy as np
+from scipy.sparse import csr_matrix, diags
+from data import *
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4 import conftables
+
+MEV2KCAL = 0.0235
+KCAL2KT = 1.688
+fname_occ_table = "fort.38"
+fname_pkout = "pK.out"
+terms = ["vdw0", "vdw1", "tors", "epol", "dsolv", "extra", "pHeffect", "Eheffect", "TS", "mfe_total", "G"]
+
+
+def read_fort38():
+    """Titration type ('pH' or 'Eh'), titration points and the occupancy table of head3.lst conformers."""
+    table = conftables.read_fort38(fname_occ_table)
+    titr_type = "Eh" if table.titr_type.upper() == "EH" else "pH"
+
+    occ = np.zeros((len(head3lst), len(table.points)))
+    for ic, confname in enumerate(table.confname.tolist()):
+        if ic >= len(head3lst) or confname != head3lst[ic].confname:
+            print("ERROR, %s in fort.38 doesn't match head3.lst" % confname)
+            sys.exit()
+    occ[:len(table.occ)] = table.occ
+
+    return titr_type, table.points, occ
+
+
+def read_pkout():
+    """pKa/Em text of each residue in pK.out, in the order of the file."""
+    pkas = {}
+    for line in open(fname_pkout).readlines()[1:]:
+        if line.strip():
+            pkas[line[:10]] = line[10:].split()[0]
+    return pkas
+
+
+def read_opp_rows(sel):
+    """Electrostatic and vdw pairwise interaction of the conformers sel with all conformers, as two sparse
+    (len(sel), n_conf) matrices read from the .opp files of sel. As in mcce, a conformer sees the interaction
+    in its own .opp file, not the average of the two directions in data.pairwise.
+    """
+    conf_index = {conf.confname: ic for ic, conf in enumerate(head3lst)}
+    scale_ele = env.tpl[("SCALING", "ELE")]
+    scale_vdw = env.tpl[("SCALING", "VDW")]
+    rows = {}
+    for row, ic in enumerate(sel):
+        oppfile = "%s/%s.opp" % (env.energy_table, head3lst[ic].confname)
+        if not os.path.isfile(oppfile):
+            continue
+        for line in open(oppfile):
+            fields = line.split()
+            if len(fields) < 6 or fields[1] not in conf_index:
+                continue
+            rows[(row, conf_index[fields[1]])] = (float(fields[2]) * scale_ele, float(fields[3]) * scale_vdw)
+
+    row_col = np.array(list(rows.keys()), dtype=int).reshape(-1, 2)
+    values = np.array(list(rows.values())).reshape(-1, 2)
+    return [csr_matrix((values[:, i], (row_col[:, 0], row_col[:, 1])), shape=(len(sel), len(head3lst))) for i in range(2)]
+
+
+class MFE:
+    """Ionization energy terms of residues at all titration points.
+    Each term is an array (n_residues, n_points) of charged state minus ground state energy in kcal/mol,
+    res_mfe, res_ele and res_vdw are lists with one sparse (n_residues, n_all_residues) matrix of interactions
+    per point, res_crg is the net charge (n_all_residues, n_points) of the residues with charged conformers.
+    """
+
+    def __init__(self, resids):
+        self.titr_type, self.points, self.occ = read_fort38()
+
+        # every residue of head3.lst, conformers grouped as the old program did
+        self.all_resids = []
+        res_index = {}
+        conf_res = np.zeros(len(head3lst), dtype=int)
+        for ic, conf in enumerate(head3lst):
+            resid = conf.confname[:3] + conf.confname[5:11]
+            if resid not in res_index:
+                res_index[resid] = len(self.all_resids)
+                self.all_resids.append(resid)
+            conf_res[ic] = res_index[resid]
+
+        self.resids = resids
+        self.compute(conf_res, np.array([res_index[x] for x in resids], dtype=int))
+
+    def compute(self, conf_res, res_sel):
+        n_conf = len(head3lst)
+        n_points = len(self.points)
+        n_res = len(self.resids)
+
+        # conformers of the selected residues, their residue (row in the output) and sign:
+        # +1 for a charged conformer, -1 for a ground state conformer
+        row_of_res = np.full(len(self.all_resids), -1)
+        row_of_res[res_sel] = np.arange(n_res)
+        sel = np.flatnonzero(row_of_res[conf_res] >= 0)
+        sel_row = row_of_res[conf_res[sel]]
+        charged = np.array([head3lst[ic].confname[3] in "+-" for ic in sel])  # dummy conformers are ground state
+        sign = np.where(charged, 1.0, -1.0)
+        group = 2 * sel_row + charged  # ground and charged state of each selected residue
+        n_sel = len(sel)
+
+        # self energy terms, pH and Eh effect of the selected conformers
+        values = {}
+        for term in ["vdw0", "vdw1", "tors", "epol", "dsolv", "extra"]:
+            values[term] = np.array([getattr(head3lst[ic], term) for ic in sel])[:, None]
+        E_self = sum(values.values())
+        nh = np.array([head3lst[ic].nh for ic in sel])[:, None]
+        ne = np.array([head3lst[ic].ne for ic in sel])[:, None]
+        pk0 = np.array([head3lst[ic].pk0 for ic in sel])[:, None]
+        em0 = np.array([head3lst[ic].em0 for ic in sel])[:, None]
+        ph = self.points[None, :] if self.titr_type == "pH" else env.runprm.get("TITR_PH0", 0.0)
+        eh = self.points[None, :] if self.titr_type == "Eh" else env.runprm.get("TITR_EH0", 0.0)
+        values["pHeffect"] = np.broadcast_to((ph - pk0) * nh * PH2KCAL, (n_sel, n_points))
+        values["Eheffect"] = np.broadcast_to((eh - em0) * ne * MEV2KCAL, (n_sel, n_points))
+
+        # interaction of each selected conformer with the conformers of other residues
+        pw_terms = []
+        for pw in read_opp_rows(sel):
+            pw = pw.tocoo()
+            other = conf_res[pw.col] != conf_res[sel[pw.row]]
+            pw_terms.append(csr_matrix((pw.data[other], (pw.row[other], pw.col[other])), shape=(n_sel, n_conf)))
+        ele_sel, vdw_sel = pw_terms
+        pw_sel = ele_sel + vdw_sel
+        values["mfe_total"] = pw_sel @ self.occ
+
+        # Boltzmann distribution of conformers within the ground and the charged state
+        E_total = values["mfe_total"] + values["pHeffect"] + values["Eheffect"] + E_self
+        E_ref = np.full((2 * n_res, n_points), np.inf)
+        np.minimum.at(E_ref, group, E_total)
+        boltzmann = np.exp(-(E_total - E_ref[group]) * KCAL2KT)
+        total = np.zeros((2 * n_res, n_points))
+        np.add.at(total, group, boltzmann)
+        nocc = boltzmann / total[group]
+
+        # state energy terms are occupancy weighted sums, the charged state minus the ground state
+        diff = csr_matrix((sign, (sel_row, np.arange(n_sel))), shape=(n_res, n_sel))
+        for term in ["vdw0", "vdw1", "tors", "epol", "dsolv", "extra", "pHeffect", "Eheffect", "mfe_total"]:
+            setattr(self, term, diff @ (nocc * values[term]))
+        self.E_total = diff @ (nocc * E_total)
+        ts = np.zeros_like(nocc)
+        significant = nocc > 0.000001
+        ts[significant] = -nocc[significant] * np.log(nocc[significant]) / KCAL2KT
+        self.TS = diff @ ts
+        self.G = self.E_total - self.TS
+
+        # break down mfe by residue, at each point
+        residue_of_conf = csr_matrix((np.ones(n_conf), (np.arange(n_conf), conf_res)), shape=(n_conf, len(self.all_resids)))
+        self.res_mfe = []
+        self.res_ele = []
+        self.res_vdw = []
+        for i in range(n_points):
+            for res_pw, pw in [(self.res_mfe, pw_sel), (self.res_ele, ele_sel), (self.res_vdw, vdw_sel)]:
+                res_pw.append((diff @ diags(nocc[:, i]) @ pw @ diags(self.occ[:, i]) @ residue_of_conf).tocsr())
+
+        # net charge of the residues that have charged conformers, as in sum_crg.out
+        crg = np.array([conf.crg for conf in head3lst])
+        ionizable = np.zeros(len(self.all_resids), dtype=bool)
+        ionizable[conf_res[[conf.confname[3] in "+-" for conf in head3lst]]] = True
+        self.res_crg = (residue_of_conf.T @ (crg[:, None] * self.occ)) * ionizable[:, None]
+
+    def interpolation(self, t_point):
+        """Lower and higher titration point index around t_point and the weight of the higher one,
+        None if t_point is out of range."""
+        i_low = i_high = None
+        for i, x in enumerate(self.points):
+            if t_point > x - 0.001:
+                i_low = i
+        for i, x in enumerate(self.points):
+            if t_point < x + 0.001:
+                i_high = i
+                break
+        if i_low is None or i_high is None:
+            return None
+
+        if abs(self.points[i_low] - self.points[i_high]) < 0.01:
+            k = 0.0
+        else:
+            k = (t_point - self.points[i_low]) / (self.points[i_high] - self.points[i_low])
+        return i_low, i_high, k
+
+    def at_point(self, t_point, rows=None):
+        """Terms at a titration point as a dict of arrays (n_residues), and the residue interactions as a
+        dense (n_residues, n_all_residues) array. Between two titration points the terms are interpolated.
+        rows selects residues, default all.
+        """
+        interpolation = self.interpolation(t_point)
+        if interpolation is None:
+            return None, None
+        i_low, i_high, k = interpolation
+
+        rows = slice(None) if rows is None else rows
+        values = {term: (1 - k) * getattr(self, term)[rows, i_low] + k * getattr(self, term)[rows, i_high] for term in terms}
+        res_mfe = (1 - k) * self.res_mfe[i_low][rows].toarray() + k * self.res_mfe[i_high][rows].toarray()
+
+        return values, res_mfe
+
+    def pairs_at_point(self, t_point, row):
+        """vdw, ele and total interaction of residue row with each residue, and the net charge of each residue,
+        at a titration point, as the columns of respair.lst in kcal/mol."""
+        i_low, i_high, k = self.interpolation(t_point)
+        pairs = []
+        for res_pw in [self.res_vdw, self.res_ele, self.res_mfe]:
+            pairs.append((1 - k) * res_pw[i_low][row].toarray().ravel() + k * res_pw[i_high][row].toarray().ravel())
+        pairs.append((1 - k) * self.res_crg[:, i_low] + k * self.res_crg[:, i_high])
+        return pairs
+
+
+def print_mfe(pka_name, pka, values, res_mfe, all_resids, cutoff):
+    print("Residue %s pKa/Em=%s" % (pka_name, pka))
+    print("=================================")
+    print("Terms          pH     meV    Kcal")
+    print("---------------------------------")
+    rows = [("vdw0", values["vdw0"]), ("vdw1", values["vdw1"]), ("tors", values["tors"]), ("ebkb", values["epol"]),
+            ("dsol", values["dsolv"]), ("offset", values["extra"]), ("pH&pK0", values["pHeffect"]),
+            ("Eh&Em0", values["Eheffect"]), ("-TS", -values["TS"]), ("residues", values["mfe_total"])]
+    for name, value in rows:
+        print("%-9s%8.2f%8.2f%8.2f" % (name, value / PH2KCAL, value / MEV2KCAL, value))
+    print("*********************************")
+    print("TOTAL    %8.2f%8.2f%8.2f" % (values["G"] / PH2KCAL, values["G"] / MEV2KCAL, values["G"]))
+    print("*********************************")
+    for resid, value in zip(all_resids, res_mfe):
+        if abs(value / PH2KCAL) > cutoff:
+            print("%-9s%8.2f%8.2f%8.2f" % (resid, value / PH2KCAL, value / MEV2KCAL, value))
+    print("=================================")
+
+
+if __name__ == "__main__":
+    helpmsg = "Report the ionization energy terms of residues at a titration point. Run in the working directory " \
+              "of a finished step 4."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("residues", metavar="res_id", nargs="*", help="residue ID in pK.out, default all residues in pK.out")
+    parser.add_argument("-p", metavar="point", type=float, required=True,
+                        help="titration point, pH or Eh. Between two calculated points the terms are interpolated")
+    parser.add_argument("-c", metavar="cutoff", default=-0.001, type=float,
+                        help="print residue interactions bigger than this value in pH unit, default all")
+    args = parser.parse_args()
+
+    pkas = read_pkout()
+    pka_names = args.residues if args.residues else list(pkas.keys())
+    known = set([conf.confname[:3] + conf.confname[5:11] for conf in head3lst])
+    resids = []
+    for pka_name in pka_names:
+        resid = pka_name[:3] + pka_name[4:]
+        if resid not in known:
+            print("Residue %s not found in fort.38" % pka_name)
+            sys.exit()
+        resids.append(resid)
+
+    mfe = MFE(resids)
+    values, res_mfe = mfe.at_point(args.p)
+    if values is None:
+        print("titration_point out off range")
+        sys.exit()
+
+    for i, pka_name in enumerate(pka_names):
+        print_mfe(pka_name, pkas.get(pka_name, "?"), {term: values[term][i] for term in terms}, res_mfe[i],
+                  mfe.all_resids, args.c)
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+
+"""
+Module: monte.py
+
+Monte Carlo sampling of step 4 on the PyMCCE data structure of data.py.
+
+The sampling follows lib/monte.c. At each titration point, the free residues are annealed,
+equilibrated for MONTE_NEQ * conformers steps and reduced by MONTE_REDUCE. The reduced system is
+solved by enumeration when it has at most NSTATE_MAX microstates; otherwise MONTE_RUNS independent
+runs are annealed and sampled for MONTE_NITER * conformers steps each.
+
+The runs of all titration points are the rows of one microstate array, of shape
+(points * runs, free residues), and advance together: the annealing, equilibration and sampling
+loops run once for all points. Each step flips one residue (and up to MONTE_FLIPS - 1 strongly
+coupled neighbors) in every run, and the Metropolis test uses the energy change of the flipped
+conformers only. Points differ in their self energies and, after MONTE_REDUCE, in their free
+conformers; a run only moves among the conformers free at its point.
+
+Input:
+ * run.prm, head3.lst, energies/*.opp and the EXTRA file (read by data.py)
+
+Output:
+ * fort.38
+
+Usage examples:
+
+1. Run MC with the settings in run.prm
+    monte.py
+
+2. Use 30 runs and a fixed random seed, write to another file
+    monte.py -r 30 -s 1 -o fort.38.py
+"""
+
+import argparse
+import time
+from data import *
+
+KCAL2KT = 1.688
+fname_occ_table = "fort.38"
+
+ANNEAL_TEMP_START = 3000.0  # lib/init.c defaults of the annealing ladder in run.prm
+ANNEAL_NSTEP = 10
+ANNEAL_NITER_STEP = 200
+NSTATE_MAX = 1000000
+RANDOM_BLOCK = 1 << 20      # random numbers drawn at a time
+ENUMERATE_CHUNK = 65536     # microstates evaluated at a time in enumeration
+
+
+def runprm_value(key, default, value_type=float):
+    if key in env.runprm:
+        return value_type(env.runprm[key])
+    return default
+
+
+def group_residues():
+    """Conformer indices of each residue, in the order of head3.lst."""
+    residues = {}
+    for ic, conf in enumerate(head3lst):
+        resid = conf.confname[:3] + conf.confname[5:11]
+        residues.setdefault(resid, []).append(ic)
+    return [np.array(x) for x in residues.values()]
+
+
+def verify_flags(residues):
+    """Fixed flags and occupancies of conformers after the checks of lib/monte.c verify_flag():
+    free conformers have 0 occupancy, a residue with only one free conformer is fixed, and fixed
+    conformers of a residue that is free have 0 occupancy.
+    """
+    fixed = np.array([conf.flag == "t" for conf in head3lst])
+    occ = np.array([conf.occ for conf in head3lst])
+    for res in residues:
+        for ic in res[~fixed[res]]:
+            if abs(occ[ic]) > 0.001:
+                print("   %s f %4.2f -> f 0.00 (free conformer starts with 0 occupancy)" % (head3lst[ic].confname, occ[ic]))
+            occ[ic] = 0.0
+
+        free = res[~fixed[res]]
+        if len(free) == 1:
+            ic = free[0]
+            fixed[ic] = True
+            occ[ic] = min(max(1.0 - occ[res].sum(), 0.0), 1.0)
+            print("   %s f 0.00 -> t %4.2f (single free conformer of the residue)" % (head3lst[ic].confname, occ[ic]))
+        elif len(free) > 1:
+            for ic in res[fixed[res]]:
+                if occ[ic] > 0.001:
+                    print("   %s t %4.2f -> t 0.00 (fixed conformer of a free residue)" % (head3lst[ic].confname, occ[ic]))
+                    occ[ic] = 0.0
+
+    return fixed, occ
+
+
+class MC_SYSTEM:
+    """Free residues of a batch of titration points. The residues free at any point are the columns
+    of the microstates and their free conformers are indexed compactly, residue by residue, with one
+    dummy conformer at the end that has no energy. At each point, E_self includes the mean field of
+    the conformers fixed at that point, moves only pick the conformers free at that point, and a
+    residue not free at that point sits on the dummy conformer.
+
+    The runs of all points are the rows of one microstate array, point by point: row p * n_run + k
+    is run k of point p.
+    """
+    def __init__(self, residues, fixed, occ, E_self0, flips, big_pairwise, rng):
+        self.flips = flips
+        self.rng = rng
+        self.n_points = len(fixed)
+
+        # mean field from the fixed conformers, at each point
+        E_self = E_self0 + (pairwise @ np.where(fixed, occ, 0.0).T).T
+
+        free_res = [res[~fixed[:, res].all(axis=0)] for res in residues if not fixed[:, res].all()]
+        self.n_free = len(free_res)
+        self.n_conf = np.array([len(x) for x in free_res], dtype=int)
+        self.first = np.cumsum(self.n_conf) - self.n_conf     # compact index of the first conformer
+        self.confs = np.concatenate(free_res) if free_res else np.zeros(0, dtype=int)
+        n_confs = len(self.confs)
+        self.dummy = n_confs
+        self.E_self = np.zeros((self.n_points, n_confs + 1))
+        self.E_self[:, :n_confs] = E_self[:, self.confs]
+        self.pw = np.zeros((n_confs + 1, n_confs + 1))
+        self.pw[:n_confs, :n_confs] = pairwise[self.confs][:, self.confs].toarray()
+        for ir in range(self.n_free):  # conformers of the same residue never interact
+            self.pw[self.first[ir]:self.first[ir] + self.n_conf[ir], self.first[ir]:self.first[ir] + self.n_conf[ir]] = 0.0
+
+        # conformers free at each point, by residue: allowed[p, ir, :n_allowed[p, ir]], the others
+        # are the dummy. pos is the place of a conformer in the allowed list of its residue.
+        self.free = ~fixed[:, self.confs]
+        self.n_confs = self.free.sum(axis=1)   # free conformers of each point
+        self.n_allowed = np.add.reduceat(self.free.astype(int), self.first, axis=1) if self.n_free else np.zeros((self.n_points, 0), dtype=int)
+        self.allowed = np.full((self.n_points, self.n_free, max(self.n_allowed.max(initial=0), 1)), self.dummy, dtype=int)
+        self.pos = np.full((self.n_points, n_confs + 1), self.allowed.shape[2], dtype=int)
+        for p in range(self.n_points):
+            for ir in range(self.n_free):
+                allowed = self.first[ir] + np.flatnonzero(self.free[p, self.first[ir]:self.first[ir] + self.n_conf[ir]])
+                self.allowed[p, ir, :len(allowed)] = allowed
+                self.pos[p, allowed] = np.arange(len(allowed))
+
+        # residues free at each point, and the residues coupled to them by any pairwise interaction
+        # stronger than BIG_PAIRWISE between conformers free at that point
+        self.n_freeres = (self.n_allowed > 0).sum(axis=1)
+        self.freeres = np.zeros((self.n_points, max(self.n_freeres.max(initial=0), 1)), dtype=int)
+        big_pw = np.abs(self.pw[:n_confs, :n_confs]) > big_pairwise
+        self.n_big = np.zeros((self.n_points, self.n_free), dtype=int)
+        big = []
+        for p in range(self.n_points):
+            freeres = np.flatnonzero(self.n_allowed[p] > 0)
+            self.freeres[p, :len(freeres)] = freeres
+            if self.n_free:
+                big_p = big_pw & self.free[p][:, np.newaxis] & self.free[p][np.newaxis, :]
+                big_p = np.logical_or.reduceat(np.logical_or.reduceat(big_p, self.first, axis=0), self.first, axis=1)
+                np.fill_diagonal(big_p, False)
+            else:
+                big_p = np.zeros((0, 0), dtype=bool)
+            self.n_big[p] = big_p.sum(axis=1)
+            big.append(big_p)
+        self.biglist = np.zeros((self.n_points, self.n_free, max(self.n_big.max(initial=0), 1)), dtype=int)
+        for p in range(self.n_points):
+            for ir in range(self.n_free):
+                self.biglist[p, ir, :self.n_big[p, ir]] = np.flatnonzero(big[p][ir])
+
+    def row_point(self, n_rows):
+        """Titration point of each row of a microstate array."""
+        return np.repeat(np.arange(self.n_points), n_rows // self.n_points)
+
+    def random_state(self, n_run):
+        """n_run random microstates of each point, as compact conformer indices of shape (n_points * n_run, n_free)."""
+        pt = self.row_point(self.n_points * n_run)
+        u = self.rng.random((len(pt), self.n_free))
+        return self.allowed[pt[:, np.newaxis], np.arange(self.n_free), (u * self.n_allowed[pt]).astype(int)]
+
+    def field(self, state):
+        """Energy of each free conformer in each run of state: its self energy plus its pairwise
+        interaction with the conformers in the microstate, shape (n_rows, number of free conformers + 1).
+        """
+        G = self.E_self[self.row_point(state.shape[0])]
+        for ir in range(self.n_free):
+            G += self.pw[state[:, ir]]
+        return G
+
+    def mc(self, state, n_step, T, counts=None):
+        """Metropolis sampling of all runs in state at temperature T, for n_step[p] steps at point p.
+        When counts (n_rows, number of free conformers + 1) is given, the steps each conformer is occupied are added to it.
+
+        The energy change of a step is read from the field of the runs. The field is only updated
+        for the runs that accept the step, and a conformer is counted when it is flipped away.
+        Runs that are done with their steps, or have no free residue, reject every step.
+        """
+        n_rows = state.shape[0]
+        pt = self.row_point(n_rows)
+        steps = np.broadcast_to(n_step, (self.n_points,))[pt]
+        n_step = steps.max(initial=0)
+        if n_step <= 0 or self.n_free == 0:
+            return
+        b = -KCAL2KT / (T / ROOMT)
+        all_rows = np.arange(n_rows)
+        idle = self.n_freeres[pt] == 0
+        last = np.zeros(state.shape, dtype=int)     # step from which the conformer of a residue is occupied
+        n_rand = 4 + 2 * (self.flips - 1)
+        block = max(1, RANDOM_BLOCK // (n_rand * n_rows))
+        for start in range(0, n_step, block):
+            # the random choices of a block of steps
+            n_t = min(block, n_step - start)
+            u = self.rng.random((n_rand, n_t, n_rows))
+            ires = self.freeres[pt, (u[0] * self.n_freeres[pt]).astype(int)]
+            pick = (u[1] * (self.n_allowed[pt, ires] - 1)).astype(int)
+            n_big = self.n_big[pt, ires]
+            nflips = np.where((u[2] < 0.5) & (n_big > 0), np.minimum(self.flips, n_big + 1), 1)
+            with np.errstate(divide="ignore"):
+                threshold = np.log(u[3]) / b    # dE < threshold is rand < exp(b*dE)
+            threshold[idle | (start + np.arange(n_t)[:, np.newaxis] >= steps)] = -np.inf
+            multi = []
+            for k in range(1, self.flips):
+                flip = nflips > k
+                iflip = self.biglist[pt, ires, (u[2 + 2 * k] * n_big).astype(int)]
+                new = self.allowed[pt, iflip, (u[3 + 2 * k] * self.n_allowed[pt, iflip]).astype(int)]
+                multi.append((flip.any(axis=1), flip, iflip, new))
+
+            G = self.field(state)   # recomputed every block, so that rounding errors do not add up
+            for t in range(n_t):
+                # 1st flip, to a conformer other than the current one
+                cur = state[all_rows, ires[t]]
+                new = self.allowed[pt, ires[t], pick[t] + (pick[t] >= self.pos[pt, cur])]
+                dE = G[all_rows, new] - G[all_rows, cur]
+                state[all_rows, ires[t]] = new
+                flipped = [(ires[t], cur, new)]
+
+                # multiple flips on residues in the big list, in half of the steps. Runs that
+                # do not flip this time keep the current conformer.
+                for any_flip, flip, iflip, new_k in multi:
+                    if not any_flip[t]:
+                        break
+                    cur = state[all_rows, iflip[t]]
+                    new = np.where(flip[t], new_k[t], cur)
+                    dE += G[all_rows, new] - G[all_rows, cur]
+                    for i, cur_l, new_l in flipped:  # field change by the earlier flips
+                        dE += self.pw[new, new_l] - self.pw[new, cur_l] - self.pw[cur, new_l] + self.pw[cur, cur_l]
+                    state[all_rows, iflip[t]] = new
+                    flipped.append((iflip[t], cur, new))
+
+                # rejected runs take back the flipped conformers, latest flip first
+                stay = np.flatnonzero(dE >= threshold[t])
+                for i, cur, new in reversed(flipped):
+                    state[stay, i[stay]] = cur[stay]
+                runs = np.flatnonzero(dE < threshold[t])
+                if len(runs) == 0:
+                    continue
+                for i, cur, new in flipped:
+                    i, cur, new = i[runs], cur[runs], new[runs]
+                    G[runs] += self.pw[new] - self.pw[cur]
+                    if counts is not None:
+                        counts[runs, cur] += start + t - last[runs, i]
+                        last[runs, i] = start + t
+
+        if counts is not None:
+            counts[all_rows[:, np.newaxis], state] += steps[:, np.newaxis] - last
+
+    def anneal(self, state, T, nstart, temp_start, nstep, niter_step):
+        """Anneal all runs in state down to T by the ladder of lib/monte.c: nstep temperatures from
+        temp_start, niter_step * conformers steps each. Then run nstart * conformers steps at T
+        ("Annealing = n_start * confs" of run.prm), with the free conformers of each point.
+        """
+        counter = self.n_confs
+        for i_step in range(nstep):
+            temp = temp_start + (i_step + 1) / nstep * (T - temp_start)
+            self.mc(state, niter_step * counter, temp)
+        self.mc(state, nstart * counter, T)
+
+    def enumerate(self, p, T, nstate_max):
+        """Exact occupancies of the free conformers at point p, or None when there are more than nstate_max microstates."""
+        res_p = np.flatnonzero(self.n_allowed[p] > 0)
+        n_conf = self.n_allowed[p, res_p]
+        n_state = 1
+        for n in n_conf:
+            n_state *= int(n)
+            if n_state > nstate_max:
+                return None
+
+        b = -KCAL2KT / (T / ROOMT)
+        stride = np.cumprod(np.r_[1, n_conf[:-1]])
+
+        def states(lo):
+            index = np.arange(lo, min(lo + ENUMERATE_CHUNK, n_state))
+            return self.allowed[p, res_p, (index[:, np.newaxis] // stride) % n_conf]
+
+        E = np.zeros(n_state)
+        for lo in range(0, n_state, ENUMERATE_CHUNK):
+            s = states(lo)
+            E_chunk = self.E_self[p, s].sum(axis=1)
+            for kr in range(1, len(res_p)):
+                E_chunk += self.pw[s[:, kr:kr+1], s[:, :kr]].sum(axis=1)
+            E[lo:lo + len(s)] = E_chunk
+
+        weight = np.exp(b * (E - E.min()))
+        occ = np.zeros(len(self.confs) + 1)
+        for lo in range(0, n_state, ENUMERATE_CHUNK):
+            s = states(lo)
+            occ += np.bincount(s.ravel(), weights=np.repeat(weight[lo:lo + len(s)], len(res_p)), minlength=len(occ))
+
+        return occ[:-1] / weight.sum()
+
+
+def titration_points():
+    """(pH, Eh) of the titration points."""
+    ph0 = runprm_value("TITR_PH0", 7.0)
+    eh0 = runprm_value("TITR_EH0", 0.0)
+    points = []
+    for i in range(runprm_value("TITR_STEPS", 1, int)):
+        if env.runprm.get("TITR_TYPE", "ph").lower() == "ph":
+            points.append((ph0 + i * runprm_value("TITR_PHD", 1.0), eh0))
+        else:
+            points.append((ph0, eh0 + i * runprm_value("TITR_EHD", 30.0)))
+    return points
+
+
+def monte(n_run, seed):
+    """Sample all titration points, return the occupancy table (conformers, points)."""
+    T = runprm_value("MONTE_T", ROOMT)
+    flips = runprm_value("MONTE_FLIPS", 3, int)
+    big_pairwise = runprm_value("BIG_PAIRWISE", 5.0)
+    nstart = runprm_value("MONTE_NSTART", 100, int)
+    anneal_temp_start = runprm_value("ANNEAL_TEMP_START", ANNEAL_TEMP_START)
+    anneal_nstep = runprm_value("ANNEAL_NSTEP", ANNEAL_NSTEP, int)
+    anneal_niter_step = runprm_value("ANNEAL_NITER_STEP", ANNEAL_NITER_STEP, int)
+    neq = runprm_value("MONTE_NEQ", 300, int)
+    niter = runprm_value("MONTE_NITER", 2000, int)
+    reduce = runprm_value("MONTE_REDUCE", 0.001)
+    nstate_max = runprm_value("NSTATE_MAX", NSTATE_MAX, int)
+    if env.runprm.get("MONTE_TSX", "f").lower() == "t":
+        print("   Warning: entropy correction (MONTE_TSX) is not implemented in monte.py, ignored.")
+
+    rng = np.random.default_rng(seed)
+    residues = group_residues()
+    print("   Verifying conformer flags ...")
+    fixed0, occ0 = verify_flags(residues)
+
+    E_self_conf = np.array([conf.vdw0 + conf.vdw1 + conf.epol + conf.tors + conf.dsolv + conf.extra for conf in head3lst])
+    nh = np.array([conf.nh for conf in head3lst])
+    ne = np.array([conf.ne for conf in head3lst])
+    pk0 = np.array([conf.pk0 for conf in head3lst])
+    em0 = np.array([conf.em0 for conf in head3lst])
+
+    points = titration_points()
+    ph = np.array([x[0] for x in points])
+    eh = np.array([x[1] for x in points])
+    n_points = len(points)
+    fixed = np.tile(fixed0, (n_points, 1))
+    occ = np.tile(occ0, (n_points, 1))
+    E_self0 = E_self_conf + nh * (ph[:, np.newaxis] - pk0) * PH2KCAL + ne * (eh[:, np.newaxis] - em0) * PH2KCAL / 58.0
+
+    # anneal and equilibrate all points together, then fix conformers that are hardly occupied
+    t0 = time.time()
+    system = MC_SYSTEM(residues, fixed, occ, E_self0, flips, big_pairwise, rng)
+    state = system.random_state(n_run)
+    system.anneal(state, T, nstart, anneal_temp_start, anneal_nstep, anneal_niter_step)
+    n_step = neq * system.n_confs
+    counts = np.zeros((n_points * n_run, len(system.confs) + 1))
+    system.mc(state, n_step, T, counts=counts)
+    occ_eq = counts[:, :-1].reshape(n_points, n_run, -1).sum(axis=1)
+    for p in range(n_points):
+        if n_step[p]:
+            low = system.confs[system.free[p] & (occ_eq[p] / (n_step[p] * n_run) < reduce)]
+            fixed[p, low] = True
+            occ[p, low] = 0.0
+            for res in residues:
+                free = res[~fixed[p, res]]
+                if len(free) == 1:
+                    fixed[p, free] = True
+                    occ[p, free] = 1.0
+    print("   Equilibration of %d titration points: %5d seconds" % (n_points, time.time() - t0), flush=True)
+
+    # enumerate the points with few microstates, sample the others together
+    t0 = time.time()
+    system = MC_SYSTEM(residues, fixed, occ, E_self0, flips, big_pairwise, rng)
+    n_free = system.n_freeres.copy()
+    sigma_max = np.zeros(n_points)
+    sampled = []
+    for p in range(n_points):
+        occ_free = system.enumerate(p, T, nstate_max)
+        if occ_free is None:
+            sampled.append(p)
+        else:
+            occ[p, system.confs[system.free[p]]] = occ_free[system.free[p]]
+
+    if sampled:
+        system = MC_SYSTEM(residues, fixed[sampled], occ[sampled], E_self0[sampled], flips, big_pairwise, rng)
+        state = system.random_state(n_run)
+        system.anneal(state, T, nstart, anneal_temp_start, anneal_nstep, anneal_niter_step)
+        n_step = niter * system.n_confs
+        counts = np.zeros((len(sampled) * n_run, len(system.confs) + 1))
+        system.mc(state, n_step, T, counts=counts)
+        occ_runs = counts[:, :-1].reshape(len(sampled), n_run, -1) / n_step[:, np.newaxis, np.newaxis]
+        for k, p in enumerate(sampled):
+            free = system.free[k]
+            occ[p, system.confs[free]] = occ_runs[k].mean(axis=0)[free]
+            if n_run > 1 and free.any():
+                sigma_max[p] = occ_runs[k][:, free].std(axis=0, ddof=1).max()
+            elif n_run == 1:
+                sigma_max[p] = 999.0
+    print("   Sampling of %d titration points (%d enumerated): %5d seconds"
+          % (n_points, n_points - len(sampled), time.time() - t0), flush=True)
+
+    for p in range(n_points):
+        print("   Titration %2d: %d free residues, biggest stdev of conformer occ = %5.3f"
+              % (p + 1, n_free[p], sigma_max[p]), flush=True)
+    occ_table = occ.T
+
+    return points, occ_table
+
+
+def write_occ_table(fname, points, occ_table):
+    """Write the occupancy table in the fort.38 format of lib/monte.c."""
+    lines = []
+    if env.runprm.get("TITR_TYPE", "ph").lower() == "ph":
+        lines.append(" ph           " + "".join([" %5.1f" % ph for ph, eh in points]) + "\n")
+    else:
+        lines.append(" eh           " + "".join([" %5.0f" % eh for ph, eh in points]) + "\n")
+    for ic, conf in enumerate(head3lst):
+        lines.append(conf.confname + "".join([" %5.3f" % x for x in occ_table[ic]]) + "\n")
+    open(fname, "w").writelines(lines)
+
+
+if __name__ == "__main__":
+    helpmsg = "Run Monte Carlo sampling of mcce step 4 in Python, write the conformer occupancy table."
+    parser = argparse.ArgumentParser(description=helpmsg)
+    parser.add_argument("-r", metavar="runs", type=int, default=0,
+                        help="Number of independent MC runs, sampled together; default: MONTE_RUNS in run.prm")
+    parser.add_argument("-s", metavar="seed", type=int, default=-1,
+                        help="Random seed, negative for a random seed; default: MONTE_SEED in run.prm")
+    parser.add_argument("-o", metavar="fname", default=fname_occ_table, help="Output occupancy table; default: %(default)s")
+    args = parser.parse_args()
+
+    n_run = args.r if args.r > 0 else runprm_value("MONTE_RUNS", 6, int)
+    seed = args.s if args.s >= 0 else runprm_value("MONTE_SEED", -1, int)
+    if seed < 0:
+        seed = None
+
+    print("Monte Carlo sampling with %d runs ..." % n_run)
+    points, occ_table = monte(n_run, seed)
+    write_occ_table(args.o, points, occ_table)
+    print("Occupancy table written to %s." % args.o)
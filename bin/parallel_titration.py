@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+
+"""
+Module: parallel_titration.py
+
+Run the titration points of step 4 as independent mcce jobs in a bounded pool, and merge the
+results into the files a serial step 4 writes.
+
+Each job runs in its own folder under step4_jobs/, with head3.lst and energies/ linked from the
+working directory and a run.prm that covers one group of titration points with its own MONTE_SEED.
+
+Output:
+ * fort.38
+ * entropy.out
+ * mc_out
+ * pK.out
+ * respair.lst
+ * ms_out/ (when MS_OUT is on)
+
+The C program fits pK.out inside the same process that runs Monte Carlo, so a job that sees only
+part of the titration can not fit it. pK.out is fitted here from the merged fort.38 with the same
+initial guess, simplex fit and output format as mcce. The mfe columns of pK.out and respair.lst are
+computed from the merged fort.38 by mfe.py, at the same point and with the same cutoff as mcce.
+"""
+
+import os
+import sys
+import time
+import shutil
+import subprocess
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from scipy.special import expit
+from mccesteps import export_runprm
+
+job_folder = "step4_jobs"
+fname_occ_table = "fort.38"
+fname_entropy = "entropy.out"
+fname_mc_out = "mc_out"
+fname_pkout = "pK.out"
+fname_respair = "respair.lst"
+ms_folder = "ms_out"
+linked_inputs = ["head3.lst", "energies"]
+
+
+def titration_points(runprm):
+    """Titration type ('p' or 'e') and the list of titration points defined by runprm."""
+    titr_type = "p" if str(runprm.get("TITR_TYPE", "ph"))[0] in "pP" else "e"
+    n_steps = int(runprm.get("TITR_STEPS", 15))
+    if titr_type == "p":
+        start = float(runprm.get("TITR_PH0", 0.0))
+        delta = float(runprm.get("TITR_PHD", 1.0))
+    else:
+        start = float(runprm.get("TITR_EH0", 0.0))
+        delta = float(runprm.get("TITR_EHD", 1.0))
+
+    return titr_type, [start + i * delta for i in range(n_steps)]
+
+
+def table_header(titr_type, points):
+    """Header line of fort.38 and entropy.out, as mcce writes it."""
+    if titr_type == "p":
+        return " ph           " + "".join([" %5.1f" % x for x in points]) + "\n"
+    else:
+        return " eh           " + "".join([" %5.0f" % x for x in points]) + "\n"
+
+
+def job_runprm(runprm, titr_type, first_point, n_points, seed):
+    """run.prm entries of one job, with relative file paths made absolute."""
+    entries = {}
+    for key, value in runprm.items():
+        value = str(value)
+        if not os.path.isabs(value) and os.path.exists(value):
+            value = os.path.abspath(value)
+        entries[key] = value
+
+    if titr_type == "p":
+        entries["TITR_PH0"] = "%.6f" % first_point
+    else:
+        entries["TITR_EH0"] = "%.6f" % first_point
+    entries["TITR_STEPS"] = "%d" % n_points
+    entries["MONTE_SEED"] = "%d" % seed
+
+    return entries
+
+
+def prepare_job(folder, entries):
+    if os.path.isdir(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    for fname in linked_inputs:
+        os.symlink(os.path.abspath(fname), os.path.join(folder, fname))
+    export_runprm(entries, fname=os.path.join(folder, "run.prm"))
+
+
+def run_job(mcce, folder):
+    """Run mcce in folder, return the exit code and the CPU time of the job in seconds.
+    CPU time is what the job would take alone, wall time depends on the other jobs sharing the CPUs.
+    """
+    with open(os.path.join(folder, "step4.log"), "w") as log:
+        process = subprocess.Popen([mcce], cwd=folder, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage.ru_utime + usage.ru_stime
+
+
+def merge_table(fname, folders, header):
+    """Join the columns of a conformer table (fort.38 or entropy.out) written by the jobs.
+    The values are copied as written by mcce, so the merged table is identical to a serial one.
+    """
+    names = []
+    columns = {}
+    for folder in folders:
+        lines = open(os.path.join(folder, fname)).readlines()[1:]
+        job_names = []
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            job_names.append(fields[0])
+            columns.setdefault(fields[0], []).extend(fields[1:])
+        if not names:
+            names = job_names
+        elif job_names != names:
+            print("   FATAL: conformers in %s do not match the other jobs." % os.path.join(folder, fname))
+            sys.exit()
+
+    lines = [header]
+    for name in names:
+        lines.append(name + "".join([" " + x for x in columns[name]]) + "\n")
+    open(fname, "w").writelines(lines)
+
+
+def fit_curve(xp, yp, ftol=0.0001, nmax=5000):
+    """Fit y = exp(a(x-b))/(1+exp(a(x-b))), return a, b, chi2.
+    This is the downhill simplex of mcce (dhill() in monte.c) in single precision, started from the
+    same simplex, so that the fitted values agree with a serial run.
+    """
+    xp = xp.astype(np.float32)
+    yp = yp.astype(np.float32)
+
+    def score(v):
+        return np.float32(np.sum((expit(v[0] * (xp - v[1])) - yp) ** 2, dtype=np.float32))
+
+    b = xp[np.argmin(np.abs(yp - 0.5))]
+    p = np.array([[0.0, b], [0.01, b], [0.0, b + 1.0]], dtype=np.float32)
+    y = np.array([score(v) for v in p], dtype=np.float32)
+    n_eval = 0
+
+    def trial(psum, ihi, fac):
+        fac1 = np.float32((1.0 - fac) / 2)
+        ptry = psum * fac1 - p[ihi] * np.float32(fac1 - fac)
+        ytry = score(ptry)
+        if ytry < y[ihi]:  # better than the highest, replace the highest
+            y[ihi] = ytry
+            psum += ptry - p[ihi]
+            p[ihi] = ptry
+        return ytry
+
+    psum = p.sum(axis=0)
+    while True:
+        order = np.argsort(y, kind="stable")
+        ilo, inhi, ihi = order[0], order[1], order[2]
+        rtol = 2.0 * abs(y[ihi] - y[ilo]) / (abs(y[ihi]) + abs(y[ilo]) + 1.0e-10)
+        if rtol < ftol or n_eval >= nmax:
+            break
+
+        n_eval += 2
+        ytry = trial(psum, ihi, -1.0)
+        if ytry <= y[ilo]:
+            trial(psum, ihi, 2.0)
+        elif ytry >= y[inhi]:
+            ysave = y[ihi]
+            ytry = trial(psum, ihi, 0.5)
+            if ytry >= ysave:  # contract around the lowest point
+                for i in range(3):
+                    if i != ilo:
+                        p[i] = 0.5 * (p[i] + p[ilo])
+                        y[i] = score(p[i])
+                n_eval += 2
+                psum = p.sum(axis=0)
+        else:
+            n_eval -= 1
+
+    return float(p[ilo][0]), float(p[ilo][1]), float(y[ilo])
+
+
+def fit_pkout(titr_type, points, monte_temp):
+    """Fit the titration curves of the ionizable residues in fort.38 and write pK.out."""
+    residues = []
+    curves = {}
+    for line in open(fname_occ_table).readlines()[1:]:
+        fields = line.split()
+        if not fields:
+            continue
+        uniq_id = fields[0]
+        if uniq_id[3] not in "+-":  # charged conformers only
+            continue
+        head = uniq_id[:4] + uniq_id[5:11]
+        if head not in curves:
+            residues.append(head)
+            curves[head] = np.zeros(len(points))
+        curves[head] += np.array([float(x) for x in fields[1:]])
+
+    xp = np.array(points)
+    x_first = xp[0]
+    x_last = xp[-1]
+    fits = []  # residue, fit result as printed, point of the mfe columns
+    for head in residues:
+        yp = curves[head]
+        if np.min(np.abs(yp - 0.5)) >= 0.485:  # no point near the midpoint, report the direction
+            if abs(yp[0] - yp[-1]) > 0.5:
+                fits.append((head, "        %-25s" % "titration curve too sharp", xp[len(xp) // 2]))
+            elif (yp[0] > 0.985) == ("+" in head):
+                fits.append((head, "        >%-24.1f" % x_last, x_last))
+            else:
+                fits.append((head, "        <%-24.1f" % x_first, x_first))
+            continue
+
+        a, b, chi2 = fit_curve(xp, yp)
+        if titr_type == "p":
+            n = abs(a * 8.617342E-2 * monte_temp / 58.0)
+        else:
+            n = abs(a * 8.617342E-2 * monte_temp)
+
+        if b < x_first:
+            fits.append((head, "        <%-24.1f" % x_first, x_first))
+        elif b > x_last:
+            fits.append((head, "        >%-24.1f" % x_last, x_last))
+        else:
+            fits.append((head, "    %9.3f %9.3f %9.3f" % (b, n, 1000 * chi2), b))
+
+    write_mfe(titr_type, x_first, x_last, fits)
+
+
+def write_mfe(titr_type, x_first, x_last, fits):
+    """Write pK.out with the mfe columns of each residue, and respair.lst, as mcce does after the fit."""
+    from mfe import MFE, terms, env, PH2KCAL, MEV2KCAL  # reads run.prm, head3.lst and energies of the working directory
+
+    mfe_point = str(env.runprm.get("MFE_POINT", "f"))
+    if "f" not in mfe_point.lower() and x_first <= float(mfe_point) <= x_last:
+        mfe_points = [float(mfe_point)] * len(fits)
+    else:
+        mfe_points = [point for _, _, point in fits]
+    cutoff = float(env.runprm.get("MFE_CUTOFF", -1.0))
+    unit = PH2KCAL if titr_type == "p" else MEV2KCAL
+
+    mfe = MFE([head[:3] + head[4:] for head, _, _ in fits])
+    if titr_type == "p":
+        lines = ["  pH      "]
+    else:
+        lines = ["  Eh      "]
+    lines.append("       pKa/Em  n(slope) 1000*chi2       vdw0      vdw1      tors      ebkb      dsol    offset"
+                 "     pHpK0     EhEm0       -TS  residues      total\n")
+    pair_lines = [" residue    partner         vdw     ele  pairwise  charge\n"]
+    for row, (head, fit, _) in enumerate(fits):
+        values, _ = mfe.at_point(mfe_points[row], rows=[row])
+        values["TS"] = 0.0 - values["TS"]  # the column is -TS
+        lines.append(head + fit + " " + "".join([" %9.2f" % (values[term][0] / unit) for term in terms[:-1]])
+                     + " %10.2f\n" % (values[terms[-1]][0] / unit))
+        for partner, vdw, ele, pw, crg in zip(mfe.all_resids, *mfe.pairs_at_point(mfe_points[row], row)):
+            if abs(pw) < cutoff:
+                continue
+            pair_lines.append("%s  %s   %9.2f %9.2f %9.2f %9.2f\n" % (head, partner, vdw / unit, ele / unit, pw / unit, crg))
+
+    open(fname_pkout, "w").writelines(lines)
+    open(fname_respair, "w").writelines(pair_lines)
+
+
+def run_parallel(runprm, mcce, n_workers, points_per_job):
+    """Split the titration of runprm into jobs of points_per_job points, run them with at most
+    n_workers mcce processes at a time and merge the output. Return the speedup, which is the
+    CPU time of all jobs over the wall time of the pool.
+    """
+    titr_type, points = titration_points(runprm)
+    seed = int(runprm.get("MONTE_SEED", -1))
+    if seed < 0:
+        seed = int(time.time()) % 1000000
+    mcce_exe = shutil.which(mcce)
+    if mcce_exe:
+        mcce = os.path.abspath(mcce_exe)
+
+    jobs = []
+    for first in range(0, len(points), points_per_job):
+        n_points = min(points_per_job, len(points) - first)
+        folder = os.path.join(job_folder, "%03d" % len(jobs))
+        entries = job_runprm(runprm, titr_type, points[first], n_points, seed + len(jobs))
+        prepare_job(folder, entries)
+        jobs.append((folder, points[first], points[first + n_points - 1], seed + len(jobs)))
+
+    print("   Running %d titration points as %d jobs on %d workers" % (len(points), len(jobs), n_workers))
+    timer_start = time.time()
+    failed = False
+    cpu_seconds = []
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(run_job, mcce, job[0]) for job in jobs]
+        for (folder, x_first, x_last, job_seed), future in zip(jobs, futures):
+            returncode, seconds = future.result()
+            cpu_seconds.append(seconds)
+            print("   Job %s: points %8.2f to %8.2f, seed %d, %8.1f CPU seconds" % (folder, x_first, x_last, job_seed, seconds))
+            if returncode or not os.path.isfile(os.path.join(folder, fname_occ_table)):
+                print("   Job %s failed, see %s" % (folder, os.path.join(folder, "step4.log")))
+                failed = True
+    wall_seconds = time.time() - timer_start
+
+    if failed:
+        print("   FATAL: not all titration jobs finished, job folders are kept in %s/" % job_folder)
+        sys.exit()
+
+    folders = [job[0] for job in jobs]
+    header = table_header(titr_type, points)
+    merge_table(fname_occ_table, folders, header)
+    merge_table(fname_entropy, folders, header)
+    with open(fname_mc_out, "w") as fh:
+        for folder in folders:
+            fh.writelines(open(os.path.join(folder, fname_mc_out)).readlines())
+    for folder in folders:
+        job_ms_folder = os.path.join(folder, ms_folder)
+        if os.path.isdir(job_ms_folder):
+            if not os.path.isdir(ms_folder):
+                os.makedirs(ms_folder)
+            for fname in os.listdir(job_ms_folder):
+                os.replace(os.path.join(job_ms_folder, fname), os.path.join(ms_folder, fname))
+    fit_pkout(titr_type, points, float(runprm.get("MONTE_T", 298.15)))
+    shutil.rmtree(job_folder)
+
+    speedup = sum(cpu_seconds) / wall_seconds
+    print("   Total time on MC: %.1f seconds wall, %.1f CPU seconds in jobs, speedup %.2f" % (wall_seconds, sum(cpu_seconds), speedup))
+
+    return speedup
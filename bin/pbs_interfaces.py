@@ -13,9 +13,10 @@ import math
 import os
 from pathlib import Path
 import struct
-import subprocess
 import sys
 
+from step3_profile import PROFILE, run_solver, timed
+
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -47,6 +48,7 @@ class PBS_TEMPLATE:
         self.epsilon_solv = 80.0        # default dielectric constant for solvent
         return
 
+    @timed("write")
     def write_pqr(self, bound):
         """
         This is a help function. It writes 3 pqr files in PBE solver working directory
@@ -76,6 +78,7 @@ class PBS_TEMPLATE:
             lines.append(line)
         return lines
 
+    @timed("write")
     def write_run_options(self, run_options):
         """
         Write command options passed to this object into file run_options.txt.
@@ -108,7 +111,7 @@ class PBS_TEMPLATE:
             # ...
 
             # Run PBE solver and save the log to result
-            result = subprocess.run([self.exe], capture_output=True, text=True)
+            result = run_solver([self.exe])
 
             # Obtain rxn0 from the log file as an example of extracting information from stdout
             lines = result.stdout.split("\n")
@@ -125,7 +128,7 @@ class PBS_TEMPLATE:
         # Use bound.single_bnd_xyzrcp
 
         # Run PBE solver and save the log to result
-        result = subprocess.run([self.exe], capture_output=True, text=True)
+        result = run_solver([self.exe])
         # update p in bound.single_bnd_xyzrcp
         # Obtain rxn
         rxn = -4.500
@@ -136,7 +139,7 @@ class PBS_TEMPLATE:
         # Use bound.multi_bnd_xyzrcp
 
         # Run PBE solver and save the log to result
-        result = subprocess.run([self.exe], capture_output=True, text=True)
+        result = run_solver([self.exe])
         # update p in bound.multi_bnd_xyzrcp
 
         return (rxn0, rxn)
@@ -188,6 +191,7 @@ class PBS_DELPHI:
 
         return depth
 
+    @timed("write")
     def write_fort15(self, xyzrcp):
         i = 1
         with open("fort.15", "w") as fh:
@@ -197,6 +201,7 @@ class PBS_DELPHI:
                 i += 1
         return
 
+    @timed("write")
     def write_fort13(self, xyzrcp):
         struct_fmt = '=ifffffi'
         with open("fort.13", "wb") as fh:
@@ -205,6 +210,7 @@ class PBS_DELPHI:
                 fh.write(record_unf)
         return
 
+    @timed("parse")
     def collect_phi(self, depth, xyzrcp):
         # collect results from the log
         try:
@@ -237,6 +243,7 @@ class PBS_DELPHI:
         return
 
 
+    @timed("parse")
     def collect_rxn(self, log):
         log_lines = log.split("\n")
         found = False
@@ -312,7 +319,7 @@ class PBS_DELPHI:
                 fh.write("energy(g,an,sol)\n")   # g for grid energy, sol for corrected rxn
 
             # 1st and only delphi run
-            result = subprocess.run([self.exe], capture_output=True, text=True)
+            result = run_solver([self.exe])
             rxn0 = self.collect_rxn(result.stdout)
 
         depth = self.depth(bound)
@@ -364,7 +371,7 @@ class PBS_DELPHI:
             fh.write("energy(g,an,sol)\n")   # g for grid energy, sol for corrected rxn
 
         # 1st delphi run
-        result = subprocess.run([self.exe], capture_output=True, text=True)
+        result = run_solver([self.exe])
         if result.returncode != 0:
             logger.critical(f"Delphi failed with error:\n{result.stderr}")
             sys.exit(1)
@@ -389,7 +396,7 @@ class PBS_DELPHI:
                 fh.write("site(a,c,p)\n")
                 fh.write("energy(g,an,sol)\n")  # g for grid energy, sol for corrected rxn
 
-            result = subprocess.run([self.exe], capture_output=True, text=True)
+            result = run_solver([self.exe])
             if result.returncode != 0:
                 logger.critical(f"Delphi failed with error:\n{result.stderr}")
                 sys.exit(1)
@@ -442,7 +449,7 @@ class PBS_DELPHI:
             fh.write("energy(g,an,sol)\n")   # g for grid energy, sol for corrected rxn
 
         # 1st delphi run
-        result = subprocess.run([self.exe], capture_output=True, text=True)
+        result = run_solver([self.exe])
         if result.returncode != 0:
             logger.critical(f"Delphi failed with error:\n{result.stderr}")
             sys.exit(1)
@@ -464,7 +471,7 @@ class PBS_DELPHI:
                 fh.write("out(phi,file=\"run%02d.phi\")\n" % (i+1))
                 fh.write("site(a,c,p)\n")
                 fh.write("energy(g,an,sol)\n")  # g for grid energy, sol for corrected rxn
-            result = subprocess.run([self.exe], capture_output=True, text=True)
+            result = run_solver([self.exe])
             if result.returncode != 0:
                 logger.critical(f"Delphi failed with error:\n{result.stderr}")
                 sys.exit(1)
@@ -512,6 +519,7 @@ class PBS_NGPB:
             self.my_env["LD_LIBRARY_PATH"] = open(".ld_library_path").read().strip()
         return
     
+    @timed("write")
     def write_option_file(self, center, number_grid, energy, atoms_w):
         with open("options.pot", "w") as fh:
             fh.write("#Parameters file\n")
@@ -551,6 +559,7 @@ class PBS_NGPB:
             fh.write("solver_options = -p\ ssor\ -ssor_omega\ 0.51\ -i\ cgs\ -tol\ 1.e-4\ -print\ 2\ -conv_cond\ 2\ -tol_w\ 0 \n")
             fh.write("[../]\n")
 
+    @timed("write")
     def write_pqr(self, bound):
         i = 1
         with open("float.pqr", "w") as fh:
@@ -572,6 +581,7 @@ class PBS_NGPB:
                 i += 1
         return
     
+    @timed("parse")
     def collect_energy(self, log: str):
         #log_lines = log.split("\n")
         #logger.info("Number of log_lines %d" % len(log_lines))
@@ -590,6 +600,7 @@ class PBS_NGPB:
 
         return pol
 
+    @timed("parse")
     def collect_phi(self, xyzrcp):
         """Collect results from the log"""
         try:
@@ -652,7 +663,7 @@ class PBS_NGPB:
             command = []
             command = self.exe.copy()
             command.append('float.pqr')
-            result = subprocess.run(command, capture_output=True, text=True, env=self.my_env)
+            result = run_solver(command, env=self.my_env)
             rxn0 = self.collect_energy(result.stdout)
 
         rxn = 0.0
@@ -676,7 +687,7 @@ class PBS_NGPB:
         command = []
         command = self.exe.copy()
         command.append('single.pqr')
-        result = subprocess.run(command, capture_output=True, text=True, env=self.my_env)
+        result = run_solver(command, env=self.my_env)
         rxn = self.collect_energy(result.stdout)
         self.collect_phi(bound.single_bnd_xyzrcp)
 
@@ -700,7 +711,7 @@ class PBS_NGPB:
         command = []
         command = self.exe.copy()
         command.append('multi.pqr')
-        result = subprocess.run(command, capture_output=True, text=True, env=self.my_env)
+        result = run_solver(command, env=self.my_env)
         # Test result, if result is error, exit
         if result.returncode != 0:
             logger.critical(f"NGPB failed with error:\n{result.stderr}")
@@ -742,6 +753,7 @@ class PBS_ZAP:
         #self.pdbfile = ""
         return
 
+    @timed("write")
     def InterfaceData_writer(self, pdbfile):
         self.InterfaceData = f"""
         !PARAMETER -in
@@ -803,6 +815,7 @@ class PBS_ZAP:
         
         return True      
 
+    @timed("write")
     def xyzrc_to_pdb(self, bound):
         i = 1
         element = "X"
@@ -825,6 +838,7 @@ class PBS_ZAP:
                 i += 1
         return
     
+    @timed("parse")
     def collect_phi(self, phi_zap, xyzrcp):
         # collect results from the log
         for counter in range(len(xyzrcp)):
@@ -900,7 +914,8 @@ class PBS_ZAP:
             zap.SetGridSpacing(itf.GetFloat("-grid_spacing"))
             zap.SetSaltConcentration(salt_concentration)
            
-            solv = zap.CalcSolvationEnergy()
+            with PROFILE.phase("solve"):
+                solv = zap.CalcSolvationEnergy()
             print(f"Solv(kcal) = {self.KCalsPerKT * solv:.3f}")
 
             rxn0 = solv * self.KCalsPerKT
@@ -947,12 +962,14 @@ class PBS_ZAP:
         zap.SetGridSpacing(itf.GetFloat("-grid_spacing"))
         zap.SetSaltConcentration(salt_concentration)
 
-        solv = zap.CalcSolvationEnergy()
+        with PROFILE.phase("solve"):
+            solv = zap.CalcSolvationEnergy()
         print(f"Solv(kcal) = {self.KCalsPerKT * solv:.3f}")
         rxn = solv * self.KCalsPerKT
 
         apot = self.oechem.OEFloatArray(mol.GetMaxAtomIdx())
-        zap.CalcAtomPotentials(apot)
+        with PROFILE.phase("solve"):
+            zap.CalcAtomPotentials(apot)
         self.collect_phi(apot, bound.single_bnd_xyzrcp)
 
         ########################################################
@@ -996,7 +1013,8 @@ class PBS_ZAP:
         zap.SetSaltConcentration(salt_concentration)
 
         apot = self.oechem.OEFloatArray(mol.GetMaxAtomIdx())
-        zap.CalcAtomPotentials(apot)
+        with PROFILE.phase("solve"):
+            zap.CalcAtomPotentials(apot)
         self.collect_phi(apot, bound.multi_bnd_xyzrcp)
 
         return (rxn0, rxn)
@@ -1020,6 +1038,7 @@ class PBS_APBS:
         #self.pdbfile = ""
         return
 
+    @timed("write")
     def write_pqr(self, bound):
         i = 1
         with open("float.pqr", "w") as fh:
@@ -1041,6 +1060,7 @@ class PBS_APBS:
                 i += 1
         return
 
+    @timed("parse")
     def collect_energy(self, log):
         log_lines = log.split("\n")
         found_pol  = False
@@ -1057,6 +1077,7 @@ class PBS_APBS:
 
         return pol
 
+    @timed("parse")
     def collect_phi(self, xyzrcp):
         # collect results from the log
         try:
@@ -1102,6 +1123,7 @@ class PBS_APBS:
     #    print(dime)
     #    return dime
 
+    @timed("write")
     def APBS_input_writer(self, pqr, dime, cglen, fglen, cent):
          input_string = f"""
          # READ IN MOLECULES
@@ -1186,7 +1208,7 @@ class PBS_APBS:
              f.write(apbs_input)
 
         # Run the APBS command
-        result = subprocess.run(["apbs", "apbs_input.in"], capture_output=True, text=True)
+        result = run_solver(["apbs", "apbs_input.in"])
         print(result.stdout)
         print(result.stderr)
 
@@ -5,11 +5,14 @@ import math
 import os
 import logging
 import glob
-import time
 import copy
 import numpy as np
 
 from geom import *
+from protein_arrays import ProteinArrays
+
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4.ftpl_cache import ftpl_records, load_param_records
 
 
 logger = logging.getLogger(__name__)
@@ -39,6 +42,10 @@ def ddvv(xyz1, xyz2):
     return dx*dx+dy*dy+dz*dz
 
 class Atom:
+    __slots__ = ("serial", "name", "altLoc", "resName", "chainID", "resSeq", "iCode", "confNum",
+                 "atomID", "confID", "confType", "resID", "xyz", "connectivity_param",
+                 "r_bound", "charge", "r_vdw", "e_vdw", "connect12", "connect13", "connect14", "history")
+
     def __init__(self):
         self.serial = 0
         self.name = "  X "
@@ -172,42 +179,31 @@ class Protein:
         return
 
     def loadpdb(self, fname):
-        rawlines = open(fname).readlines()
-        lines = [x.strip("\n") for x in rawlines if x[:6] == "ATOM  " or x[:6] == "HETATM"]
+        with open(fname) as fh:
+            lines = [x.strip("\n") for x in fh if x[:6] == "ATOM  " or x[:6] == "HETATM"]
+
+        # look up residues and conformers by ID, in one pass over the atom lines
+        residues = {}      # resID -> Residue
+        conformers = {}    # confID -> Conformer
         for line in lines:
             atom = Atom()
             atom.loadline(line)
-            # reverse search if this atom belongs to an existing conformer and residue
-            found_conf = False
-            found_res = False
-            for i_res in range(len(self.residue) - 1, -1, -1):
-                insert_res = i_res
-                for i_conf in range(len(self.residue[i_res].conf) - 1, -1, -1):
-                    if self.residue[i_res].conf[i_conf].confID == atom.confID:
-                        found_conf = True
-                        self.residue[i_res].conf[i_conf].atom.append(atom)
-                        break
-                if found_conf:
-                    break
-                elif self.residue[i_res].resID == atom.resID:  # not in conf but residue ID matches
-                    conf = Conformer()
-                    conf.confID = atom.confID
-                    conf.resID = atom.resID
-                    conf.history = atom.history
-                    conf.atom.append(atom)
-                    self.residue[i_res].conf.append(conf)
-                    found_res = True
-
-            if not found_conf and not found_res:  # new residue
+            conf = conformers.get(atom.confID)
+            if conf is None:   # new conformer
                 conf = Conformer()
                 conf.confID = atom.confID
                 conf.resID = atom.resID
                 conf.history = atom.history
-                conf.atom.append(atom)
-                res = Residue()
-                res.resID = conf.resID
+                conformers[conf.confID] = conf
+
+                res = residues.get(atom.resID)
+                if res is None:   # new residue
+                    res = Residue()
+                    res.resID = conf.resID
+                    residues[res.resID] = res
+                    self.residue.append(res)
                 res.conf.append(conf)
-                self.residue.append(res)
+            conf.atom.append(atom)
 
         # Insert an empty conformer for cofactors that do not have backbone
         for res in self.residue:
@@ -451,44 +447,46 @@ class Protein:
                     print("---->Atom %s" % atom.atomID)
         return
 
+    def make_arrays(self):
+        """Export the atoms to read-only arrays, see protein_arrays.ProteinArrays."""
+        self.arrays = ProteinArrays(self)
+        return self.arrays
+
     def calc_vdw(self, verbose=False):
         # do it on two sides so the two-way interaction numbers can be checked
-        for res1 in self.residue:
-
+        # conformer pairs are evaluated on the array export, one conformer against all partners at a time
+        arrays = self.make_arrays()
+        side_k = []     # side chain conformers of all residues, in residue order
+        side_res = []
+        for i_res, res in enumerate(self.residue):
+            for j in range(1, len(res.conf)):
+                side_k.append(arrays.res_conf_start[i_res] + j)
+                side_res.append(i_res)
+        side_k = np.array(side_k, dtype=np.int64)
+        side_res = np.array(side_res, dtype=np.int64)
+        bk_k = arrays.res_conf_start[:-1]   # backbone conformer of each residue
+
+        for i_res, res1 in enumerate(self.residue):
             if len(res1.conf) <= 1:
                 continue    # only backbone
-            for conf1 in res1.conf[1:]:
+            # within its own residue, a conformer only interacts with itself
+            first = np.searchsorted(side_res, i_res)
+            last = np.searchsorted(side_res, i_res, side="right")
+            for j, conf1 in enumerate(res1.conf[1:], 1):
                 if verbose:
                     print("   vdw - %s ..." % conf1.confID)
-                saved_time = time.time()
+                k1 = arrays.res_conf_start[i_res] + j
+                partners = np.concatenate((side_k[:first], [k1], side_k[last:]))
+                vdw = vdw_confs(arrays, k1, partners)
 
                 # compute vdw0
-                conf1.vdw0 = vdw_conf(conf1, conf1)
-
-                for res2 in self.residue:
-                    if len(res2.conf) == 1:
-                        continue  # only backbone
-                    if res1 == res2: # we need to do self to self vdw - vdw0
-                        vdw = vdw_conf(conf1, conf1)
-                        if abs(vdw) > 0.001:
-                            self.vdw_pw[(conf1.confID, conf1.confID)] = vdw
-                        continue
-                    for conf2 in res2.conf[1:]:
-                        vdw = vdw_conf(conf1, conf2)
-                        if abs(vdw) > 0.001:
-                            #print("%s - %s: %.3f" % (conf1.confID, conf2.confID, vdw))
-                            self.vdw_pw[(conf1.confID, conf2.confID)] = vdw
-
+                conf1.vdw0 = float(vdw[first])
+                for k2, value in zip(partners, vdw):
+                    if abs(value) > 0.001:
+                        self.vdw_pw[(conf1.confID, arrays.confID[k2])] = float(value)
 
                 # compute vdw1, vdw to all backbone
-                vdw1 = 0.0
-                for res2 in self.residue:
-                    conf2 = res2.conf[0]
-                    vdw = vdw_conf(conf1, conf2)
-                    vdw1 += vdw
-                conf1.vdw1 = vdw1
-                elapsed = time.time() - saved_time
-                #print("   %s ... %.3f seconds" % (conf1.confID, elapsed))
+                conf1.vdw1 = float(vdw_confs(arrays, k1, bk_k).sum())
 
     def calc_vdw_virtual(self, delta="", verbose=False):
         # Create virtual conformers
@@ -529,10 +527,23 @@ class Protein:
     def calc_tors(self) -> None:
         """Calculate torsion energy for all conformers, update conformer tors in-place.
         """
+        confs = []
         for res in self.residue:
             if len(res.conf) <= 1: continue    # only backbone
-            for conf in res.conf[1:]:
-                conf.tors = torsion_conf(conf)
+            confs.extend(res.conf[1:])
+
+        # Collect the torsion quadruplets of all conformers, compute all energies in one vectorized pass
+        # and scatter the results back per conformer.
+        quads = []
+        owners = []
+        for i_conf, conf in enumerate(confs):
+            for quad in torsion_quadruplets(conf):
+                quads.append(quad)
+                owners.append(i_conf)
+
+        tors = np.bincount(np.array(owners, dtype=int), weights=torsion_energies(quads), minlength=len(confs))
+        for conf, e in zip(confs, tors):
+            conf.tors = float(e)
 
     def calc_tors_virtual(self):
         """
@@ -696,28 +707,10 @@ class ENV:
             print("%s:%s" % (key, value))
 
     def read_ftpl_file(self, fname):
-        lines = open(fname).readlines()
-        for line in lines:
-            end = line.find("#")
-            line = line[:end]
-            fields = line.split(":")
-            if len(fields) != 2:
-                continue
-
-            key_string = fields[0].strip()
-            keys = key_string.split(",")
-            key1 = keys[0].strip().strip("\"")
-            if len(keys) > 1:
-                key2 = keys[1].strip().strip("\"")
-            else:
-                key2 = ""
-            if len(keys) > 2:
-                key3 = keys[2].strip().strip("\"")
-            else:
-                key3 = ""
-
-            value_string = fields[1].strip()
+        self.load_ftpl_records(ftpl_records(fname))
 
+    def load_ftpl_records(self, records):
+        for key1, key2, key3, value_string in records:
             # Connectivity records
             if key1 == "CONFLIST":
                 self.param[(key1, key2)] = [x.strip() for x in value_string.strip().split(",")]
@@ -735,29 +728,22 @@ class ENV:
         else:
             ftpldir = self.runprm["MCCE_HOME"]+"/param"
         cwd = os.getcwd()
-        os.chdir(ftpldir)
 
-        files = glob.glob("*.ftpl")
-        files.sort()
+        # records of the parameter folder come from the compiled parameter cache,
+        # which is rebuilt when any source file changes
         logger.info("Reading parameters from %s" % ftpldir)
-        for fname in files:
-            self.read_ftpl_file(fname)
-
+        param_records = load_param_records(ftpldir)
+        for fname, records in param_records.items():
+            if fname.endswith(".ftpl"):
+                self.load_ftpl_records(records)
 
         # Update vdw with 00always_needed.tpl
         fname = "00always_needed.tpl"
-        lines = open(fname).readlines()
-        logger.info("Updating vdw parameters from %s" % os.path.abspath(fname))
-        for line in lines:
-            end = line.find("#")
-            line = line[:end].strip()
-            if len(line) < 20:
-                continue
-            key1 = line[:9].strip()
-            key2 = line[9:15].strip()
-            key3 = line[15:19]
+        records = param_records[fname]
+        logger.info("Updating vdw parameters from %s" % os.path.abspath(os.path.join(ftpldir, fname)))
+        for key1, key2, key3, value_str in records:
             if key1=="VDW_RAD" or key1=="VDW_EPS":
-                value = float(line[20:].strip())
+                value = float(value_str.strip())
                 # print("%s %s \"%s\" : %.4f" % (key1, key2, key3, value))
                 new_key = ("RADIUS", key2, key3)
                 if new_key in self.param:
@@ -771,24 +757,14 @@ class ENV:
                     param_value.e_vdw = value
                 self.param[new_key] = param_value
 
-        logger.info("Loading TORSION parameters from %s" % os.path.abspath(fname))
-        for line in lines:
-            end = line.find("#")
-            line = line[:end].strip()
-            if len(line) < 20:
-                continue
-            key1 = line[:9].strip()
-            key2 = line[9:15].strip()
-            key3 = line[15:19]
+        logger.info("Loading TORSION parameters from %s" % os.path.abspath(os.path.join(ftpldir, fname)))
+        for key1, key2, key3, value_str in records:
             if key1 == "TORSION":
                 new_key = (key1, key2, key3)  # key1: TORSION, key2: residue name, key3: 4-char atom name
-                param_value = TORSION_param(line[20:])
+                param_value = TORSION_param(value_str)
                 self.param[new_key] = param_value
 
-
-        os.chdir(cwd)
-
-        # read from user_param
+        # read from user_param, parsed from source as it belongs to this run and is not cached
         ftpldir = "user_param"
         if os.path.isdir(ftpldir):
             print("Reading parameters from %s" % ftpldir)
@@ -939,6 +915,64 @@ def vdw_conf(conf1, conf2, cutoff=0.001, verbose=False, display=False):
 
     return vdw
 
+def vdw_confs(arrays, k1, ks):
+    """Vectorized vdw_conf() of conformer k1 to conformers ks of a ProteinArrays.
+    Returns an array of conformer vdw values, one per conformer in ks.
+    """
+    ks = np.asarray(ks, dtype=np.int64)
+    vdw = np.zeros(len(ks))
+
+    # blob screening
+    d = np.sqrt(((arrays.blob_center[ks] - arrays.blob_center[k1]) ** 2).sum(axis=1))
+    near = np.flatnonzero(~(d > arrays.blob_radius[k1] + 6 + arrays.blob_radius[ks]))
+    atoms1 = np.arange(arrays.conf_start[k1], arrays.conf_start[k1 + 1])
+    counts = arrays.conf_start[ks[near] + 1] - arrays.conf_start[ks[near]]
+    if len(atoms1) == 0 or counts.sum() == 0:
+        return vdw
+    atoms2 = np.repeat(arrays.conf_start[ks[near]], counts) + \
+             np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    column_conf = np.repeat(np.arange(len(near)), counts)
+
+    diff = arrays.xyz[atoms1][:, np.newaxis, :] - arrays.xyz[atoms2][np.newaxis, :, :]
+    d2 = (diff * diff).sum(axis=2)
+
+    # self, 1-2 and 1-3 pairs are excluded, 1-4 pairs are scaled
+    position = np.full(arrays.n_atom, -1, dtype=np.int64)
+    position[atoms2] = np.arange(len(atoms2))
+    excluded = atoms1[:, np.newaxis] == atoms2[np.newaxis, :]
+    for order in (12, 13):
+        rows, idx = arrays.connect_pairs(atoms1, order)
+        cols = position[idx]
+        excluded[rows[cols >= 0], cols[cols >= 0]] = True
+    scale = np.ones(d2.shape)
+    rows, idx = arrays.connect_pairs(atoms1, 14)
+    cols = position[idx]
+    scale[rows[cols >= 0], cols[cols >= 0]] = VDW_SCALE14
+
+    active = (diff < VDW_CUTOFF_FAR).all(axis=2) & ~excluded & ~(d2 > VDW_CUTOFF_FAR2)
+    p_lj = np.zeros(d2.shape)
+    p_lj[active & (d2 < VDW_CUTOFF_NEAR2)] = 999.0
+    i1, i2 = np.nonzero(active & ~(d2 < VDW_CUTOFF_NEAR2))
+    d2_lj = d2[i1, i2]
+    r = np.sqrt(d2_lj)
+    r0 = arrays.r_vdw[atoms1[i1]] + arrays.r_vdw[atoms2[i2]]
+    eps = np.sqrt(arrays.e_vdw[atoms1[i1]] * arrays.e_vdw[atoms2[i2]])
+    sig_d2 = r0 * r0 / d2_lj
+    sig_d6 = sig_d2 * sig_d2 * sig_d2
+    sig_d12 = sig_d6 * sig_d6
+    p = 6
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p_lj[i1, i2] = scale[i1, i2] * np.where(r < r0,
+                                                (eps * (np.log(r0 / r) * (sig_d2)**(p/2))) - eps,
+                                                eps * (sig_d12 - 2.0 * sig_d6))
+
+    vdw_near = np.bincount(column_conf, weights=p_lj.sum(axis=0), minlength=len(near))
+    vdw_near[vdw_near >= VDW_UPLIMIT] = 999.0
+    vdw_near[ks[near] == k1] *= 0.5
+    vdw[near] = vdw_near
+
+    return vdw
+
 def vdw_atom(atom1, atom2):
     # A good post: https://mattermodeling.stackexchange.com/questions/4845/how-to-create-a-lookup-table-of-%CF%B5-and-%CF%83-values-for-lennard-jones-potentials
     # Parameter source: http://mackerell.umaryland.edu/charmm_ff.shtml#gromacs
@@ -1112,14 +1146,22 @@ def torsion_conf(conf):
     return e;
         
     """
-    e = 0.0   # default value
+    return float(torsion_energies(torsion_quadruplets(conf)).sum())
+
+
+def torsion_quadruplets(conf):
+    """
+    Find the torsion atom quadruplets of a conformer that have TORSION parameters
+    :param conf: Input conformer
+    :return: list of (atom0, atom1, atom2, atom3, t_param) tuples
+    """
+    quads = []
     for atom in conf.atom:
         key1 = "TORSION"
         key2 = atom.confType
         key3 = atom.name
         key = (key1, key2, key3)
-        k_tor_e = 0.0
-        
+
         found = False
         if key in env.param:
             found = True
@@ -1147,19 +1189,64 @@ def torsion_conf(conf):
                                 if found: break
                                 if atom3_name == a3.name:
                                     found = True
-                                    atom1 = a1
-                                    atom2 = a2
-                                    atom3 = a3
+                                    quads.append((atom0, a1, a2, a3, t_param))
                                     break
-            if found:
-                #print(atom0.name, atom1.name, atom2.name, atom3.name)
-                phi = torsion_angle(atom0.xyz, atom1.xyz, atom2.xyz, atom3.xyz)
-                for term in t_param.tors_terms:
-                    k_tor_e += torsion(phi, term)
 
-        e += k_tor_e
+    return quads
 
-    return e
+
+def torsion_angles(xyz):
+    """Vectorized torsion_angle() over many quadruplets
+    :param xyz: coordinates of the 4 points of M torsions
+    :type xyz: array of shape (M, 4, 3)
+    :return: torsion angles in radians, in [0, 2*pi)
+    :rtype: array of shape (M,)
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 4, 3)
+    r21 = xyz[:, 1] - xyz[:, 2]
+    r10 = xyz[:, 0] - xyz[:, 1]
+    r23 = xyz[:, 3] - xyz[:, 2]
+    k = r21 / np.linalg.norm(r21, axis=1)[:, np.newaxis]
+    i = r23 - k * np.einsum("ij,ij->i", k, r23)[:, np.newaxis]
+    i = i / np.linalg.norm(i, axis=1)[:, np.newaxis]
+    j = np.cross(k, i)
+    r10_p = r10 - k * np.einsum("ij,ij->i", k, r10)[:, np.newaxis]
+    r10_p = r10_p / np.linalg.norm(r10_p, axis=1)[:, np.newaxis]
+
+    cos_theta = np.clip(np.einsum("ij,ij->i", r10_p, i), -1.0, 1.0)
+    angle = np.arccos(cos_theta)
+    flip = np.einsum("ij,ij->i", r10_p, j) < 0.0
+    angle[flip] = 2*np.pi - angle[flip]
+
+    return angle
+
+
+def torsion_energies(quads):
+    """
+    Calculate torsion energies of many quadruplets in one pass
+    :param quads: list of (atom0, atom1, atom2, atom3, t_param) as returned by torsion_quadruplets()
+    :return: array of torsion energy values in kcal/mol, one per quadruplet
+    """
+    m = len(quads)
+    if m == 0:
+        return np.zeros(0)
+
+    xyz = np.array([[q[0].xyz, q[1].xyz, q[2].xyz, q[3].xyz] for q in quads], dtype=float)
+    phi = torsion_angles(xyz)
+
+    # Multi-term Fourier series, terms padded with v2 = 0
+    n_term = max(len(q[4].tors_terms) for q in quads)
+    v2 = np.zeros((m, n_term))
+    n_fold = np.zeros((m, n_term))
+    gamma = np.zeros((m, n_term))
+    for i_quad, q in enumerate(quads):
+        for i_term, term in enumerate(q[4].tors_terms):
+            v2[i_quad, i_term] = term.v2
+            n_fold[i_quad, i_term] = term.n_fold
+            gamma[i_quad, i_term] = term.gamma
+
+    e = v2 * (1.0 + np.cos(n_fold * phi[:, np.newaxis] - gamma))
+    return e.sum(axis=1)
 
 
 def torsion(phi, term):
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Module: protein_arrays.py
+
+Array export for the vdw, boundary and clash loops of step3, from the Protein model in pdbio_gr.py.
+
+ProteinArrays copies the atoms of a Protein in residue -> conformer -> atom order into
+contiguous NumPy arrays: xyz, radii, charge, names, conformer and residue offsets and the
+1-2, 1-3 and 1-4 connectivity in CSR form. Protein.calc_vdw, the multi side chain dielectric
+boundary and the clash detection of postprocess_ele read these arrays instead of walking the
+Atom objects.
+
+The Atom objects remain the only owners of the data. The export is a snapshot: its arrays
+are not writeable, and it has to be rebuilt after the atoms change. It is an extra copy
+and does not reduce the memory of the model.
+"""
+
+import numpy as np
+
+
+class ProteinArrays:
+    """Read-only array export of a Protein for the vdw, boundary and clash loops.
+
+    Atom k of conformer c is atom conf_start[c] + k; conformer j of residue r is conformer
+    res_conf_start[r] + j, so conformer 0 of a residue is its backbone.
+    """
+
+    def __init__(self, protein):
+        atoms = []
+        self.confID = []
+        self.conf_index = {}   # confID -> conformer index
+        conf_start = [0]
+        res_conf_start = [0]
+        blob_center = []
+        blob_radius = []
+        for res in protein.residue:
+            for conf in res.conf:
+                self.conf_index[conf.confID] = len(self.confID)
+                self.confID.append(conf.confID)
+                atoms.extend(conf.atom)
+                conf_start.append(len(atoms))
+                blob = getattr(conf, "blob", None)
+                if blob is None:
+                    blob_center.append((0.0, 0.0, 0.0))
+                    blob_radius.append(0.0)
+                else:
+                    blob_center.append(blob.center)
+                    blob_radius.append(blob.radius)
+            res_conf_start.append(len(self.confID))
+
+        self.atom = atoms   # the Atom objects, in array order
+        self.n_atom = len(atoms)
+        self.n_conf = len(self.confID)
+        self.n_res = len(protein.residue)
+        self.conf_start = np.array(conf_start, dtype=np.int64)
+        self.res_conf_start = np.array(res_conf_start, dtype=np.int64)
+        self.conf_res = np.repeat(np.arange(self.n_res), np.diff(self.res_conf_start))
+        self.atom_conf = np.repeat(np.arange(self.n_conf), np.diff(self.conf_start))
+
+        self.xyz = np.array([a.xyz for a in atoms], dtype=float).reshape(-1, 3)
+        self.r_bound = np.array([a.r_bound for a in atoms], dtype=float)
+        self.r_vdw = np.array([a.r_vdw for a in atoms], dtype=float)
+        self.e_vdw = np.array([a.e_vdw for a in atoms], dtype=float)
+        self.charge = np.array([a.charge for a in atoms], dtype=float)
+        self.name = np.array([a.name for a in atoms], dtype="U4")
+
+        self.blob_center = np.array(blob_center, dtype=float).reshape(-1, 3)
+        self.blob_radius = np.array(blob_radius, dtype=float)
+
+        # connectivity in CSR form: neighbors of atom i are idx[ptr[i]:ptr[i+1]]
+        index = {id(a): i for i, a in enumerate(atoms)}
+        self.connect = {}
+        for order in (12, 13, 14):
+            ptr = [0]
+            idx = []
+            for a in atoms:
+                idx.extend(index[id(a2)] for a2 in getattr(a, "connect%d" % order) if id(a2) in index)
+                ptr.append(len(idx))
+            self.connect[order] = (np.array(ptr, dtype=np.int64), np.array(idx, dtype=np.int64))
+
+        for array in [self.conf_start, self.res_conf_start, self.conf_res, self.atom_conf, self.xyz,
+                      self.r_bound, self.r_vdw, self.e_vdw, self.charge, self.name, self.blob_center,
+                      self.blob_radius] + [x for pair in self.connect.values() for x in pair]:
+            array.flags.writeable = False   # a snapshot, changes go to the Atom objects
+
+        self._residue_unique = {}
+
+    def conf_atoms(self, k):
+        """Slice of the atoms of conformer k."""
+        return slice(self.conf_start[k], self.conf_start[k + 1])
+
+    def connected(self, i, order=12):
+        """Atom indices in the connect12, connect13 or connect14 list of atom i."""
+        ptr, idx = self.connect[order]
+        return idx[ptr[i]:ptr[i + 1]]
+
+    def connect_pairs(self, atoms, order=12):
+        """Rows (positions in atoms) and atom indices of the connectivity lists of the given atoms."""
+        ptr, idx = self.connect[order]
+        starts = ptr[atoms]
+        counts = ptr[atoms + 1] - starts
+        rows = np.repeat(np.arange(len(atoms)), counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        return rows, idx[np.repeat(starts, counts) + offsets]
+
+    def is_conf_clash(self, k1, k2, use_r_bound=True):
+        """Quick detection of the conformer to conformer clash without considering connectivity.
+        If use_r_bound is True, then use half of the dielectric boundary radius, otherwise use r_vdw.
+        """
+        s1 = self.conf_atoms(k1)
+        s2 = self.conf_atoms(k2)
+        if use_r_bound:
+            r1 = self.r_bound[s1] * 0.5
+            r2 = self.r_bound[s2] * 0.5
+        else:
+            r1 = self.r_vdw[s1]
+            r2 = self.r_vdw[s2]
+        d2 = ((self.xyz[s1][:, np.newaxis, :] - self.xyz[s2][np.newaxis, :, :]) ** 2).sum(axis=2)
+        return bool((d2 < (r1[:, np.newaxis] + r2[np.newaxis, :]) ** 2).any())
+
+    def residue_unique_atoms(self, i_res, tolerance=0.001):
+        """Merge the side chain atoms of residue i_res that have the same xyz and r_bound.
+
+        Atoms are visited in conformer order and matched to the first earlier unique atom
+        within the tolerance, as in the multi side chain dielectric boundary.
+        Returns the list of atom index groups; the first atom of a group is the unique one.
+        """
+        if i_res in self._residue_unique:
+            return self._residue_unique[i_res]
+
+        first = self.conf_start[self.res_conf_start[i_res] + 1]   # skip backbone conformer
+        last = self.conf_start[self.res_conf_start[i_res + 1]]
+        groups = []
+        if last > first:
+            xyzr = np.column_stack((self.xyz[first:last], self.r_bound[first:last]))
+            unique = np.empty((last - first, 4))
+            n_unique = 0
+            for j in range(last - first):
+                if n_unique:
+                    matched = np.flatnonzero((np.abs(unique[:n_unique] - xyzr[j]) < tolerance).all(axis=1))
+                    if matched.size:
+                        groups[matched[0]].append(first + j)
+                        continue
+                unique[n_unique] = xyzr[j]
+                n_unique += 1
+                groups.append([first + j])
+
+        self._residue_unique[i_res] = groups
+        return groups
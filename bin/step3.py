@@ -37,6 +37,7 @@ import os
 from pathlib import Path
 import tempfile
 import shutil
+import subprocess
 import sys
 import time
 from mccesteps import record_runprm 
@@ -46,6 +47,8 @@ from mccesteps import restore_runprm
 import itertools
 #from pdbio import *
 from pbs_interfaces import *
+from protein_arrays import ProteinArrays
+from step3_profile import PROFILE, PROFILE_TABLE, PROFILE_JSON, write_report
 
 
 logger = logging.getLogger("step3.py")
@@ -153,6 +156,7 @@ class RunOptions:
         self.skip_pb = args.skip_pb
         self.fly = args.fly
         self.debug = args.debug
+        self.profile = args.profile
         self.refresh = args.refresh
         if args.l:  # load options from the specified file
             lines = open(args.l).readlines()
@@ -361,32 +365,12 @@ class Exchange:
                 # other residues will have all conformers with 0 charge.
                 # skip dummy or backbone only residue
                 if len(protein.residue[ires].conf) > 1:
-                    # this is the xyzrcp record for all side chain atoms of this residue
-                    residue_bnd_xyzrcp = []
-                    # this points to the atom records of each line in residue_bnd_xyzrpc
-                    residue_bnd_atom = []
-                    for iconf in range(1, len(protein.residue[ires].conf)):
-                        for atom in protein.residue[ires].conf[iconf].atom:
-                            xyzrcp = ExchangeAtom(atom)
-                            # test if this atom existed within this residue already
-                            found = False
-                            for ib in range(len(residue_bnd_xyzrcp)):
-                                if (abs(residue_bnd_xyzrcp[ib].x - xyzrcp.x) < 0.001
-                                        and abs(residue_bnd_xyzrcp[ib].y - xyzrcp.y) < 0.001
-                                        and abs(residue_bnd_xyzrcp[ib].z - xyzrcp.z) < 0.001
-                                        and abs(residue_bnd_xyzrcp[ib].r - xyzrcp.r) < 0.001):
-                                    # identical atom
-                                    residue_bnd_atom[ib].append(atom)
-                                    found = True
-                                    break
-
-                            if not found:
-                                residue_bnd_xyzrcp.append(xyzrcp)
-                                residue_bnd_atom.append([atom])
-
-                    # merge this residue to the multi-bnd
-                    self.multi_bnd_xyzrcp += residue_bnd_xyzrcp
-                    self.multi_bnd_atom += residue_bnd_atom
+                    # identical atoms (xyz and r_bound within 0.001) of the side chain conformers
+                    # are merged once per residue on the array export, then reused
+                    for group in protein.arrays.residue_unique_atoms(ires):
+                        atoms = [protein.arrays.atom[i] for i in group]
+                        self.multi_bnd_xyzrcp.append(ExchangeAtom(atoms[0]))
+                        self.multi_bnd_atom.append(atoms)
 
         # Basic error checking
         if len(self.multi_bnd_xyzrcp) != len(self.multi_bnd_atom):
@@ -493,7 +477,10 @@ def pbe(iric):
     pid = current_process()  # Identify this worker
     confid = protein.residue[ir].conf[ic].confID
     resid = confid[:3] + confid[5:11]
-    bound = def_boundary(ir, ic)
+    PROFILE.start(confid, run_options.s)
+    with PROFILE.phase("boundary"):
+        bound = def_boundary(ir, ic)
+    PROFILE.boundary_sizes(bound)
     rxn = 0.0
 
     # skip pbe if atoms in this conformer are all 0 charged
@@ -601,6 +588,7 @@ def pbe(iric):
                 shutil.rmtree(tmp_pbe)
 
     # write raw opp file
+    t_raw = time.perf_counter()
     fname = "%s/%s.raw" % (energy_folder, confid)
 
     if not Path(energy_folder).exists():
@@ -708,6 +696,7 @@ def pbe(iric):
 
         with open(fname, "w") as ofh:
             ofh.writelines(raw_lines)
+    PROFILE.add("raw", time.perf_counter() - t_raw)
 
     progress_log = "progress.log"
 
@@ -729,6 +718,8 @@ def pbe(iric):
     with open(progress_log, "a") as proglog:
         proglog.write(summary_line)
 
+    PROFILE.add("total", end_time - start_time)
+    PROFILE.finish(skipped=all_0)
     return (ir, ic)
 
 
@@ -854,7 +845,8 @@ def postprocess_ele(protein):
                     # detect the clash between conf1 and conf2_ref
                     clash = False
                     if conf2_ref:
-                        clash = is_conf_clash(conf1, conf2_ref)
+                        clash = protein.arrays.is_conf_clash(protein.arrays.conf_index[conf1_id],
+                                                             protein.arrays.conf_index[conf2_ref.confID])
 
                     # mark res2 conformers with "?"
                     if clash:
@@ -1260,6 +1252,12 @@ def cli_parser():
         "--fly", default=False, action="store_true",
         help="don-the-fly rxn0 calculation; default: %(default)s.",
     )
+    parser.add_argument(
+        "--profile",
+        default=False,
+        action="store_true",
+        help="record per-conformer PB solver timings into %s and %s; default: %%(default)s." % (PROFILE_TABLE, PROFILE_JSON),
+    )
     parser.add_argument(
         "--refresh",
         default=False,
@@ -1312,6 +1310,8 @@ if __name__ == "__main__":
 
     logger.info("   Process run time options & convert step2_out.pdb.")
     run_options = RunOptions(args)
+    if run_options.profile:
+        PROFILE.enable()  # before the worker pool is forked, so that the workers inherit it
     # print(vars(run_options))
 
     # environment and ftpl
@@ -1328,6 +1328,7 @@ if __name__ == "__main__":
     protein = Protein()
     protein.loadpdb(run_options.inputpdb)
     protein.update_confcrg()
+    protein.arrays = ProteinArrays(protein)   # array export for boundary composition and clash detection
     logger.info("   Time needed: %d seconds.", time.time() - start_t)
     start_t = time.time()
 
@@ -1435,7 +1436,8 @@ if __name__ == "__main__":
         os.system("apptainer instance stop my_instance")
         
     logger.info("   Processing ele pairwise interaction...")
-    ele_matrix = postprocess_ele(protein)
+    with PROFILE.stage("postprocess_ele"):
+        ele_matrix = postprocess_ele(protein)
     # Debug
     # for conf_pair, ele_pw in ele_matrix.items():
     #     reversed_key = (conf_pair[1], conf_pair[0])
@@ -1459,20 +1461,23 @@ if __name__ == "__main__":
 
     # Compute vdw, not doing parallelization at this moment
     logger.info("   Making atom connectivity ...")
-    protein.make_connect12()
-    protein.make_connect13()
-    protein.make_connect14()
+    with PROFILE.stage("make_connect"):
+        protein.make_connect12()
+        protein.make_connect13()
+        protein.make_connect14()
     logger.info("   Time needed: %d seconds.", time.time() - start_t)
     start_t = time.time()
 
     logger.info("   Calculating vdw ...")
-    protein.calc_vdw_virtual(delta=args.vdw_relax)  # Call subroutine that creates vdw virtual conformers
+    with PROFILE.stage("calc_vdw"):
+        protein.calc_vdw_virtual(delta=args.vdw_relax)  # Call subroutine that creates vdw virtual conformers
     # For efficiency reason, the vdw pairwise table is a matrix protein.vdw_pw[conf1.i,conf2.i]
     logger.info("   Time needed: %d seconds.", time.time() - start_t)
     start_t = time.time()
 
     logger.info("   Calculating torsion energy ...")
-    protein.calc_tors()
+    with PROFILE.stage("calc_tors"):
+        protein.calc_tors()
     logger.info("   Time needed: %d seconds.", time.time() - start_t)
     start_t = time.time()
 
@@ -1486,14 +1491,20 @@ if __name__ == "__main__":
     # Assemble output files, order sensitive as head3.lst subroutine will make serial for
     # conformers later used by opp files
     logger.info("   Composing head3.lst ...")
-    compose_head3(protein)
+    with PROFILE.stage("compose_head3"):
+        compose_head3(protein)
     logger.info("   Time needed: %d seconds.", time.time() - start_t)
     start_t = time.time()
 
     logger.info("   Composing opp files ...")
-    compose_opp(protein, ele_matrix)
+    with PROFILE.stage("compose_opp"):
+        compose_opp(protein, ele_matrix)
     logger.info("   Time needed: %d seconds.", time.time() - start_t)
 
+    if PROFILE.enabled:
+        write_report()
+        logger.info("   Step3 profile written to %s and %s." % (PROFILE_TABLE, PROFILE_JSON))
+
     logger.info("   Total time for step3 is %d seconds.", time.time() - start_t0)
 
     if detected:
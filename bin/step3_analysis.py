@@ -1,29 +1,18 @@
 #!/usr/bin/env python
 
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4.conftables import read_head3
+
 new_folder = "energies"
 old_folder = "energies.old"
 write_cutoff = 0.01
 
 def read_confnames():
-    confnames = []
-    lines = open("head3.lst").readlines()
-    for line in lines[1:]:
-        fields = line.split()
-        if len(fields) < 17:
-            continue
-        confnames.append(fields[1])
-    return confnames
+    return read_head3("head3.lst")["CONFORMER"].tolist()
 
 def load_old_backbone():
-    backbone_ele = {}
-    lines = open("head3.lst").readlines()
-    for line in lines[1:]:
-        fields = line.split()
-        if len(fields) < 17:
-            continue
-        confid = fields[1]
-        epol = float(fields[12])
-        backbone_ele[confid] = epol
+    head3 = read_head3("head3.lst")
+    backbone_ele = dict(zip(head3["CONFORMER"].tolist(), head3["epol"].tolist()))
 
     return backbone_ele
 
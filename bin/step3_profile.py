@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+"""
+Module: step3_profile.py
+
+Opt-in per-conformer profiling of step3 (step3.py --profile).
+
+Each conformer handled by pbe() gets a record of phase timings and boundary sizes:
+  * boundary: composing the float, single and multi boundary conditions
+  * write:    writing solver input files (PBS_* write_* methods)
+  * spawn:    starting the solver subprocess
+  * solve:    waiting for the solver subprocess to finish
+  * parse:    reading solver output (PBS_* collect_* methods)
+  * raw:      composing and writing energies/*.raw
+  * total:    the whole pbe() call
+Workers append one JSON line per conformer to step3_profile.jsonl. The parent adds the
+timings of its own post-processing stages and writes a summary table (step3_profile.txt)
+and a machine readable summary (step3_profile.json).
+
+When profiling is off, the hooks only test a flag.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import functools
+import json
+import os
+import subprocess
+import time
+
+import numpy as np
+
+
+PROFILE_RECORDS = "step3_profile.jsonl"
+PROFILE_TABLE = "step3_profile.txt"
+PROFILE_JSON = "step3_profile.json"
+PHASES = ["boundary", "write", "spawn", "solve", "parse", "raw", "total"]
+PERCENTILES = [50, 90, 99]
+
+
+class Step3Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.fname = ""
+        self.record = None   # record of the conformer in progress
+        self.parent = {}     # parent side stage timings, seconds
+
+    def enable(self, fname=PROFILE_RECORDS):
+        """Turn profiling on and start a new record file. Call it before forking the workers."""
+        self.enabled = True
+        self.fname = os.path.abspath(fname)
+        if os.path.isfile(self.fname):
+            os.remove(self.fname)
+
+    def start(self, confid, solver):
+        if self.enabled:
+            self.record = {"conf": confid, "solver": solver, "phases": defaultdict(float), "sizes": {}}
+
+    def add(self, phase, seconds):
+        if self.enabled and self.record is not None:
+            self.record["phases"][phase] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        if not (self.enabled and self.record is not None):
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record["phases"][name] += time.perf_counter() - t
+
+    def boundary_sizes(self, bound):
+        if self.enabled and self.record is not None:
+            self.record["sizes"] = {"float": len(bound.float_bnd_xyzrcp),
+                                    "single": len(bound.single_bnd_xyzrcp),
+                                    "multi": len(bound.multi_bnd_xyzrcp)}
+
+    def finish(self, skipped=False):
+        """Append the record of the conformer in progress to the record file."""
+        if not (self.enabled and self.record is not None):
+            return
+        self.record["skipped"] = skipped
+        line = json.dumps(self.record) + "\n"
+        with open(self.fname, "a") as fh:   # one short append per conformer, safe across workers
+            fh.write(line)
+        self.record = None
+
+    @contextmanager
+    def stage(self, name):
+        """Time a parent side stage, e.g. postprocess_ele."""
+        if not self.enabled:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.parent[name] = self.parent.get(name, 0.0) + time.perf_counter() - t
+
+
+PROFILE = Step3Profiler()
+
+
+def timed(phase):
+    """Decorator adding the run time of a method to a phase of the current conformer record."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not PROFILE.enabled:
+                return func(*args, **kwargs)
+            with PROFILE.phase(phase):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def run_solver(command, **kwargs):
+    """subprocess.run(command, capture_output=True, text=True, **kwargs) with the process start
+    and the wait for the solver recorded as the "spawn" and "solve" phases.
+    """
+    t = time.perf_counter()
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, **kwargs) as proc:
+        t_started = time.perf_counter()
+        stdout, stderr = proc.communicate()
+    PROFILE.add("spawn", t_started - t)
+    PROFILE.add("solve", time.perf_counter() - t_started)
+    return subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+
+
+def _stats(values):
+    values = np.asarray(values, dtype=float)
+    stats = {"n": int(values.size), "mean": float(values.mean()), "max": float(values.max())}
+    for q, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        stats["p%d" % q] = float(v)
+    return stats
+
+
+def summarize(records, parent=None):
+    """Aggregate conformer records per solver and per residue type."""
+    summary = {"n_conformers": len(records),
+               "n_skipped": sum(1 for r in records if r["skipped"]),
+               "parent": parent or {},
+               "by_solver": {},
+               "by_residue": {}}
+    groups = defaultdict(list)
+    for r in records:
+        if not r["skipped"]:
+            groups[("by_solver", r["solver"])].append(r)
+            groups[("by_residue", r["conf"][:3])].append(r)
+    for (kind, name), group in sorted(groups.items()):
+        entry = {"phases": {}, "sizes": {}}
+        for phase in PHASES:
+            entry["phases"][phase] = _stats([r["phases"].get(phase, 0.0) for r in group])
+        for bnd in ("float", "single", "multi"):
+            entry["sizes"][bnd] = _stats([r["sizes"].get(bnd, 0) for r in group])
+        summary[kind][name] = entry
+    return summary
+
+
+def summary_lines(summary):
+    lines = ["Step3 profile: %d conformers, %d skipped (no charge)\n"
+             % (summary["n_conformers"], summary["n_skipped"])]
+    for kind, title in (("by_solver", "Solver"), ("by_residue", "Residue")):
+        lines.append("\n%-8s %-9s %6s %9s %9s %9s %9s %9s\n"
+                     % (title, "Phase", "N", "mean(s)", "p50(s)", "p90(s)", "p99(s)", "max(s)"))
+        for name, entry in summary[kind].items():
+            for phase in PHASES:
+                s = entry["phases"][phase]
+                lines.append("%-8s %-9s %6d %9.3f %9.3f %9.3f %9.3f %9.3f\n"
+                             % (name, phase, s["n"], s["mean"], s["p50"], s["p90"], s["p99"], s["max"]))
+            sizes = ", ".join("%s %.0f" % (bnd, entry["sizes"][bnd]["mean"]) for bnd in ("float", "single", "multi"))
+            lines.append("%-8s %-9s %s\n" % (name, "atoms", "mean boundary size: " + sizes))
+    if summary["parent"]:
+        lines.append("\nParent side stages\n")
+        for name, seconds in summary["parent"].items():
+            lines.append("%-24s %9.3f s\n" % (name, seconds))
+    return lines
+
+
+def write_report(profiler=PROFILE, table=PROFILE_TABLE, json_file=PROFILE_JSON):
+    """Read the conformer records and write the summary table and the json summary."""
+    records = []
+    if os.path.isfile(profiler.fname):
+        with open(profiler.fname) as fh:
+            records = [json.loads(line) for line in fh if line.strip()]
+    summary = summarize(records, profiler.parent)
+    with open(table, "w") as fh:
+        fh.writelines(summary_lines(summary))
+    with open(json_file, "w") as fh:
+        json.dump(summary, fh, indent=2)
+    return summary
@@ -35,6 +35,12 @@ Usage examples:
 
 7. Run step 4 with other customized parameters
     step4.py -u EXTRA=./extra.tpl
+
+8. Run step 4 as one mcce job per titration point, 4 jobs at a time
+    step4.py -p 4
+
+9. Run step 4 as jobs of 3 titration points each, 4 jobs at a time
+    step4.py -p 4 -g 3
 """
 
 import argparse
@@ -45,6 +51,7 @@ from mccesteps import record_runprm
 from mccesteps import detect_runprm
 from mccesteps import restore_runprm
 from amend_sumcrg import amend_sum_crg
+from parallel_titration import run_parallel
 
 def write_runprm(args):
     runprm = {}
@@ -119,7 +126,7 @@ def write_runprm(args):
     export_runprm(runprm)
     record_runprm(runprm, "#STEP4")
 
-    return
+    return runprm
 
 
 
@@ -190,6 +197,20 @@ if __name__ == "__main__":
         default="",
         help="User customized variables; default: %(default)s.",
     )
+    parser.add_argument(
+        "-p",
+        metavar="jobs",
+        type=int,
+        default=1,
+        help="Number of titration jobs to run in parallel, 1 runs all points in one mcce; default: %(default)s.",
+    )
+    parser.add_argument(
+        "-g",
+        metavar="points",
+        type=int,
+        default=1,
+        help="Number of titration points in each parallel job; default: %(default)s.",
+    )
     parser.add_argument(
         "-load_runprm",
         metavar="prm_file",
@@ -200,8 +221,10 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     detected = detect_runprm()
-    write_runprm(args)
-    if not args.norun:
+    runprm = write_runprm(args)
+    if not args.norun and args.p > 1:
+        run_parallel(runprm, args.e, args.p, max(args.g, 1))
+    elif not args.norun:
         process = subprocess.Popen([args.e], stdout=subprocess.PIPE)
         for line in process.stdout:
             print(line.decode(), end="")
@@ -32,9 +32,15 @@ import numpy as np
 from scipy.optimize import curve_fit
 from sanity import *
 
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4.conftables import read_head3, read_fort38
+
 PH2KCAL = 1.364
 fname_sumcrg = "sum_crg2.out"
 fname_pkout = "pK2.out"
+FIT_MAXITER = 200  # iterations of the batched fit, curves not converged by then go to curve_fit
+FIT_GTOL = 1.0e-10  # gradient of chi2 at convergence
+FIT_FTOL = 1.0e-12  # relative decrease of chi2 in a step at convergence
 
 
 def sigmoid(x, x0, k):
@@ -43,6 +49,84 @@ def sigmoid(x, x0, k):
     return y
 
 
+def half_point_guess(xdata, ydata, x0_max, k_max):
+    """Initial midpoint and slope of each curve in ydata, rows going from 0 to -1.
+    The midpoint is where the curve crosses -0.5, by linear interpolation, and the slope is the one
+    of a sigmoid as steep as the crossing segment. A curve that does not cross -0.5 starts at the end
+    of the range it is heading to.
+    """
+    n_curves = ydata.shape[0]
+    below = ydata <= -0.5
+    crossing = below[:, 1:] != below[:, :-1]
+    crosses = crossing.any(axis=1)
+    j = np.argmax(crossing, axis=1)
+    rows = np.arange(n_curves)
+    dy = ydata[rows, j + 1] - ydata[rows, j]
+    dx = xdata[j + 1] - xdata[j]
+    t = np.divide(-0.5 - ydata[rows, j], dy, out=np.full(n_curves, 0.5), where=dy != 0)
+
+    x0 = np.where(crosses, xdata[j] + t * dx, np.where(ydata.mean(axis=1) > -0.5, x0_max, 0.0))
+    k = np.where(crosses, 4.0 * np.abs(dy) / dx, 1.0)
+    return np.column_stack([np.clip(x0, 0.0, x0_max), np.clip(k, 0.01, k_max)])
+
+
+def fit_sigmoids(xdata, ydata, x0_max, k_max=4.0):
+    """Least squares fit of sigmoid(x, x0, k) to every row of ydata at once, within the bounds
+    0 <= x0 <= x0_max and 0 <= k <= k_max.
+    Each iteration takes a Levenberg-Marquardt step for all curves, from the 2x2 normal equations
+    solved in closed form. A parameter at a bound is held there while the gradient points out of the
+    bounds. Return the parameters (n_curves, 2), chi2 (n_curves) and which curves converged.
+    """
+    n_curves = ydata.shape[0]
+    lower = np.zeros(2)
+    upper = np.array([x0_max, k_max])
+    params = half_point_guess(xdata, ydata, x0_max, k_max)
+    damping = np.full(n_curves, 1.0e-3)
+    converged = np.zeros(n_curves, dtype=bool)
+
+    def chi2_of(p, y):
+        return np.sum((sigmoid(xdata[None, :], p[:, :1], p[:, 1:]) - y) ** 2, axis=1)
+
+    chi2 = chi2_of(params, ydata)
+    for _ in range(FIT_MAXITER):
+        todo = ~converged
+        if not todo.any():
+            break
+        p = params[todo]
+        dx = xdata[None, :] - p[:, :1]
+        f = sigmoid(xdata[None, :], p[:, :1], p[:, 1:])
+        residual = f - ydata[todo]
+        ds = -f * (1.0 + f)  # derivative of the logistic function, f is its negative
+        jac = np.stack([p[:, 1:] * ds, -dx * ds], axis=2)  # d f / d x0, d f / d k
+        grad = np.einsum("ij,ijk->ik", residual, jac)
+        hess = np.einsum("ijk,ijl->ikl", jac, jac)
+
+        held = ((p <= lower) & (grad > 0)) | ((p >= upper) & (grad < 0))
+        free_grad = np.where(held, 0.0, grad)
+        done = np.abs(free_grad).max(axis=1) < FIT_GTOL
+
+        # damped normal equations, a held parameter gets a unit row and no coupling
+        a = np.where(held[:, 0], 1.0, hess[:, 0, 0] * (1.0 + damping[todo]))
+        d = np.where(held[:, 1], 1.0, hess[:, 1, 1] * (1.0 + damping[todo]))
+        b = np.where(held.any(axis=1), 0.0, hess[:, 0, 1])
+        det = a * d - b * b
+        det = np.where(det > 0, det, np.inf)
+        step = -np.column_stack([d * free_grad[:, 0] - b * free_grad[:, 1], a * free_grad[:, 1] - b * free_grad[:, 0]]) / det[:, None]
+
+        trial = np.clip(p + step, lower, upper)
+        trial_chi2 = chi2_of(trial, ydata[todo])
+        better = trial_chi2 < chi2[todo]
+        done |= better & (chi2[todo] - trial_chi2 <= FIT_FTOL * chi2[todo])
+
+        index = np.flatnonzero(todo)
+        params[index[better]] = trial[better]
+        chi2[index[better]] = trial_chi2[better]
+        damping[index] = np.clip(np.where(better, damping[todo] * 0.1, damping[todo] * 10.0), 1.0e-12, 1.0e12)
+        converged[index[done]] = True
+
+    return params, chi2, converged
+
+
 class Conformer:
     def __init__(self):
         self.name = ""
@@ -171,102 +255,89 @@ class Titration:
         k0 = xvalue[1] - xvalue[0]
 
         xdata = np.array([float(i) for i in range(npoints)])
-        for res in self.residues:
-            if res.state_flag != "0":
-                res_str = res.resid[:3] + res.state_flag + res.resid[3:]
-
-                # ydata of sigmoid function is always positive [0, 1] but our net charge is [-1, 0]
-                ydata = np.array(res.netcrg)
-                # print(xdata)
-                # print("Before:",ydata)
-                if ydata.mean() > 0:
-                    ydata += -1.0  # acid[0, -1], base[+1, 0] -> [0, -1]
-                if ydata[-1] - ydata[0] > 0.0:
-                    ydata = -ydata - 1
-                    # print("After:", ydata)
-                msg = ""
+        charged = [res for res in self.residues if res.state_flag != "0"]
+        ydata = np.zeros((len(charged), npoints))
+        for i, res in enumerate(charged):
+            # ydata of sigmoid function is always positive [0, 1] but our net charge is [-1, 0]
+            y = np.array(res.netcrg)
+            if y.mean() > 0:
+                y += -1.0  # acid[0, -1], base[+1, 0] -> [0, -1]
+            if y[-1] - y[0] > 0.0:
+                y = -y - 1
+            ydata[i] = y
+
+        # all curves are fitted together, the ones that do not converge one by one by curve_fit
+        fitted, chi2, converged = fit_sigmoids(xdata, ydata, npoints)
+        for i, res in enumerate(charged):
+            res_str = res.resid[:3] + res.state_flag + res.resid[3:]
+            msg = ""
+            if converged[i]:
+                popt = fitted[i]
+                chi_squared = chi2[i]
+            else:
                 try:
                     (popt, pcov) = curve_fit(
-                        sigmoid, xdata, ydata, bounds=(0, [npoints, 4])
+                        sigmoid, xdata, ydata[i], bounds=(0, [npoints, 4])
                     )
-                    # (popt, pcov) = curve_fit(sigmoid, xdata, ydata)
+                    chi_squared = np.sum([(sigmoid(xdata, *popt) - ydata[i]) ** 2])
                 except RuntimeError:
                     msg = "Titration out of range"
                 except ValueError:
                     msg = "Input value not valid"
 
-                # print(res_str, popt)
-                if (
-                    popt[0] < 0.001 or popt[0] > npoints - 1.001
-                ):  # x from 0 to 14 as 15 points
-                    msg = "Titration out of range"
+            if not msg and (
+                popt[0] < 0.001 or popt[0] > npoints - 1.001
+            ):  # x from 0 to 14 as 15 points
+                msg = "Titration out of range"
 
-                if msg:
-                    pkout.append("%s         %s\n" % (res_str, msg))
+            if msg:
+                pkout.append("%s         %s\n" % (res_str, msg))
+            else:
+                midpoint = popt[0] * k0 + x0
+                if titration_type.upper() == "PH":
+                    nslope = 0.4342 * popt[1] / titration_delta
+                elif titration_type.upper() == "EM":
+                    nslope = 0.4342 * popt[1] / titration_delta * 58.0
+                elif (
+                    titration_type.upper() == "CH"
+                    or titration_type.upper() == "EXTRA"
+                ):
+                    nslope = 0.4342 * popt[1] / titration_delta * PH2KCAL
                 else:
-                    chi_squared = np.sum([(sigmoid(xdata, *popt) - ydata) ** 2])
-                    midpoint = popt[0] * k0 + x0
-                    if titration_type.upper() == "PH":
-                        nslope = 0.4342 * popt[1] / titration_delta
-                    elif titration_type.upper() == "EM":
-                        nslope = 0.4342 * popt[1] / titration_delta * 58.0
-                    elif (
-                        titration_type.upper() == "CH"
-                        or titration_type.upper() == "EXTRA"
-                    ):
-                        nslope = 0.4342 * popt[1] / titration_delta * PH2KCAL
-                    else:
-                        print("Why am I here?")
-                    pka_str = "%9.3f %9.3f %9.3f" % (
-                        midpoint,
-                        nslope,
-                        chi_squared * 1000.0,
-                    )
-                    pkout.append("%s    %s\n" % (res_str, pka_str))
+                    print("Why am I here?")
+                pka_str = "%9.3f %9.3f %9.3f" % (
+                    midpoint,
+                    nslope,
+                    chi_squared * 1000.0,
+                )
+                pkout.append("%s    %s\n" % (res_str, pka_str))
 
-            open(fname_pkout, "w").writelines(pkout)
+        open(fname_pkout, "w").writelines(pkout)
 
         return
 
     def load_confs(self):
         conformers = []
 
-        fort38_lines = open("fort.38").readlines()
-        head3_lines = open("head3.lst").readlines()
-        line = fort38_lines.pop(0)
-        fields = line.split()
-        self.titration_type = fields[0]
-        self.titration_points = [float(x) for x in fields[1:]]
-        head3_lines.pop(0)
-
-        while fort38_lines and head3_lines:
-            fort38_data = fort38_lines.pop(0)
-            head3_data = head3_lines.pop(0)
-            conf = Conformer()
+        head3 = read_head3("head3.lst").tolist()
+        fort38 = read_fort38("fort.38")
+        self.titration_type = fort38.titr_type
+        self.titration_points = fort38.points.tolist()
 
-            fields = fort38_data.split()
-            conf.name = fields[0]
-            conf.occ = [float(x) for x in fields[1:]]
+        for name, occ, head3_data in zip(fort38.confname.tolist(), fort38.occ.tolist(), head3):
+            conf = Conformer()
+            conf.name = name
+            conf.occ = occ
 
-            fields = head3_data.split()
-            if conf.name != fields[1]:
+            if conf.name != head3_data[1]:
                 print(
                     "Confomer %s in fort.38 does not match %s in head3.lst"
-                    % (conf.name, fields[1])
+                    % (conf.name, head3_data[1])
                 )
                 sys.exit()
 
-            conf.crg = float(fields[4])
-            conf.em0 = float(fields[5])
-            conf.pka0 = float(fields[6])
-            conf.ne = int(fields[7])
-            conf.nh = int(fields[8])
-            conf.vdw0 = float(fields[9])
-            conf.vdw1 = float(fields[10])
-            conf.tors = float(fields[11])
-            conf.epol = float(fields[12])
-            conf.dsolv = float(fields[13])
-            conf.extra = float(fields[14])
+            (conf.crg, conf.em0, conf.pka0, conf.ne, conf.nh, conf.vdw0, conf.vdw1,
+             conf.tors, conf.epol, conf.dsolv, conf.extra) = head3_data[4:15]
             conformers.append(conf)
 
         return conformers
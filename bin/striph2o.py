@@ -7,53 +7,12 @@ import math
 import os
 
 
-DEFAULT_RAD = 1.8
-probe_rad = 1.4
-area_k = 4.0*math.pi
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4.sas import DEFAULT_RAD, probe_rad, radius, fibonacci_sphere, SAS_GRID, atom_sas
 
 BOX_SIZE = 2.3 + probe_rad    # roughly = max atom radius + probe radius
 
 
-radius = {" H": 1.2,
-          " C": 1.7,
-          " N": 1.55,
-          " O": 1.52,
-          " F": 1.47,
-          " P": 1.8,
-          " S": 1.8,
-          "CL": 1.75,
-          "CU": 1.4,
-          " B": 1.92,
-          "AL": 1.84,
-          "NA": 2.27,
-          "MG": 1.73,
-          "SI": 2.1,
-          "CA": 2.31,
-          " K": 2.75,
-          "FE": 1.63,
-          "ZN": 1.39,
-          "BR": 1.85
-}
-
-
-def fibonacci_sphere(samples):
-
-    points = []
-    phi = math.pi * (3. - math.sqrt(5.))  # golden angle in radians
-
-    for i in range(samples):
-        y = 1 - (i / float(samples - 1)) * 2  # y goes from 1 to -1
-        radius = math.sqrt(1 - y * y)  # radius at y
-
-        theta = phi * i  # golden angle increment
-
-        x = math.cos(theta) * radius
-        z = math.sin(theta) * radius
-
-        points.append((x, y, z))
-
-    return points
-
 n_points = 36    # 122
 point_preset = fibonacci_sphere(n_points)
 
@@ -164,9 +123,8 @@ class Protein:
 
         point_preset = fibonacci_sphere(122)
         for res in self.residues:
-            res.max_exposed = 0.0
-            for atom in new_res.atoms:
-                res.max_exposed += atomacc_in_res(atom, res.atoms, point_preset)
+            # surface of the residue alone
+            res.max_exposed = atom_sas([atom.xyz for atom in res.atoms], [atom.rad_ext for atom in res.atoms], point_preset).sum()
 
         return
 
@@ -235,47 +193,17 @@ class Protein:
         return
 
     def atom_sas(self, point_preset):
-        for res in self.residues:
-            for atom in res.atoms:
-                n_points = len(point_preset)
-                counter = n_points
-                for p_raw in point_preset:
-                    point = (p_raw[0] * atom.rad_ext + atom.xyz[0],
-                             p_raw[1] * atom.rad_ext + atom.xyz[1],
-                             p_raw[2] * atom.rad_ext + atom.xyz[2])
-
-                    ibox = (math.floor((point[0] - self.lower_bound[0])/BOX_SIZE),
-                            math.floor((point[1] - self.lower_bound[1])/BOX_SIZE),
-                            math.floor((point[2] - self.lower_bound[2])/BOX_SIZE))
-
-                    #print("---", ibox)
-                    buried = False
-                    for ix in range(ibox[0] - 1, ibox[0] + 2):
-                        if buried:
-                            break
-                        for iy in range(ibox[1] - 1, ibox[1] + 2):
-                            if buried:
-                                break
-                            for iz in range(ibox[2] - 1, ibox[2] + 2):
-                                if buried:
-                                    break
-                                neighbor_box = (ix, iy, iz)
-                                #print(neighbor_box)
-                                if neighbor_box in self.boxes:
-                                    for atom2 in self.boxes[neighbor_box]:
-                                        if atom2 != atom:
-                                            dx = point[0] - atom2.xyz[0]
-                                            dy = point[1] - atom2.xyz[1]
-                                            dz = point[2] - atom2.xyz[2]
-                                            dd = dx*dx + dy*dy + dz*dz
-                                            if dd < atom2.rad_ext * atom2.rad_ext:
-                                                buried = True
-                                                counter -= 1
-                                                break
-
-                #print(counter)
-                atom.sas = area_k * atom.rad_ext * atom.rad_ext * counter / n_points
-                #print(atom.name, atom.sas)
+        # cofactor atoms are buried by each other and by the rest of atoms
+        cofactor_atoms = [atom for res in self.residues for atom in res.atoms]
+        in_cofactors = set(cofactor_atoms)
+        other_atoms = [atom for atom in self.atoms if atom not in in_cofactors]
+        background = SAS_GRID([atom.xyz for atom in other_atoms], [atom.rad_ext for atom in other_atoms])
+        sas = atom_sas([atom.xyz for atom in cofactor_atoms],
+                       [atom.rad_ext for atom in cofactor_atoms],
+                       point_preset,
+                       background=background)
+        for atom, atom_sas_value in zip(cofactor_atoms, sas):
+            atom.sas = atom_sas_value
 
     def res_sas(self):
         for res in self.residues:
@@ -337,29 +265,6 @@ class Protein:
         return
 
 
-def atomacc_in_res(atom, all_atoms, point_preset):
-    r_extended = probe_rad + atom.rad
-    n_points = len(point_preset)
-    counter = n_points
-    for p_raw in point_preset:
-        point = (p_raw[0] * r_extended + atom.xyz[0],
-                 p_raw[1] * r_extended + atom.xyz[1],
-                 p_raw[2] * r_extended + atom.xyz[2])
-
-        for atom2 in all_atoms:
-            if atom2 != atom:
-                dx = point[0] - atom2.xyz[0]
-                dy = point[1] - atom2.xyz[1]
-                dz = point[2] - atom2.xyz[2]
-                dd = dx * dx + dy * dy + dz * dz
-                if dd < atom2.rad_ext * atom2.rad_ext:
-                    counter -= 1
-                    break
-    sas = area_k * atom.rad_ext * atom.rad_ext * counter / n_points
-
-    return sas
-
-
 def strip_surface(prot, cutoff, point_preset, ncycle = 10):
     n_stripped = 1
 
@@ -368,14 +273,11 @@ def strip_surface(prot, cutoff, point_preset, ncycle = 10):
         timeD = time.time()
 
         print("      Total atoms: %d; processing cofactors: %d ..." % (len(prot.atoms), len(prot.residues)))
-        prot.make_regions()
-        timeC = time.time()
-        print("takes %.3f seconds" % (timeC-timeD))
-
         print("      Compute atom sas ...", end=" ")
         prot.atom_sas(point_preset)
-        timeD = time.time()
-        print("takes %.3f seconds" % (timeD-timeC))
+        timeC = time.time()
+        print("takes %.3f seconds" % (timeC-timeD))
+        timeD = timeC
 
         print("      Compute residue sas ...", end=" ")
         prot.res_sas()
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 # comparison of VDW0, VDW1, TORS, DSOLV in head3.lst
+
+import mcce4_path  # noqa: F401, puts MCCE_bin on the python path
+from mcce4.conftables import read_head3
+
 old_folder = "../4lzt-old/"
 new_folder = "./"
 
@@ -12,30 +16,18 @@ class SELF_E:
         self.epol = 0.0
         self.dsolv = 0.0
 
-    def loadline(self, line):
-        fields = line.split()
-        confID = ""
-        if len(fields) == 17:
-            self.vdw0 = float(fields[9])
-            self.vdw1 = float(fields[10])
-            self.tors = float(fields[11])
-            self.epol = float(fields[12])
-            self.dsolv = float(fields[13])
-            confID = fields[1]
-        return confID
-
 def load_head3(folder):
     fname = "%s/head3.lst" % folder
 
-    lines = open(fname).readlines()
-
     head3 = {}
-    for line in lines:
+    for row in read_head3(fname):
         self_e = SELF_E()
-        confID = self_e.loadline(line)
-
-        if confID:
-            head3[confID] = self_e
+        self_e.vdw0 = row["vdw0"]
+        self_e.vdw1 = row["vdw1"]
+        self_e.tors = row["tors"]
+        self_e.epol = row["epol"]
+        self_e.dsolv = row["dsolv"]
+        head3[row["CONFORMER"]] = self_e
 
     return head3
 